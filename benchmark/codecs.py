@@ -0,0 +1,90 @@
+"""
+Compare compression codecs for ingestion csv and processed parquet files.
+
+For every table the latest ingestion file(s) are read from the ingestion
+bucket (or local csv files are used with --files) and written with each
+codec in memory. Size, encode time and decode time are printed, so the
+INGESTION_CODECS / PROCESSED_CODECS settings can be picked per table.
+
+    python -m benchmark.codecs --bucket funland-ingestion-bucket-123 --tables sales_order staff
+    python -m benchmark.codecs --files sales_order.csv
+"""
+import argparse
+import io
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.lambda_handler.extract import compress_bytes, parse_codec
+from src.lambda_handler.transform import find_latest_ingestion_keys, read_ingestion_files
+
+CSV_CODECS = ["none", "gzip:1", "gzip:6", "gzip:9", "zstd:1", "zstd:3", "zstd:9", "zstd:19"]
+PARQUET_CODECS = ["none", "snappy", "gzip:6", "zstd:1", "zstd:3", "zstd:9"]
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def benchmark_csv(df, spec):
+    codec = parse_codec(spec)
+    body, encode_seconds = timed(lambda: compress_bytes(df.to_csv().encode("utf-8"), codec))
+    if codec["name"] == "none":
+        _, decode_seconds = timed(lambda: pd.read_csv(io.BytesIO(body)))
+    else:
+        _, decode_seconds = timed(lambda: pd.read_csv(pa.input_stream(pa.py_buffer(body),
+                                                                      compression=codec["name"])))
+    return len(body), encode_seconds, decode_seconds
+
+
+def benchmark_parquet(df, spec):
+    codec = parse_codec(spec)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    def encode():
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression=codec["name"], compression_level=codec["level"])
+        return buffer.getvalue()
+
+    body, encode_seconds = timed(encode)
+    _, decode_seconds = timed(lambda: pq.read_table(io.BytesIO(body)).to_pandas())
+    return len(body), encode_seconds, decode_seconds
+
+
+def load_tables(args):
+    if args.files:
+        return {os.path.basename(path).split(".")[0]: pd.read_csv(path) for path in args.files}
+    tables = {}
+    for table in args.tables:
+        keys = find_latest_ingestion_keys(args.bucket, table)
+        if keys:
+            tables[table] = read_ingestion_files(args.bucket, keys)
+    return tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bucket", help="ingestion bucket to read the latest files from")
+    parser.add_argument("--tables", nargs="+", default=["sales_order", "staff", "counterparty", "address"])
+    parser.add_argument("--files", nargs="+", help="local csv files to use instead of the bucket")
+    args = parser.parse_args()
+    if not args.bucket and not args.files:
+        parser.error("give --bucket or --files")
+
+    print(f"{'table':<16}{'file':<9}{'codec':<9}{'rows':>9}{'KiB':>11}{'ratio':>7}{'encode s':>10}{'decode s':>10}")
+    for table, df in load_tables(args).items():
+        for file_type, codecs, benchmark in [("csv", CSV_CODECS, benchmark_csv),
+                                             ("parquet", PARQUET_CODECS, benchmark_parquet)]:
+            baseline = None
+            for spec in codecs:
+                size, encode_seconds, decode_seconds = benchmark(df, spec)
+                baseline = baseline or size
+                print(f"{table:<16}{file_type:<9}{spec:<9}{len(df):>9}{size / 1024:>11.1f}"
+                      f"{baseline / size:>7.2f}{encode_seconds:>10.3f}{decode_seconds:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Show that the fact_sales_order column transforms scale linearly.
+
+A sales_order dataframe of each size is generated in memory (typed the
+way read_ingestion_files returns it) and split_datetime_columns,
+coerce_date_columns and the whole fact_sales_order column pipeline are
+timed on it. Nanoseconds per row should stay flat as the rows grow.
+The per-row loop fact_sales_order used before is timed too, up to
+--loop-max rows, for comparison.
+
+    python -m benchmark.column_transforms
+    python -m benchmark.column_transforms --rows 100000 1000000 5000000
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from src.lambda_handler.transform import alias_columns, coerce_date_columns, order_columns, split_datetime_columns
+
+FACT_COLUMNS = ["sales_record_id", "sales_order_id", "created_date", "created_time", "last_updated_date",
+                "last_updated_time", "sales_staff_id", "counterparty_id", "units_sold", "unit_price",
+                "currency_id", "design_id", "agreed_payment_date", "agreed_delivery_date",
+                "agreed_delivery_location_id"]
+
+
+def sales_orders(rows, seed=0):
+    """
+    Summary : a sales_order dataframe with `rows` rows, timestamps spread
+    over three years and the agreed dates as text, like totesys.
+    """
+    rng = np.random.default_rng(seed)
+    created_at = pd.Timestamp("2022-11-03") + pd.to_timedelta(rng.integers(0, 3 * 365 * 86400, rows), unit="s")
+    agreed = (created_at + pd.to_timedelta(rng.integers(1, 30, rows), unit="D")).strftime("%Y-%m-%d")
+    ids = pd.array(np.arange(1, rows + 1), dtype="Int64")
+    return pd.DataFrame({
+        "sales_order_id": ids, "created_at": created_at, "last_updated": created_at,
+        "design_id": ids, "staff_id": ids, "counterparty_id": ids,
+        "units_sold": pd.array(rng.integers(1000, 100000, rows), dtype="Int64"),
+        "unit_price": rng.integers(200, 400, rows) / 100, "currency_id": ids,
+        "agreed_delivery_date": agreed, "agreed_payment_date": agreed, "agreed_delivery_location_id": ids,
+    })
+
+
+def fact_columns(df):
+    df = alias_columns(df, {"sales_record_id": "sales_order_id"})
+    df = split_datetime_columns(df, {"created_at": "created", "last_updated": "last_updated"})
+    df = df.rename(columns={"staff_id": "sales_staff_id"})
+    df = coerce_date_columns(df, ["agreed_delivery_date", "agreed_payment_date"])
+    return order_columns(df, FACT_COLUMNS)
+
+
+def loop_split(df):
+    # the loop fact_sales_order used to split created_at: one whole-column assignment per row
+    for d in df["created_at"]:
+        df["created_date"] = d.date()
+        df["created_time"] = d.time()
+    return df
+
+
+def timed(function, df):
+    start = time.perf_counter()
+    function(df.copy())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", nargs="+", type=int, default=[10000, 100000, 1000000, 3000000])
+    parser.add_argument("--loop-max", type=int, default=20000, help="largest size the old loop is timed on")
+    args = parser.parse_args()
+
+    cases = {"split_datetime_columns": lambda df: split_datetime_columns(df, {"created_at": "created"}),
+             "coerce_date_columns": lambda df: coerce_date_columns(df, ["agreed_delivery_date"]),
+             "fact_sales_order columns": fact_columns,
+             "old per-row loop": loop_split}
+
+    print(f"{'transform':<28}{'rows':>10}{'seconds':>10}{'ns/row':>10}")
+    for rows in args.rows:
+        df = sales_orders(rows)
+        for name, function in cases.items():
+            if function is loop_split and rows > args.loop_max:
+                continue
+            seconds = timed(function, df)
+            print(f"{name:<28}{rows:>10}{seconds:>10.3f}{seconds / rows * 1e9:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Compare the select and copy extract engines on the totesys database.
+
+Every table is extracted twice from the same REPEATABLE READ snapshot,
+once per engine, into a moto S3 bucket, and the wall time, rows per
+second and bytes written are printed for each. The database credentials
+come from the same .env file the tests use (totesys_user, totesys_password,
+totesys_database, totesys_host, totesys_port).
+
+    python -m benchmark.extract_engines --tables sales_order transaction payment
+"""
+import argparse
+import os
+import time
+import boto3
+from dotenv import load_dotenv
+from moto import mock_aws
+from pg8000.native import Connection
+from src.lambda_handler.extract import extract_table_to_s3, open_export_snapshot
+
+EPOCH = "2000-01-01 00:00:00.000000"
+BUCKET = "benchmark-ingestion-bucket"
+
+
+def connect():
+    load_dotenv()
+    return Connection(
+        user=os.getenv("totesys_user"),
+        password=os.getenv("totesys_password"),
+        database=os.getenv("totesys_database"),
+        host=os.getenv("totesys_host"),
+        port=int(os.getenv("totesys_port", "5432")),
+    )
+
+
+def run_engine(table, engine, db_connection, s3_client):
+    extract_config = {"mode": "stream", "chunk_size": 50000, "format": "csv", "engine": engine}
+    start = time.perf_counter()
+    result = extract_table_to_s3(table, f"{EPOCH}-{engine}", db_connection, s3_client, BUCKET, extract_config,
+                                 watermark=EPOCH)
+    seconds = time.perf_counter() - start
+    return {"rows": result["row_count"], "bytes": result["bytes"], "seconds": seconds,
+            "rows_per_second": result["row_count"] / seconds if seconds else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", nargs="+", default=["sales_order", "transaction", "payment"])
+    args = parser.parse_args()
+
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        db_connection = connect()
+        open_export_snapshot(db_connection)
+        try:
+            print(f"{'table':<16}{'engine':<8}{'rows':>10}{'MiB':>10}{'seconds':>10}{'rows/s':>12}")
+            for table in args.tables:
+                for engine in ["select", "copy"]:
+                    result = run_engine(table, engine, db_connection, s3_client)
+                    print(f"{table:<16}{engine:<8}{result['rows']:>10}{result['bytes'] / 2 ** 20:>10.2f}"
+                          f"{result['seconds']:>10.3f}{result['rows_per_second']:>12.0f}")
+        finally:
+            db_connection.run("COMMIT")
+            db_connection.close()
+
+
+if __name__ == "__main__":
+    main()
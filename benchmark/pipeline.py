@@ -0,0 +1,204 @@
+"""
+Run the whole pipeline locally and measure every stage.
+
+The extract and transform lambda handlers run against the totesys
+database in .env (fill it with benchmark.totesys_data, or pass
+--sales-orders to generate it first) and a moto S3, SSM and Secrets
+Manager standing in for AWS. Moto keeps big objects in temporary files,
+so the S3 stand-in does not hold the whole batch in memory.
+
+For each stage the wall time, rows per second (rows in the batch
+manifest) and peak RSS are printed, then the functions of extract.py and
+transform.py that took the most time (inclusive, summed over calls).
+The load stage is reported as skipped while load.py is empty.
+
+Settings such as EXTRACT_MODE, INGESTION_FORMAT or PROCESSED_CODEC are
+read from the environment, exactly as the lambdas read them.
+
+    python -m benchmark.pipeline
+    python -m benchmark.pipeline --sales-orders 1000000 --top 20
+"""
+import argparse
+import functools
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+import boto3
+from moto import mock_aws
+from benchmark.extract_engines import connect
+from benchmark.totesys_data import load_totesys
+
+EPOCH = "2000-01-01 00:00:00.000000"
+INGESTION_BUCKET = "benchmark-ingestion-bucket"
+PROCESSED_BUCKET = "benchmark-processed-bucket"
+REGION = "eu-west-2"
+
+
+class PeakRss:
+    """
+    Context manager sampling the resident set size of this process every
+    `interval` seconds, peak holds the largest value seen in bytes.
+    Falls back to the lifetime peak from getrusage where /proc is missing.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def current(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # kilobytes on linux, bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return max_rss if os.uname().sysname == "Darwin" else max_rss * 1024
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.peak = self.current()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def timed_function(function, name, stats):
+    """
+    Summary : wrap a function so every call adds its duration to
+    stats[name]. Generators are timed while they are being iterated.
+    """
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            entry = stats.setdefault(name, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    entry["seconds"] += time.perf_counter() - start
+                    return
+                entry["seconds"] += time.perf_counter() - start
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            entry = stats.setdefault(name, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += time.perf_counter() - start
+    return wrapper
+
+
+def instrument(module, stats):
+    """
+    Summary : time every function defined in a lambda module. Calls inside
+    the module look the names up on the module, so they are timed too.
+    """
+    prefix = module.__name__.rsplit(".", 1)[-1]
+    for name, value in list(vars(module).items()):
+        if inspect.isfunction(value) and value.__module__ == module.__name__ and name != "lambda_handler":
+            setattr(module, name, timed_function(value, f"{prefix}.{name}", stats))
+
+
+def set_up_aws(db_credentials):
+    """
+    Summary : create the buckets, the db_creds secret and the last_checked
+    parameter the lambdas expect, inside the active moto mock.
+    """
+    s3_client = boto3.client("s3", region_name=REGION)
+    for bucket in [INGESTION_BUCKET, PROCESSED_BUCKET]:
+        s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": REGION})
+    boto3.client("secretsmanager", region_name=REGION).create_secret(
+        Name="db_creds", SecretString=json.dumps(db_credentials))
+    boto3.client("ssm", region_name=REGION).put_parameter(Name="last_checked", Value=EPOCH, Type="String")
+    os.environ["S3_INGESTION_BUCKET"] = INGESTION_BUCKET
+    os.environ["S3_PROCESSED_BUCKET"] = PROCESSED_BUCKET
+    return s3_client
+
+
+def manifest_rows(s3_client, manifest_key):
+    """
+    Summary : total rows listed as changed in a batch manifest.
+    """
+    body = s3_client.get_object(Bucket=INGESTION_BUCKET, Key=manifest_key)["Body"].read()
+    return sum(entry["row_count"] for entry in json.loads(body)["tables"].values() if entry["changed"])
+
+
+def run_stage(name, handler, stages):
+    """
+    Summary : run one lambda handler and record its wall time and peak RSS.
+    """
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        result = handler()
+        seconds = time.perf_counter() - start
+    stages[name] = {"seconds": seconds, "peak_rss": rss.peak}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sales-orders", type=int, help="generate a fresh totesys database of this size first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--top", type=int, default=15, help="number of functions to list")
+    args = parser.parse_args()
+
+    db_connection = connect()
+    try:
+        if args.sales_orders:
+            print(f"generating totesys with {args.sales_orders} sales orders")
+            load_totesys(db_connection, args.sales_orders, args.seed, replace=True)
+    finally:
+        db_connection.close()
+    db_credentials = {"DB_USER": os.getenv("totesys_user"), "DB_PASSWORD": os.getenv("totesys_password"),
+                      "DB_NAME": os.getenv("totesys_database"), "DB_HOST": os.getenv("totesys_host"),
+                      "DB_PORT": int(os.getenv("totesys_port", "5432"))}
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", REGION)
+    stats = {}
+    stages = {}
+    with mock_aws():
+        s3_client = set_up_aws(db_credentials)
+        # imported inside the mock so the clients the modules keep are mocked
+        import src.lambda_handler.extract as extract
+        import src.lambda_handler.transform as transform
+        instrument(extract, stats)
+        instrument(transform, stats)
+
+        extract_result = run_stage("extract", lambda: extract.lambda_handler({}, None), stages)
+        rows = manifest_rows(s3_client, extract_result["manifest_key"])
+        run_stage("transform", lambda: transform.lambda_handler({"myresult": extract_result}, None), stages)
+
+    print(f"{'stage':<12}{'rows':>10}{'seconds':>10}{'rows/s':>12}{'peak RSS MiB':>14}")
+    for name, stage in stages.items():
+        print(f"{name:<12}{rows:>10}{stage['seconds']:>10.3f}{rows / stage['seconds']:>12.0f}"
+              f"{stage['peak_rss'] / 2 ** 20:>14.1f}")
+    print(f"{'load':<12}{'skipped, load.py is empty':>46}")
+
+    print(f"\n{'function':<56}{'calls':>8}{'seconds':>10}")
+    for name, entry in sorted(stats.items(), key=lambda item: item[1]["seconds"], reverse=True)[:args.top]:
+        print(f"{name:<56}{entry['calls']:>8}{entry['seconds']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
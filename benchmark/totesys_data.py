@@ -0,0 +1,270 @@
+"""
+Generate a synthetic totesys database at any scale.
+
+All 11 tables are created with the columns and value shapes of
+assets/tables_data.txt. The size is set by the number of sales orders
+(10k to 10M); the other tables scale with it:
+
+    purchase_order  sales_orders / 2
+    transaction     one per sales order and per purchase order
+    payment         one per transaction
+    design          sales_orders / 100 (at least 100)
+    the rest        fixed small reference tables
+
+Every foreign key points at a row that exists, and last_updated grows
+with the primary key over 2022-11-03 .. 2025-06-01, like the real feed.
+Rows are generated from a seed, so the same arguments give the same data.
+The foreign keys are not declared as constraints, to keep the load fast.
+
+Rows are streamed with COPY FROM STDIN into the database from .env
+(the same one the tests and benchmark.extract_engines use), or written
+as csv files with --out.
+
+    python -m benchmark.totesys_data --sales-orders 100000 --replace
+    python -m benchmark.totesys_data --sales-orders 10000 --out /tmp/totesys
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import re
+import time
+from datetime import datetime, timedelta
+from benchmark.extract_engines import connect
+
+START = datetime(2022, 11, 3, 14, 20, 49, 962000)
+END = datetime(2025, 6, 1)
+# rows per COPY message
+BATCH_ROWS = 10000
+
+CURRENCIES = ["GBP", "USD", "EUR"]
+DEPARTMENTS = [("Sales", "Manchester"), ("Purchasing", "Manchester"), ("Production", "Leeds"),
+               ("Dispatch", "Leeds"), ("Finance", "Manchester"), ("Facilities", "Manchester"),
+               ("Communications", "Leeds"), ("HR", "Leeds")]
+PAYMENT_TYPES = ["SALES_RECEIPT", "SALES_REFUND", "PURCHASE_PAYMENT", "PURCHASE_REFUND"]
+DESIGN_NAMES = ["Wooden", "Bronze", "Granite", "Steel", "Cotton", "Plastic", "Rubber", "Frozen", "Soft", "Fresh"]
+FILE_LOCATIONS = ["/usr", "/private", "/System", "/lost+found", "/Users", "/opt", "/bin", "/etc"]
+FIRST_NAMES = ["Jeremie", "Deron", "Jeanette", "Ana", "Magdalena", "Korey", "Raphael", "Oswaldo", "Brody", "Jazmyn"]
+LAST_NAMES = ["Franey", "Beier", "Erdman", "Glover", "Zieme", "Kreiger", "Rippin", "Bergnaum", "Ratke", "Kuhn"]
+CITIES = ["New Patienceburgh", "Aliso Viejo", "Lake Charles", "Olsonside", "Fort Shadburgh", "Kendraburgh"]
+COUNTRIES = ["Turkey", "San Marino", "Samoa", "Republic of Korea", "Austria", "Saint Lucia", "Bermuda"]
+DISTRICTS = ["Avon", None, "Buckinghamshire", None, "Cambridgeshire", "Bedfordshire", None]
+COMPANY_WORDS = ["Fahey", "Sons", "Leannon", "Predovic", "Morar", "Armstrong", "Kub", "Frami", "Yost", "Hahn"]
+
+SCHEMA = {
+    "address": """address_id int PRIMARY KEY, address_line_1 varchar NOT NULL, address_line_2 varchar,
+        district varchar, city varchar NOT NULL, postal_code varchar NOT NULL, country varchar NOT NULL,
+        phone varchar NOT NULL, created_at timestamp NOT NULL, last_updated timestamp NOT NULL""",
+    "counterparty": """counterparty_id int PRIMARY KEY, counterparty_legal_name varchar NOT NULL,
+        legal_address_id int NOT NULL, commercial_contact varchar, delivery_contact varchar,
+        created_at timestamp NOT NULL, last_updated timestamp NOT NULL""",
+    "currency": """currency_id int PRIMARY KEY, currency_code varchar(3) NOT NULL,
+        created_at timestamp NOT NULL, last_updated timestamp NOT NULL""",
+    "department": """department_id int PRIMARY KEY, department_name varchar NOT NULL, location varchar,
+        manager varchar, created_at timestamp NOT NULL, last_updated timestamp NOT NULL""",
+    "design": """design_id int PRIMARY KEY, created_at timestamp NOT NULL, design_name varchar NOT NULL,
+        file_location varchar NOT NULL, file_name varchar NOT NULL, last_updated timestamp NOT NULL""",
+    "payment_type": """payment_type_id int PRIMARY KEY, payment_type_name varchar NOT NULL,
+        created_at timestamp NOT NULL, last_updated timestamp NOT NULL""",
+    "staff": """staff_id int PRIMARY KEY, first_name varchar NOT NULL, last_name varchar NOT NULL,
+        department_id int NOT NULL, email_address varchar NOT NULL, created_at timestamp NOT NULL,
+        last_updated timestamp NOT NULL""",
+    "sales_order": """sales_order_id int PRIMARY KEY, created_at timestamp NOT NULL,
+        last_updated timestamp NOT NULL, design_id int NOT NULL, staff_id int NOT NULL,
+        counterparty_id int NOT NULL, units_sold int NOT NULL, unit_price numeric(10, 2) NOT NULL,
+        currency_id int NOT NULL, agreed_delivery_date varchar NOT NULL, agreed_payment_date varchar NOT NULL,
+        agreed_delivery_location_id int NOT NULL""",
+    "purchase_order": """purchase_order_id int PRIMARY KEY, created_at timestamp NOT NULL,
+        last_updated timestamp NOT NULL, staff_id int NOT NULL, counterparty_id int NOT NULL,
+        item_code varchar NOT NULL, item_quantity int NOT NULL, item_unit_price numeric NOT NULL,
+        currency_id int NOT NULL, agreed_delivery_date varchar NOT NULL, agreed_payment_date varchar NOT NULL,
+        agreed_delivery_location_id int NOT NULL""",
+    "transaction": """transaction_id int PRIMARY KEY, transaction_type varchar NOT NULL, sales_order_id int,
+        purchase_order_id int, created_at timestamp NOT NULL, last_updated timestamp NOT NULL""",
+    "payment": """payment_id int PRIMARY KEY, created_at timestamp NOT NULL, last_updated timestamp NOT NULL,
+        transaction_id int NOT NULL, counterparty_id int NOT NULL, payment_amount numeric(10, 2) NOT NULL,
+        currency_id int NOT NULL, payment_type_id int NOT NULL, paid boolean NOT NULL,
+        payment_date varchar NOT NULL, company_ac_number int NOT NULL, counterparty_ac_number int NOT NULL""",
+}
+# parents first, so a partial load never has dangling keys
+TABLE_ORDER = ["address", "counterparty", "currency", "department", "design", "payment_type", "staff",
+               "sales_order", "purchase_order", "transaction", "payment"]
+
+
+def table_columns(table):
+    """
+    Summary : column names of a table, in SCHEMA order.
+    """
+    return [column.split()[0] for column in re.split(r",(?![^(]*\))", SCHEMA[table])]
+
+
+def table_sizes(sales_orders):
+    """
+    Summary : number of rows generated for every table.
+
+    Returns:
+        dict {"sales_order": 10000, "purchase_order": 5000, ...}
+    """
+    purchase_orders = sales_orders // 2
+    return {"address": 30, "counterparty": 20, "currency": len(CURRENCIES), "department": len(DEPARTMENTS),
+            "design": max(100, sales_orders // 100), "payment_type": len(PAYMENT_TYPES), "staff": 20,
+            "sales_order": sales_orders, "purchase_order": purchase_orders,
+            "transaction": sales_orders + purchase_orders, "payment": sales_orders + purchase_orders}
+
+
+def timestamps(count):
+    """
+    Summary : `count` increasing created_at/last_updated values spread
+    from START to END, so later primary keys are updated later.
+    """
+    step = (END - START) / max(count, 1)
+    for index in range(count):
+        yield START + step * index
+
+
+def generate_table(table, sizes, rng):
+    """
+    Summary:
+    Yield the rows of one table as tuples in SCHEMA column order. Foreign
+    keys are drawn from 1..sizes[parent], so they always exist.
+    """
+    count = sizes[table]
+    for row_id, updated in enumerate(timestamps(count), start=1):
+        if table == "address":
+            yield (row_id, f"{rng.randint(1, 9999)} {rng.choice(LAST_NAMES)} Via",
+                   rng.choice([None, "Sunny Cove"]), rng.choice(DISTRICTS), rng.choice(CITIES),
+                   f"{rng.randint(10000, 99999)}", rng.choice(COUNTRIES),
+                   f"{rng.randint(1000, 9999)} {rng.randint(100000, 999999)}", updated, updated)
+        elif table == "counterparty":
+            yield (row_id, f"{rng.choice(COMPANY_WORDS)} and {rng.choice(COMPANY_WORDS)}",
+                   rng.randint(1, sizes["address"]), f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                   f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}", updated, updated)
+        elif table == "currency":
+            yield (row_id, CURRENCIES[row_id - 1], updated, updated)
+        elif table == "department":
+            name, location = DEPARTMENTS[row_id - 1]
+            yield (row_id, name, location, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}", updated, updated)
+        elif table == "design":
+            name = rng.choice(DESIGN_NAMES)
+            yield (row_id, updated, name, rng.choice(FILE_LOCATIONS),
+                   f"{name.lower()}-{updated:%Y%m%d}-{rng.randrange(16 ** 4):04x}.json", updated)
+        elif table == "payment_type":
+            yield (row_id, PAYMENT_TYPES[row_id - 1], updated, updated)
+        elif table == "staff":
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            yield (row_id, first_name, last_name, rng.randint(1, sizes["department"]),
+                   f"{first_name.lower()}.{last_name.lower()}@terrifictotes.com", updated, updated)
+        elif table == "sales_order":
+            yield (row_id, updated, updated, rng.randint(1, sizes["design"]), rng.randint(1, sizes["staff"]),
+                   rng.randint(1, sizes["counterparty"]), rng.randint(1000, 100000),
+                   f"{rng.uniform(2, 4):.2f}", rng.randint(1, sizes["currency"]),
+                   f"{updated + timedelta(days=rng.randint(1, 7)):%Y-%m-%d}",
+                   f"{updated + timedelta(days=rng.randint(1, 7)):%Y-%m-%d}", rng.randint(1, sizes["address"]))
+        elif table == "purchase_order":
+            yield (row_id, updated, updated, rng.randint(1, sizes["staff"]), rng.randint(1, sizes["counterparty"]),
+                   "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(7)),
+                   rng.randint(1, 1000), f"{rng.uniform(1, 1000):.2f}", rng.randint(1, sizes["currency"]),
+                   f"{updated + timedelta(days=rng.randint(1, 7)):%Y-%m-%d}",
+                   f"{updated + timedelta(days=rng.randint(1, 7)):%Y-%m-%d}", rng.randint(1, sizes["address"]))
+        elif table == "transaction":
+            # the first sales_order transactions, then one per purchase order
+            if row_id <= sizes["sales_order"]:
+                yield (row_id, "SALE", row_id, None, updated, updated)
+            else:
+                yield (row_id, "PURCHASE", None, row_id - sizes["sales_order"], updated, updated)
+        elif table == "payment":
+            is_sale = row_id <= sizes["sales_order"]
+            payment_type_id = rng.choice([1, 2] if is_sale else [3, 4])
+            yield (row_id, updated, updated, row_id, rng.randint(1, sizes["counterparty"]),
+                   f"{rng.uniform(1, 1000000):.2f}", rng.randint(1, sizes["currency"]), payment_type_id,
+                   rng.random() < 0.5, f"{updated + timedelta(days=rng.randint(0, 3)):%Y-%m-%d}",
+                   rng.randint(10000000, 99999999), rng.randint(10000000, 99999999))
+
+
+def csv_batches(rows, batch_rows=BATCH_ROWS):
+    """
+    Summary : turn rows into csv text, batch_rows at a time (COPY reads an
+    iterable of str, so the table never has to fit in memory).
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for index, row in enumerate(rows, start=1):
+        writer.writerow(["" if value is None else value for value in row])
+        if index % batch_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def load_totesys(db_connection, sales_orders, seed=0, replace=False):
+    """
+    Summary:
+    Create the 11 totesys tables and COPY the generated rows into them.
+    Existing tables are only dropped with replace=True.
+
+    Returns:
+        dict {"sales_order": (rows, seconds), ...}
+    """
+    rng = random.Random(seed)
+    sizes = table_sizes(sales_orders)
+    report = {}
+    for table in TABLE_ORDER:
+        if replace:
+            db_connection.run(f'DROP TABLE IF EXISTS "{table}"')
+        db_connection.run(f'CREATE TABLE "{table}" ({SCHEMA[table]})')
+        start = time.perf_counter()
+        db_connection.run(f'COPY "{table}" FROM STDIN WITH (FORMAT csv)',
+                          stream=csv_batches(generate_table(table, sizes, rng)))
+        report[table] = (sizes[table], time.perf_counter() - start)
+    db_connection.run("ANALYZE")
+    return report
+
+
+def write_totesys_csv(directory, sales_orders, seed=0):
+    """
+    Summary : write the generated tables as <directory>/<table>.csv with a header.
+
+    Returns:
+        dict {"sales_order": (rows, seconds), ...}
+    """
+    rng = random.Random(seed)
+    sizes = table_sizes(sales_orders)
+    os.makedirs(directory, exist_ok=True)
+    report = {}
+    for table in TABLE_ORDER:
+        start = time.perf_counter()
+        with open(os.path.join(directory, f"{table}.csv"), "w") as file:
+            file.write(",".join(table_columns(table)) + "\n")
+            for batch in csv_batches(generate_table(table, sizes, rng)):
+                file.write(batch)
+        report[table] = (sizes[table], time.perf_counter() - start)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sales-orders", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replace", action="store_true", help="drop the totesys tables if they exist")
+    parser.add_argument("--out", help="write csv files to this directory instead of the database")
+    args = parser.parse_args()
+
+    if args.out:
+        report = write_totesys_csv(args.out, args.sales_orders, args.seed)
+    else:
+        db_connection = connect()
+        try:
+            report = load_totesys(db_connection, args.sales_orders, args.seed, args.replace)
+        finally:
+            db_connection.close()
+
+    print(f"{'table':<16}{'rows':>10}{'seconds':>10}{'rows/s':>12}")
+    for table, (rows, seconds) in report.items():
+        print(f"{table:<16}{rows:>10}{seconds:>10.3f}{rows / seconds if seconds else 0.0:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
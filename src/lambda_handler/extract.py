@@ -1,16 +1,122 @@
+import time
+MODULE_LOAD_START = time.perf_counter()
 import os
+import io
+import csv
 import logging
+import queue
+import resource
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pg8000.native import Connection, identifier, literal, DatabaseError, InterfaceError
 import boto3
 from botocore.exceptions import ClientError
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
+from decimal import Decimal
 import json
-import pandas as pd
-import awswrangler as wr
+# pandas, awswrangler and pyarrow are imported by the functions that write
+# rows, so a run where no table changed never pays for loading them
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# tables without a usable last_updated column, always read in full
+FULL_SCAN_TABLES = ["department"]
+
+# compression codecs each ingestion format can be written with, the
+# first one is the default
+INGESTION_CODECS = {
+    "csv": ["none", "gzip", "zstd"],
+    "parquet": ["snappy", "none", "gzip", "zstd"],
+    "arrow": ["zstd", "none", "lz4"],
+}
+# extension added after .csv for a compressed csv, transform reads the codec from it
+CSV_CODEC_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# columns transform actually uses, per table. Extract only selects these
+# unless EXTRACT_FULL_FIDELITY is set; tables not listed (sales_order uses
+# every column, the rest are not transformed yet) are read with SELECT *.
+# Keep this in step with the builders in transform.py. Every table here has
+# a transform snapshot (SNAPSHOT_TABLES) merged by last_updated, so it is
+# always selected.
+COLUMN_REGISTRY = {
+    # dim_currency
+    "currency": ["currency_id", "currency_code", "last_updated"],
+    # dim_location and dim_counterparty
+    "address": ["address_id", "address_line_1", "address_line_2", "district",
+                "city", "postal_code", "country", "phone", "last_updated"],
+    # dim_design
+    "design": ["design_id", "design_name", "file_location", "file_name", "last_updated"],
+    # dim_staff
+    "staff": ["staff_id", "first_name", "last_name", "department_id", "email_address", "last_updated"],
+    "department": ["department_id", "department_name", "location", "last_updated"],
+    # dim_counterparty
+    "counterparty": ["counterparty_id", "counterparty_legal_name", "legal_address_id", "last_updated"],
+}
+
+# type of every column of the 11 totesys tables, the one schema extract
+# writes with and transform reads with: int, str, bool, timestamp or
+# decimal(precision,scale). check_schema_drift compares it with the
+# database. transform.py keeps an identical copy, change both together.
+SOURCE_SCHEMA = {
+    "address": {"address_id": "int", "address_line_1": "str", "address_line_2": "str", "district": "str",
+                "city": "str", "postal_code": "str", "country": "str", "phone": "str",
+                "created_at": "timestamp", "last_updated": "timestamp"},
+    "counterparty": {"counterparty_id": "int", "counterparty_legal_name": "str", "legal_address_id": "int",
+                     "commercial_contact": "str", "delivery_contact": "str",
+                     "created_at": "timestamp", "last_updated": "timestamp"},
+    "currency": {"currency_id": "int", "currency_code": "str", "created_at": "timestamp", "last_updated": "timestamp"},
+    "department": {"department_id": "int", "department_name": "str", "location": "str", "manager": "str",
+                   "created_at": "timestamp", "last_updated": "timestamp"},
+    "design": {"design_id": "int", "created_at": "timestamp", "design_name": "str", "file_location": "str",
+               "file_name": "str", "last_updated": "timestamp"},
+    "payment_type": {"payment_type_id": "int", "payment_type_name": "str",
+                     "created_at": "timestamp", "last_updated": "timestamp"},
+    "staff": {"staff_id": "int", "first_name": "str", "last_name": "str", "department_id": "int",
+              "email_address": "str", "created_at": "timestamp", "last_updated": "timestamp"},
+    "sales_order": {"sales_order_id": "int", "created_at": "timestamp", "last_updated": "timestamp",
+                    "design_id": "int", "staff_id": "int", "counterparty_id": "int", "units_sold": "int",
+                    "unit_price": "decimal(10,2)", "currency_id": "int", "agreed_delivery_date": "str",
+                    "agreed_payment_date": "str", "agreed_delivery_location_id": "int"},
+    "purchase_order": {"purchase_order_id": "int", "created_at": "timestamp", "last_updated": "timestamp",
+                       "staff_id": "int", "counterparty_id": "int", "item_code": "str", "item_quantity": "int",
+                       "item_unit_price": "decimal(10,2)", "currency_id": "int", "agreed_delivery_date": "str",
+                       "agreed_payment_date": "str", "agreed_delivery_location_id": "int"},
+    "transaction": {"transaction_id": "int", "transaction_type": "str", "sales_order_id": "int",
+                    "purchase_order_id": "int", "created_at": "timestamp", "last_updated": "timestamp"},
+    "payment": {"payment_id": "int", "created_at": "timestamp", "last_updated": "timestamp",
+                "transaction_id": "int", "counterparty_id": "int", "payment_amount": "decimal(10,2)",
+                "currency_id": "int", "payment_type_id": "int", "paid": "bool", "payment_date": "str",
+                "company_ac_number": "int", "counterparty_ac_number": "int"},
+}
+# postgres data_type of every SOURCE_SCHEMA type, for check_schema_drift
+SCHEMA_DATA_TYPES = {"int": "integer", "str": "character varying", "bool": "boolean",
+                     "timestamp": "timestamp without time zone", "decimal": "numeric"}
+# seconds spent importing this module, reported on a cold start
+IMPORT_SECONDS = time.perf_counter() - MODULE_LOAD_START
+# True until the first invocation in this container
+COLD_START = True
+# boto3 clients are created once per container and reused while it stays warm
+AWS_CLIENTS = {}
+# the db secret and schema drift check kept across warm invocations, {key: (value, expires_at)}
+WARM_CACHE = {}
+# the totesys connection kept open across warm invocations
+DB_CONNECTIONS = {}
+# postgres error codes for a rejected password / role
+AUTHENTICATION_ERROR_CODES = ["28P01", "28000"]
+# S3 calls and bytes of this process, and of every thread, counted by install_s3_meter
+S3_METER = {"s3_requests": 0, "bytes_read": 0, "bytes_written": 0}
+S3_METER_LOCK = threading.Lock()
+S3_THREAD_METER = threading.local()
+# CloudWatch unit of every metric emit_metrics writes
+METRIC_UNITS = {"seconds": "Seconds", "rows_in": "Count", "rows_out": "Count", "rows_per_second": "Count/Second",
+                "bytes_read": "Bytes", "bytes_written": "Bytes", "s3_requests": "Count",
+                "peak_memory_mb": "Megabytes"}
+# tables a backfill loads when the event does not list them
+BACKFILL_TABLES = ["transaction", "sales_order", "payment", "counterparty", "currency", "department",
+                   "design", "staff", "address", "purchase_order", "payment_type"]
+
 
 ##################################################################################
 # Lambda Handler
@@ -51,7 +157,8 @@ def lambda_handler(event, context):
         - test that the file exists
         - test that the content is valid
     
-    - update last checked variable ## figure out where to do this step so we have access to the latest files for transform step.
+    - update last checked variable ## figure out where to do this step so we have access to the latest files
+      for transform step.
         test:
         - test to see if the function updates the 
         variable in the parameter store as expected
@@ -76,21 +183,28 @@ def lambda_handler(event, context):
             - maybe a success message?
             {"timestamp":"2020....", "message":"extract successful"}
     """
-    ssm_client=boto3.client("ssm")
-    sm_client=boto3.client("secretsmanager")
+    global COLD_START
+    cold_start, COLD_START = COLD_START, False
+    timings = {}
+    metrics = new_run_metrics()
+    install_s3_meter()
+
+    with stage_timer(timings, "clients", metrics):
+        ssm_client = get_aws_client("ssm")
+        sm_client = get_aws_client("secretsmanager")
+        s3_client = get_aws_client("s3")
     logger.info("created s3 clients")
+
+    if event and "backfill" in event:
+        # a step of the backfill state machine, see run_backfill
+        return run_backfill(event["backfill"], ssm_client, sm_client, s3_client)
     
-    last_checked = get_last_checked(ssm_client)["last_checked"]
+    with stage_timer(timings, "last_checked", metrics):
+        # read on every run, backfills and other containers write it too
+        last_checked = get_last_checked(ssm_client)["last_checked"]
     logger.info(f"obtained last checked: {last_checked}")
     
     
-    db_credentials = get_db_credentials(sm_client)
-    logger.info(f"obtained last checked: {db_credentials}")
-    
-    
-    db_conn = create_db_connection(db_credentials)
-    logger.info(f"created db connection")
-    
     tables_to_import = ["transaction", "sales_order", 
                         "payment","counterparty", 
                         "currency", "department", 
@@ -102,23 +216,344 @@ def lambda_handler(event, context):
     ingestion_bucket = get_bucket_name()["ingestion_bucket"]
     logger.info(f"obtained ingestion bucket name: {ingestion_bucket}")
 
-    
-    for table in tables_to_import:
-        column_names, new_rows = extract_new_rows(table, last_checked, db_conn)
-        logger.info(f"obtained new rows for {table}")
-        if new_rows:
-            convert_new_rows_to_df_and_upload_to_s3_as_csv(ingestion_bucket, table, column_names, new_rows,last_checked)
-            logger.info(f"uploaded csv file for {table} to s3")
-    db_conn.close()
-    logger.info(f"db connection closed")
-    
-    new_time = update_last_checked(ssm_client)
+    extract_config = get_extract_config()
+    logger.info(f"obtained extract config: {extract_config}")
+
+    if extract_config["engine"] == "cdc":
+        # changes come from the replication slot, no snapshot, probe or watermarks
+        return run_cdc_extract(tables_to_import, last_checked, ssm_client, sm_client, s3_client, ingestion_bucket,
+                               extract_config, cold_start, timings, metrics)
+
+    with stage_timer(timings, "connection", metrics):
+        db_credentials, db_conn = get_db_connection(sm_client)
+        logger.info("obtained db connection")
+        if extract_config["schema_drift"] != "off":
+            enforce_schema(get_cached("schema_drift", lambda: check_schema_drift(db_conn, tables_to_import)),
+                           extract_config["schema_drift"])
+        # every table (and every pool connection) reads from this one snapshot
+        snapshot = open_export_snapshot(db_conn)
+    logger.info(f"exported snapshot {snapshot['snapshot_id']} taken at {snapshot['snapshot_time']}")
+
+    with stage_timer(timings, "probe", metrics):
+        # one read for the watermarks and fingerprints of every table
+        extract_state = get_extract_state(ssm_client)
+        watermarks = extract_state.get("watermarks", {})
+        table_changes = probe_table_changes(tables_to_import, db_conn)
+        changed_tables = select_changed_tables(table_changes, last_checked, extract_state.get("fingerprints", {}),
+                                               watermarks, extract_state.get("row_counts", {}))
+    logger.info(f"tables changed since their watermark: {changed_tables}")
+
+    with stage_timer(timings, "extract", metrics) as extract_stage:
+        tasks = plan_extract_tasks(changed_tables, last_checked, db_conn, extract_config, watermarks)
+        table_changes = limit_table_changes(table_changes, tasks)
+        logger.info(f"planned {len(tasks)} extract tasks")
+
+        if extract_config["pool_size"] > 1:
+            task_results = extract_tables_concurrently(tasks, last_checked, db_credentials,
+                                                       s3_client, ingestion_bucket, extract_config,
+                                                       snapshot_id=snapshot["snapshot_id"])
+        else:
+            task_results = [extract_task_to_s3(task, last_checked, db_conn, s3_client, ingestion_bucket,
+                                               extract_config)
+                            for task in tasks]
+        results = combine_task_results(task_results)
+        for result in results:
+            metrics["tables"][result["table"]] = result["metrics"]
+        extract_stage["rows_in"] = extract_stage["rows_out"] = sum(result["row_count"] for result in results)
+        db_conn.run("COMMIT")
+        if get_cache_ttl() <= 0:
+            db_conn.close()
+    logger.info("snapshot transaction closed")
+    logger.info(f"extracted {sum(result['row_count'] for result in results)} new rows")
+
+    # a failed table keeps its old watermark (and fingerprint) and is retried next run
+    failed_tables = [result["table"] for result in results if "error" in result]
+    if failed_tables:
+        logger.error(f"extract failed for {failed_tables}, they will be retried on the next run")
+
+    with stage_timer(timings, "state", metrics):
+        # one manifest per batch so transform never has to probe the bucket
+        previous_manifest = get_manifest(s3_client, ingestion_bucket, extract_state.get("manifest_key"))
+        manifest = build_batch_manifest(last_checked, extract_config["format"], results, table_changes,
+                                        previous_manifest)
+        manifest_key = upload_manifest(s3_client, ingestion_bucket, manifest)
+        logger.info(f"batch manifest written to s3://{ingestion_bucket}/{manifest_key}")
+
+        extract_state = advance_extract_state(extract_state, table_changes, changed_tables, failed_tables,
+                                              last_checked)
+        extract_state["manifest_key"] = manifest_key
+        update_extract_state(ssm_client, extract_state)
+        new_time = update_last_checked(ssm_client, snapshot["snapshot_time"])
     logger.info(f"last checked time updated:  {new_time}")
-    return {"message":"success", "timestamp_to_transform": last_checked}
+
+    startup = startup_report(cold_start, timings)
+    logger.info(f"startup report: {startup}")
+    emit_metrics("extract", metrics)
+    return {"message":"success", "timestamp_to_transform": last_checked,
+            "ingestion_format": extract_config["format"], "changed_tables": changed_tables,
+            "failed_tables": failed_tables, "manifest_key": manifest_key, "startup": startup,
+            "metrics": metrics}
 
 ##################################################################################
 # Useful functions for the Lambda Handler
 ##################################################################################
+
+def get_cache_ttl():
+    """
+    Summary:
+    Seconds the db secret and the schema drift check are kept in the warm
+    cache, from the CACHE_TTL_SECONDS environment variable (default 3600). 0 turns the
+    warm cache off, including the kept database connection.
+    """
+    return int(os.environ.get("CACHE_TTL_SECONDS", "3600"))
+
+
+def cache_get(key):
+    """
+    Summary:
+    Value stored under key in the warm cache, or None if it is missing or
+    its TTL has run out.
+    """
+    entry = WARM_CACHE.get(key)
+    if entry is None:
+        return None
+    value, expires_at = entry
+    if time.monotonic() >= expires_at:
+        del WARM_CACHE[key]
+        return None
+    return value
+
+
+def cache_put(key, value):
+    """
+    Summary:
+    Keep value in the warm cache for get_cache_ttl() seconds.
+
+    Returns:
+        the value, so a fetch can be cached in one expression
+    """
+    ttl = get_cache_ttl()
+    if ttl > 0:
+        WARM_CACHE[key] = (value, time.monotonic() + ttl)
+    return value
+
+
+def cache_invalidate(key):
+    """
+    Summary:
+    Drop key from the warm cache so the next get_cached fetches it again.
+    """
+    WARM_CACHE.pop(key, None)
+
+
+def get_cached(key, fetch):
+    """
+    Summary:
+    Return the cached value of key, calling fetch() and caching its result
+    on a miss. Used for values only this container's config changes, like
+    the db secret, so a warm container skips those round trips. The
+    last_checked and extract_state parameters are not cached: backfills
+    and overlapping runs in other containers write them too.
+
+    Args:
+        key (str): cache key, e.g. "db_credentials"
+        fetch (callable): reads the value from AWS
+
+    Returns:
+        the cached or freshly fetched value
+    """
+    value = cache_get(key)
+    if value is None:
+        value = cache_put(key, fetch())
+    return value
+
+
+def get_aws_client(service_name):
+    """
+    Summary:
+    Return the boto3 client for a service, creating it on the first call
+    in this container only. Creating a client loads the service model and
+    builds a session, which is a noticeable part of a cold start.
+
+    Args:
+        service_name (str): e.g. "s3", "ssm", "secretsmanager"
+
+    Returns:
+        boto3 client
+    """
+    if service_name not in AWS_CLIENTS:
+        AWS_CLIENTS[service_name] = boto3.client(service_name)
+    return AWS_CLIENTS[service_name]
+
+
+@contextmanager
+def stage_timer(timings, stage, metrics=None):
+    """
+    Summary:
+    Time the block it wraps and store the seconds under timings[stage].
+    With the run's metrics (see new_run_metrics) the full record of the
+    stage from measure() is kept under metrics["stages"][stage]; the block
+    gets the record to fill in its rows_in and rows_out.
+    """
+    record = {}
+    try:
+        with measure() as record:
+            yield record
+    finally:
+        # measure() fills in the seconds when its block exits, one clock for both
+        timings[stage] = record.get("seconds")
+        if metrics is not None:
+            metrics["stages"][stage] = record
+
+
+def new_run_metrics():
+    """
+    Summary : the metrics of one invocation, one record per stage and per table.
+    """
+    return {"stages": {}, "tables": {}}
+
+
+@contextmanager
+def measure(per_thread=False):
+    """
+    Summary:
+    Measure the block it wraps. The record yielded is filled in when the
+    block ends with its duration, the S3 requests and bytes read and
+    written (see install_s3_meter) and the peak memory of the process so
+    far. per_thread only counts the S3 calls made by this thread, for work
+    running next to other threads (one table of a concurrent extract).
+
+    Yields:
+        dict {"rows_in": 0, "rows_out": 0} the block can update, then
+        {"rows_in": 10, "rows_out": 10, "seconds": 0.52, "s3_requests": 3,
+         "bytes_read": 0, "bytes_written": 2048, "peak_memory_mb": 210.5}
+    """
+    start = time.perf_counter()
+    s3_start = read_s3_meter(per_thread)
+    record = {"rows_in": 0, "rows_out": 0}
+    try:
+        yield record
+    finally:
+        s3_end = read_s3_meter(per_thread)
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        for name, value in s3_end.items():
+            record[name] = value - s3_start[name]
+        record["peak_memory_mb"] = peak_memory_mb()
+
+
+def peak_memory_mb():
+    """
+    Summary : the most memory (RSS) this process has used, in MiB.
+    """
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def install_s3_meter():
+    """
+    Summary:
+    Count every S3 call and the bytes of every GetObject, PutObject and
+    UploadPart made through the default boto3 session, which is where
+    boto3.client and awswrangler get their clients. The hooks are copied
+    into clients when they are created, so this runs before any client
+    is made, once per session.
+    """
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    session = boto3.DEFAULT_SESSION
+    if getattr(session, "s3_meter_installed", False):
+        return
+    session.events.register("before-call.s3", count_s3_request)
+    session.events.register("after-call.s3.GetObject", count_s3_bytes_read)
+    session.events.register("before-parameter-build.s3.PutObject", count_s3_bytes_written)
+    session.events.register("before-parameter-build.s3.UploadPart", count_s3_bytes_written)
+    session.s3_meter_installed = True
+
+
+def add_to_s3_meter(name, amount):
+    """
+    Summary : add to the process wide and to this thread's S3 counters.
+    """
+    with S3_METER_LOCK:
+        S3_METER[name] += amount
+    setattr(S3_THREAD_METER, name, getattr(S3_THREAD_METER, name, 0) + amount)
+
+
+def read_s3_meter(per_thread=False):
+    """
+    Summary : current S3 counters of the process, or of this thread.
+
+    Returns:
+        dict {"s3_requests": 12, "bytes_read": 0, "bytes_written": 4096}
+    """
+    if per_thread:
+        return {name: getattr(S3_THREAD_METER, name, 0) for name in S3_METER}
+    with S3_METER_LOCK:
+        return dict(S3_METER)
+
+
+def count_s3_request(**kwargs):
+    add_to_s3_meter("s3_requests", 1)
+
+
+def count_s3_bytes_read(parsed=None, **kwargs):
+    add_to_s3_meter("bytes_read", (parsed or {}).get("ContentLength") or 0)
+
+
+def count_s3_bytes_written(params=None, **kwargs):
+    body = (params or {}).get("Body")
+    if isinstance(body, (bytes, bytearray, memoryview, str)):
+        size = len(body)
+    else:
+        try:
+            position = body.tell()
+            size = body.seek(0, 2) - position
+            body.seek(position)
+        except Exception:
+            size = 0
+    add_to_s3_meter("bytes_written", size)
+
+
+def emit_metrics(function_name, metrics):
+    """
+    Summary:
+    Print every stage and table record as a CloudWatch Embedded Metric
+    Format line; CloudWatch Logs turns them into metrics in the
+    METRICS_NAMESPACE namespace (default funland-etl), with the dimensions
+    Function + Stage or Function + Table, to alarm on throughput.
+
+    Args:
+        function_name (str): "extract", "transform" or "load"
+        metrics (dict): from new_run_metrics
+    """
+    namespace = os.environ.get("METRICS_NAMESPACE", "funland-etl")
+    timestamp = int(time.time() * 1000)
+    for dimension, records in [("Stage", metrics["stages"]), ("Table", metrics["tables"])]:
+        for name, record in records.items():
+            values = {metric: record.get(metric, 0) for metric in METRIC_UNITS if metric != "rows_per_second"}
+            values["rows_per_second"] = round(values["rows_out"] / values["seconds"], 1) if values["seconds"] else 0.0
+            print(json.dumps({
+                "_aws": {"Timestamp": timestamp,
+                         "CloudWatchMetrics": [{"Namespace": namespace, "Dimensions": [["Function", dimension]],
+                                                "Metrics": [{"Name": metric, "Unit": unit}
+                                                            for metric, unit in METRIC_UNITS.items()]}]},
+                "Function": function_name, dimension: name, **values}))
+
+
+def startup_report(cold_start, timings):
+    """
+    Summary:
+    Put together what the handler reports about its start up, so cold and
+    warm runs can be compared: whether this was the first invocation in
+    the container, how long the module imports took (only paid on a cold
+    start) and the seconds spent in every stage of the run.
+
+    Returns:
+        dict {"cold_start": True, "import_seconds": 0.41, "stage_seconds": {"clients": 0.09, ...}}
+    """
+    return {"cold_start": cold_start,
+            "import_seconds": round(IMPORT_SECONDS, 4) if cold_start else 0.0,
+            "stage_seconds": timings}
+
     
 def get_last_checked(ssm_client): # test and code complete
     """
@@ -148,6 +583,50 @@ def get_last_checked(ssm_client): # test and code complete
     
     
    
+def get_extract_state(ssm_client):
+    """
+    Summary:
+    Read the extract_state parameter, a JSON object holding what the
+    previous runs need to pass on to the next one: the high-water mark and
+    row count of every table and the content fingerprints of the full
+    scan tables.
+    All tables live in this one parameter, so one call reads them all.
+
+    Returns:
+        dict, empty on the very first run
+        {"watermarks": {"sales_order": "2025-06-10 09:15:00.000000"},
+         "fingerprints": {"department": "9e107d9d372bb6826bd81d3542a419d6"},
+         "row_counts": {"sales_order": 11000}}
+    """
+    try:
+        response = ssm_client.get_parameter(Name='extract_state')
+        return json.loads(response['Parameter']['Value'])
+    except ssm_client.exceptions.ParameterNotFound:
+        logger.info("get_extract_state: no extract_state yet, starting with an empty state")
+        return {}
+    except ClientError as error:
+        logger.error(f"get_extract_state: There has been an error: {str(error)}")
+        raise error
+
+
+def update_extract_state(ssm_client, extract_state):
+    """
+    Summary:
+    Overwrite the extract_state parameter with the given dictionary.
+    """
+    try:
+        ssm_client.put_parameter(
+            Name = "extract_state",
+            Value = json.dumps(extract_state),
+            Description='State carried between extract runs',
+            Type="String",
+            Overwrite=True
+        )
+    except ClientError as error:
+        logger.error(f"update_extract_state: There has been an error: {str(error)}")
+        raise error
+
+
 def get_db_credentials(sm_client): # test and code complete
     """_summary_
     This functions should return a dictionary of all 
@@ -196,7 +675,89 @@ def create_db_connection(db_credentials): #test and code complete
         raise error
     
 
-def extract_new_rows(table_name, last_checked, db_connection): 
+def is_authentication_error(error):
+    """
+    Summary:
+    True if a pg8000 DatabaseError says the server rejected the
+    credentials (e.g. the password was rotated). Its first argument is the
+    dictionary of fields from the server's error response.
+    """
+    details = error.args[0] if error.args else None
+    return isinstance(details, dict) and details.get("C") in AUTHENTICATION_ERROR_CODES
+
+
+def is_db_connection_alive(db_connection):
+    """
+    Summary:
+    Cheap liveness check for a kept connection: one ROLLBACK round trip.
+    It also ends any transaction a failed run left open, so the next
+    snapshot starts clean.
+
+    Returns:
+        Boolean
+    """
+    try:
+        db_connection.run("ROLLBACK")
+        return True
+    except Exception as error:
+        logger.info(f"is_db_connection_alive: kept db connection is no longer usable: {str(error)}")
+        return False
+
+
+def get_db_connection(sm_client):
+    """
+    Summary:
+    Return the database credentials and a connection to totesys, reusing
+    what a warm container already has. A kept connection is checked with
+    is_db_connection_alive and quietly reopened if it is dead. If the
+    server rejects the cached credentials they are dropped, fetched again
+    from Secrets Manager and the connection retried once.
+
+    Args:
+        sm_client: boto3 secretsmanager client
+
+    Returns:
+        tuple of (db_credentials, db_connection)
+    """
+    db_credentials = get_cached("db_credentials", lambda: get_db_credentials(sm_client))
+    db_connection = DB_CONNECTIONS.get("totesys")
+    if db_connection is not None:
+        if is_db_connection_alive(db_connection):
+            logger.info("get_db_connection: reusing the kept db connection")
+            return db_credentials, db_connection
+        close_db_connection()
+
+    try:
+        db_connection = create_db_connection(db_credentials)
+    except DatabaseError as db_error:
+        if not is_authentication_error(db_error):
+            raise db_error
+        logger.warning("get_db_connection: cached db credentials were rejected, fetching them again")
+        cache_invalidate("db_credentials")
+        db_credentials = get_cached("db_credentials", lambda: get_db_credentials(sm_client))
+        db_connection = create_db_connection(db_credentials)
+
+    if get_cache_ttl() > 0:
+        DB_CONNECTIONS["totesys"] = db_connection
+    return db_credentials, db_connection
+
+
+def close_db_connection():
+    """
+    Summary:
+    Close and forget the kept database connection, ignoring errors from a
+    connection that is already dead.
+    """
+    db_connection = DB_CONNECTIONS.pop("totesys", None)
+    if db_connection is None:
+        return
+    try:
+        db_connection.close()
+    except Exception as error:
+        logger.info(f"close_db_connection: {str(error)}")
+
+
+def extract_new_rows(table_name, last_checked, db_connection, key_range=None, select_columns=None, until=None): 
     """ 
     Summary :
         Use connection object to query for rows in a given table where 
@@ -214,6 +775,15 @@ def extract_new_rows(table_name, last_checked, db_connection):
         
         db_connection (object):
         a connection object to the totesys database
+
+        key_range (tuple):
+        optional (first, last) primary key values to limit the query to
+
+        select_columns (list):
+        optional columns to read instead of all of them
+
+        until (str):
+        optional timestamp, rows updated after it are left out
     
     
     Returns:
@@ -223,17 +793,8 @@ def extract_new_rows(table_name, last_checked, db_connection):
         returns a tuple of (column_names, new_rows):
     """
     
-    last_checked_dt_obj = datetime.strptime(last_checked, "%Y-%m-%d %H:%M:%S.%f")
+    query = build_extract_query(table_name, last_checked, key_range, select_columns, until)
 
-    if table_name in ["department"]:
-        query = f"""
-    SELECT * FROM {identifier(table_name)}
-    """
-    else:
-        query = f"""
-    SELECT * FROM {identifier(table_name)} WHERE last_updated > {literal(last_checked_dt_obj)}
-    """
-           
     try:
         new_rows = db_connection.run(query)
         column_names = [column['name'] for column in db_connection.columns]
@@ -246,78 +807,1999 @@ def extract_new_rows(table_name, last_checked, db_connection):
     
 
 
-def convert_new_rows_to_df_and_upload_to_s3_as_csv(ingestion_bucket, table, column_names, new_rows,last_checked):
+def build_extract_query(table_name, last_checked, key_range=None, select_columns=None, until=None):
     """
     Summary:
-    This function will take the column names and new row data, 
-    and create a pandas dataframe from this.
-    From here, this dataframe is uploaded directly to given s3 bucket as
-    a csv file.
-    
+    Build the SELECT used to pull new rows for a table. The tables in
+    FULL_SCAN_TABLES (department) are always read in full, every other table only returns rows
+    updated after last_checked. With a key_range the query is further
+    limited to primary keys between the two (inclusive) values, and with
+    select_columns only those columns are read (see COLUMN_REGISTRY).
+    With until, rows updated after that time are left out as well (the
+    backfill reads every chunk up to the same point in time).
 
     Args:
-        ingestion_bucket (str): name of the ingestion bucket
-        table (str): name of the table with the new data
-        column_names (list): list of column names
-        new_rows (list): nested list of new row values
-        
-        
-    returns:
-        sucess message through a log
+        table_name (str): name of the table to query for
+        last_checked (str): timestamp string stored in parameter store
+        key_range (tuple): optional (first, last) primary key values
+        select_columns (list): optional columns to select instead of *
+        until (str): optional timestamp string, upper bound for last_updated
+
+    Returns:
+        str: the SQL query
     """
-    
-    #convert new rows to a dataframe
-    df = pd.DataFrame(new_rows,columns=column_names)
-    logger.info(f"dataframe for {table} has been created")
-    #convert dataframe to a csv file
-    try:
-        wr.s3.to_csv(df, f"s3://{ingestion_bucket}/{table}/{last_checked}.csv")
-        logger.info(f"{table} has been saved to s3://{ingestion_bucket}/{table}/{last_checked}.csv")
-    except Exception as error:
-        logger.error(f"convert_new_rows_to_df_and_upload_to_s3_as_csv: There has been a dataframe error: {str(error)}")
-        raise error
+    last_checked_dt_obj = datetime.strptime(last_checked, "%Y-%m-%d %H:%M:%S.%f")
 
-    
-def update_last_checked(ssm_client):
+    conditions = []
+    if table_name not in FULL_SCAN_TABLES:
+        conditions.append(f"last_updated > {literal(last_checked_dt_obj)}")
+        if until is not None:
+            until_dt_obj = datetime.strptime(until, "%Y-%m-%d %H:%M:%S.%f")
+            conditions.append(f"last_updated <= {literal(until_dt_obj)}")
+    if key_range is not None:
+        first_key, last_key = key_range
+        conditions.append(f"{identifier(get_primary_key(table_name))} BETWEEN {int(first_key)} AND {int(last_key)}")
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    projection = ", ".join(identifier(column) for column in select_columns) if select_columns else "*"
+    return f"""
+    SELECT {projection} FROM {identifier(table_name)}{where}
     """
-    Summary:
-    Initialise ssm_client using boto3.client("ssm")
-    Use AWS parameter store to access/update the 'last_checked' parameter
-    Use .put_parameter method to update (using Overwrite=TRUE) 
-    the last_checked time each time extract_lambda_handler is run.
-            
+
+
+def probe_table_changes(tables, db_connection):
     """
+    Summary:
+    Ask the database in one round trip which tables have changed.
+    For every table the probe returns max(last_updated) and the row count,
+    a count lower than the stored one shows deleted rows that do not move
+    max(last_updated). Tables in FULL_SCAN_TABLES also get an md5
+    fingerprint of their whole content, since their last_updated cannot
+    be trusted.
+
+    Args:
+        tables (list): names of the tables to probe
+        db_connection (object): a connection object to the totesys database
 
-    now=str(datetime.now())
+    Returns:
+        dict {"sales_order": {"max_last_updated": "2025-06-10 09:15:00.000000",
+                              "row_count": 11000, "fingerprint": None}, ...}
+    """
+    selects = []
+    for table in tables:
+        if table in FULL_SCAN_TABLES:
+            fingerprint = f"md5(string_agg(t::text, ',' ORDER BY t.{identifier(get_primary_key(table))}))"
+        else:
+            fingerprint = "NULL::text"
+        selects.append(f"SELECT {literal(table)}, max(t.last_updated), count(*), {fingerprint} "
+                       f"FROM {identifier(table)} AS t")
+    query = "\nUNION ALL\n".join(selects)
 
     try:
-        ssm_client.put_parameter(
-            Name = "last_checked",
-            Value = now,
-            Description='Timestamp of each Lambda execution',
-            Type="String",
-            Overwrite=True
-        )
-        return now
-    except Exception as e:
-        logger.error(f"There has been an error: {str(e)}")
-        raise e
-    
+        rows = db_connection.run(query)
+    except DatabaseError as db_error:
+        logger.error(f"probe_table_changes: There has been a database error: {str(db_error)}")
+        raise db_error
 
+    table_changes = {}
+    for table, max_last_updated, row_count, fingerprint in rows:
+        table_changes[table] = {
+            "max_last_updated": max_last_updated.strftime("%Y-%m-%d %H:%M:%S.%f") if max_last_updated else None,
+            "row_count": row_count,
+            "fingerprint": fingerprint,
+        }
+    return table_changes
 
-    
-def get_bucket_name(): #completed with tests
+
+def select_changed_tables(table_changes, last_checked, fingerprints, watermarks=None, row_counts=None):
     """
-    Summary : this function should obtain the ingestion bucket name from the
-    environment variables and return it.
-    
-    
+    Summary:
+    Pick the tables worth extracting from the result of probe_table_changes.
+    A full scan table is extracted when its fingerprint differs from the
+    one stored after the last run; any other table when it has a row
+    updated after its own watermark (last_checked if it has none yet) or
+    its row count differs from the one stored after the last run.
+
+    Args:
+        table_changes (dict): output of probe_table_changes
+        last_checked (str): timestamp string stored in parameter store
+        fingerprints (dict): fingerprints stored by the previous run
+        watermarks (dict): per table high-water marks stored by the previous run
+        row_counts (dict): per table row counts stored by the previous run
+
     Returns:
-    dict {"ingestion_bucket" : "funland-ingestion-bucket-......."}
-    
+        list of table names, in probe order
     """
+    watermarks = watermarks or {}
+    row_counts = row_counts or {}
+    changed_tables = []
+    for table, change in table_changes.items():
+        if table in FULL_SCAN_TABLES:
+            if change["fingerprint"] != fingerprints.get(table):
+                changed_tables.append(table)
+            continue
+        updated = False
+        if change["max_last_updated"] is not None:
+            watermark = datetime.strptime(watermarks.get(table, last_checked), "%Y-%m-%d %H:%M:%S.%f")
+            max_last_updated = datetime.strptime(change["max_last_updated"], "%Y-%m-%d %H:%M:%S.%f")
+            updated = max_last_updated > watermark
+        recounted = table in row_counts and change["row_count"] != row_counts[table]
+        if recounted and not updated:
+            logger.warning(f"{table} went from {row_counts[table]} to {change['row_count']} rows with no row "
+                           f"updated, rows were deleted; only the cdc engine extracts deletes")
+        if updated or recounted:
+            changed_tables.append(table)
+    return changed_tables
 
-    bucket_name = os.environ.get("S3_INGESTION_BUCKET")
-    return {"ingestion_bucket":f'{bucket_name}'}
+
+def advance_extract_state(extract_state, table_changes, changed_tables, failed_tables, last_checked):
+    """
+    Summary:
+    Work out the extract_state to store after a run. Every table that was
+    extracted successfully moves its watermark up to the max(last_updated)
+    it was extracted at (the probe and the extract read the same
+    snapshot), and full scan tables store their new fingerprint. Every
+    other table stores its row count for the next probe to compare.
+    Failed tables keep their previous values so only they are read again.
+    A table without a watermark yet is given this run's last_checked, the
+    value it was read from, since last_checked itself moves on after the run.
+
+    Args:
+        extract_state (dict): output of get_extract_state
+        table_changes (dict): output of probe_table_changes
+        changed_tables (list): tables extracted in this run
+        failed_tables (list): tables whose extract failed
+        last_checked (str): timestamp string this run extracted from
+
+    Returns:
+        dict, the new extract_state
+    """
+    watermarks = dict(extract_state.get("watermarks", {}))
+    fingerprints = dict(extract_state.get("fingerprints", {}))
+    row_counts = dict(extract_state.get("row_counts", {}))
+    for table in changed_tables:
+        if table in failed_tables:
+            continue
+        change = table_changes[table]
+        if table in FULL_SCAN_TABLES:
+            fingerprints[table] = change["fingerprint"]
+        elif change["max_last_updated"] is not None:
+            watermarks[table] = change["max_last_updated"]
+    for table, change in table_changes.items():
+        if table not in FULL_SCAN_TABLES:
+            watermarks.setdefault(table, last_checked)
+            if table not in failed_tables:
+                row_counts[table] = change["row_count"]
+    return {**extract_state, "watermarks": watermarks, "fingerprints": fingerprints, "row_counts": row_counts}
+
+
+def get_primary_key(table_name):
+    """
+    Summary:
+    Every totesys table uses <table>_id as its integer primary key.
+    """
+    return f"{table_name}_id"
+
+
+def get_primary_key_range(table_name, last_checked, db_connection, until=None):
+    """
+    Summary:
+    Find the smallest and largest primary key among the rows that
+    extract_new_rows would return for this table (updated after
+    last_checked, and not after until when it is given).
+
+    Returns:
+        tuple (first_key, last_key), (None, None) if there are no new rows
+    """
+    last_checked_dt_obj = datetime.strptime(last_checked, "%Y-%m-%d %H:%M:%S.%f")
+    primary_key = identifier(get_primary_key(table_name))
+    until_condition = ""
+    if until is not None:
+        until_dt_obj = datetime.strptime(until, "%Y-%m-%d %H:%M:%S.%f")
+        until_condition = f" AND last_updated <= {literal(until_dt_obj)}"
+    query = f"""
+    SELECT min({primary_key}), max({primary_key}) FROM {identifier(table_name)}
+    WHERE last_updated > {literal(last_checked_dt_obj)}{until_condition}
+    """
+    try:
+        first_key, last_key = db_connection.run(query)[0]
+        return first_key, last_key
+    except DatabaseError as db_error:
+        logger.error(f"get_primary_key_range: There has been a database error: {str(db_error)}")
+        raise db_error
+
+
+def split_key_range(first_key, last_key, partitions):
+    """
+    Summary:
+    Split the inclusive range first_key..last_key into at most
+    `partitions` contiguous, non-overlapping inclusive ranges of
+    (nearly) equal width.
+
+    Returns:
+        list of (first, last) tuples
+    """
+    width = last_key - first_key + 1
+    partitions = max(1, min(partitions, width))
+    step, remainder = divmod(width, partitions)
+    ranges = []
+    start = first_key
+    for index in range(partitions):
+        end = start + step - 1 + (1 if index < remainder else 0)
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
+def plan_extract_tasks(tables, last_checked, db_connection, extract_config, watermarks=None):
+    """
+    Summary:
+    Turn the list of tables into the list of units of work for this run.
+    A table listed in extract_config["partitions"] is split into that many
+    primary key ranges, each written to its own part file under
+    <table>/<last_checked>/; every other table is a single task.
+    Each task reads the rows updated after the table's own watermark.
+
+    With extract_config["row_budget"] set, a table with more new rows than
+    the budget (after a pause or an outage) has its last_updated window
+    split into sub-windows of about row_budget rows (see
+    get_window_boundaries), each extracted as its own part, so no task
+    holds more than the budget in memory. extract_config["max_windows"]
+    caps the sub-windows extracted per run; the rest of the window is left
+    for the next runs (see limit_table_changes).
+
+    Args:
+        tables (list): names of the tables to extract
+        last_checked (str): timestamp string stored in parameter store
+        db_connection (object): connection used to look up the key ranges
+        extract_config (dict): output of get_extract_config
+        watermarks (dict): per table high-water marks, last_checked is
+        used for tables that do not have one yet
+
+    Returns:
+        list of dicts {"table": "sales_order", "key_range": (1, 500), "part": 0,
+                       "watermark": "2025-06-10 09:15:00.000000", "until": None}
+        key_range and part are None for tables that are not split, until
+        is the upper bound of a sub-window (None for the last one)
+    """
+    watermarks = watermarks or {}
+    row_budget = extract_config.get("row_budget", 0)
+    max_windows = extract_config.get("max_windows", 0)
+    tasks = []
+    for table in tables:
+        watermark = watermarks.get(table, last_checked)
+        partitions = extract_config["partitions"].get(table, 1)
+        boundaries = []
+        if row_budget > 0 and table not in FULL_SCAN_TABLES:
+            boundaries = get_window_boundaries(table, watermark, db_connection, row_budget)
+        windows = list(zip([watermark, *boundaries], [*boundaries, None]))
+        if max_windows > 0:
+            windows = windows[:max_windows]
+        if len(windows) > 1:
+            logger.info(f"{table} window split into {len(windows)} sub-windows of about {row_budget} rows")
+
+        table_tasks = []
+        for window_start, window_end in windows:
+            if partitions > 1:
+                first_key, last_key = get_primary_key_range(table, window_start, db_connection, window_end)
+                if first_key is not None:
+                    for key_range in split_key_range(first_key, last_key, partitions):
+                        table_tasks.append({"table": table, "key_range": key_range, "part": len(table_tasks),
+                                            "watermark": window_start, "until": window_end})
+                    continue
+            part = len(table_tasks) if len(windows) > 1 else None
+            table_tasks.append({"table": table, "key_range": None, "part": part,
+                                "watermark": window_start, "until": window_end})
+        tasks.extend(table_tasks)
+    return tasks
+
+
+def get_window_boundaries(table_name, watermark, db_connection, row_budget):
+    """
+    Summary:
+    Count the rows updated after watermark and, when there are more than
+    row_budget, find the last_updated of every row_budget-th of them in
+    last_updated order, in one query. Consecutive boundaries delimit
+    sub-windows (start, end] of about row_budget rows each; rows sharing
+    a last_updated are never split, so a sub-window can run over the
+    budget when many rows were updated at the same time.
+
+    Args:
+        table_name (str): name of the table
+        watermark (str): start of the window, timestamp string
+        db_connection (object): a connection object to the totesys database
+        row_budget (int): most rows wanted in one sub-window
+
+    Returns:
+        list of timestamp strings in increasing order, empty when the
+        window fits in the budget
+    """
+    watermark_dt_obj = datetime.strptime(watermark, "%Y-%m-%d %H:%M:%S.%f")
+    budget = int(row_budget)
+    query = f"""
+    SELECT DISTINCT last_updated FROM (
+        SELECT last_updated, row_number() OVER (ORDER BY last_updated) AS position, count(*) OVER () AS total
+        FROM {identifier(table_name)} WHERE last_updated > {literal(watermark_dt_obj)}
+    ) AS window_rows
+    WHERE total > {budget} AND position % {budget} = 0
+    ORDER BY last_updated
+    """
+    try:
+        rows = db_connection.run(query)
+    except DatabaseError as db_error:
+        logger.error(f"get_window_boundaries: There has been a database error: {str(db_error)}")
+        raise db_error
+    return [last_updated.strftime("%Y-%m-%d %H:%M:%S.%f") for (last_updated,) in rows]
+
+
+def limit_table_changes(table_changes, tasks):
+    """
+    Summary:
+    When max_windows left part of a table's window for later, the table
+    was only read up to the end of its last planned sub-window. Lower the
+    table's max_last_updated to that point, so advance_extract_state and
+    the manifest record how far the table really got and the next run
+    carries on from there.
+
+    Returns:
+        dict, table_changes with the deferred tables adjusted
+    """
+    reached = {}
+    for task in tasks:
+        if task.get("until") is None:
+            reached[task["table"]] = None
+        elif reached.get(task["table"], "") is not None:
+            reached[task["table"]] = max(reached.get(task["table"], ""), task["until"])
+
+    limited = dict(table_changes)
+    for table, until in reached.items():
+        if until is not None:
+            limited[table] = {**table_changes[table], "max_last_updated": until}
+    return limited
+
+
+def combine_task_results(task_results):
+    """
+    Summary:
+    Merge the results of the tasks from plan_extract_tasks back into one
+    result per table, keeping the order the tables were first seen in.
+    A table with any failed task carries that task's "error". The task
+    "metrics" are added up (peak memory is the largest of them).
+
+    Returns:
+        list of dicts
+        {"table": "sales_order", "row_count": 10, "keys": [...], "bytes": 2048, "columns": [...],
+         "metrics": {...}}
+    """
+    results = {}
+    for task_result in task_results:
+        result = results.setdefault(task_result["table"], {"table": task_result["table"], "row_count": 0,
+                                                           "keys": [], "bytes": 0, "columns": []})
+        result["row_count"] += task_result["row_count"]
+        result["keys"].extend(task_result["keys"])
+        result["bytes"] += task_result["bytes"]
+        result["columns"] = result["columns"] or task_result["columns"]
+        if "error" in task_result:
+            result["error"] = task_result["error"]
+        if "metrics" in task_result:
+            table_metrics = result.setdefault("metrics", {})
+            for name, value in task_result["metrics"].items():
+                if name == "peak_memory_mb":
+                    table_metrics[name] = max(table_metrics.get(name, 0), value)
+                else:
+                    table_metrics[name] = round(table_metrics.get(name, 0) + value, 4)
+    return list(results.values())
+
+
+def extract_new_rows_in_chunks(table_name, last_checked, db_connection, chunk_size, key_range=None,
+                               select_columns=None, until=None):
+    """
+    Summary:
+    Streaming version of extract_new_rows. The query is opened as a
+    server-side cursor and rows are fetched chunk_size at a time, so only
+    one chunk is ever held in memory.
+
+    Cursors only exist inside a transaction block, so the caller has to
+    START TRANSACTION before iterating and COMMIT afterwards.
+
+    Args:
+        table_name (str): name of the table to query for
+        last_checked (str): timestamp string stored in parameter store
+        db_connection (object): a connection object to the totesys database
+        chunk_size (int): number of rows fetched per round trip
+        key_range (tuple): optional (first, last) primary key values
+        select_columns (list): optional columns to read instead of all of them
+        until (str): optional upper bound for last_updated
+
+    Yields:
+        tuple of (column_names, rows) for every non-empty chunk
+    """
+    cursor_name = identifier(f"extract_{table_name}")
+    query = build_extract_query(table_name, last_checked, key_range, select_columns, until)
+
+    try:
+        db_connection.run(f"DECLARE {cursor_name} NO SCROLL CURSOR FOR {query}")
+        while True:
+            rows = db_connection.run(f"FETCH FORWARD {int(chunk_size)} FROM {cursor_name}")
+            if not rows:
+                break
+            column_names = [column['name'] for column in db_connection.columns]
+            yield column_names, rows
+        db_connection.run(f"CLOSE {cursor_name}")
+    except DatabaseError as db_error:
+        logger.error(f"extract_new_rows_in_chunks: There has been a database error: {str(db_error)}")
+        raise db_error
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Summary:
+    Write-only file object that sends everything written to it to S3 as a
+    multipart upload. Bytes are buffered until part_size is reached and then
+    uploaded as one part, so memory use is bounded by part_size no matter
+    how big the object ends up.
+
+    Nothing is visible in the bucket until close() completes the upload.
+    abort() throws away any parts that were already sent.
+
+    Args:
+        s3_client: boto3 s3 client
+        bucket (str): name of the bucket
+        key (str): object key to write
+        part_size (int): bytes per part, S3 needs at least 5 MiB for all but the last
+    """
+
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, s3_client, bucket, key, part_size=MIN_PART_SIZE):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_written = 0
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=body
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.parts:
+                self._upload_part(bytes(self.buffer))
+                self.buffer.clear()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts}
+            )
+        except ClientError as error:
+            logger.error(f"S3MultipartWriter: could not complete upload of {self.key}: {str(error)}")
+            self.abort()
+            raise error
+        super().close()
+
+    def abort(self):
+        if self.closed:
+            return
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer.clear()
+        super().close()
+
+
+class CompressedWriter(io.RawIOBase):
+    """
+    Summary:
+    Write-only file object that compresses what is written to it before
+    passing it on to another file object (an S3MultipartWriter). Bytes are
+    collected into blocks of block_size and every block is written as one
+    complete gzip member / zstd frame. A file made of several members or
+    frames is still a valid .gz / .zst file, so readers see one stream.
+
+    close() writes the last block but leaves the wrapped file open, the
+    caller still closes or aborts it.
+
+    Args:
+        raw: file object the compressed bytes are written to
+        codec (dict): output of parse_codec, "gzip" or "zstd"
+        block_size (int): uncompressed bytes per block
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, raw, codec, block_size=BLOCK_SIZE):
+        import pyarrow as pa
+
+        super().__init__()
+        self.raw = raw
+        self.codec = pa.Codec(codec["name"], compression_level=codec["level"])
+        self.block_size = block_size
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.block_size:
+            self._write_block()
+        return len(data)
+
+    def _write_block(self):
+        self.raw.write(self.codec.compress(bytes(self.buffer), asbytes=True))
+        self.buffer.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer:
+            self._write_block()
+        super().close()
+
+
+def parse_codec(spec):
+    """
+    Summary : parse a codec setting "name" or "name:level" (e.g. "zstd:9").
+
+    Returns:
+    dict {"name": "zstd", "level": 9}, level is None for the codec default
+    """
+    name, _, level = spec.strip().lower().partition(":")
+    return {"name": name, "level": int(level) if level else None}
+
+
+def compress_bytes(data, codec):
+    """
+    Summary : compress a whole buffer with a csv codec ("none" returns it as is).
+    """
+    if codec["name"] == "none":
+        return data
+    import pyarrow as pa
+
+    return pa.Codec(codec["name"], compression_level=codec["level"]).compress(data, asbytes=True)
+
+
+def copy_new_rows_to_s3_as_csv(s3_client, ingestion_bucket, table_name, last_checked, db_connection, key,
+                               key_range=None, select_columns=None, codec=None, until=None, stats=None):
+    """
+    Summary:
+    The copy engine. The extract query is run as
+    COPY (SELECT ...) TO STDOUT WITH (FORMAT csv, HEADER) and pg8000 hands
+    the CSV bytes coming off the socket straight to an S3 multipart
+    upload, so no Python object is built for any row or cell.
+
+    The file has a header but no index column (transform reads both
+    layouts), NULLs are empty fields and booleans are written as t/f.
+    If there are no rows the upload is aborted and no file is created.
+
+    Args:
+        s3_client: boto3 s3 client
+        ingestion_bucket (str): name of the ingestion bucket
+        table_name (str): name of the table to extract
+        last_checked (str): only rows updated after this are copied
+        db_connection (object): a connection object to the totesys database
+        key (str): object key to write
+        key_range (tuple): optional (first, last) primary key values
+        select_columns (list): optional columns to copy instead of all of them
+        codec (dict): optional csv codec from parse_codec, the bytes are
+        compressed on their way to S3
+        until (str): optional upper bound for last_updated
+        stats (dict): optional, the size of the file written is stored
+        under "bytes" so the caller does not have to head_object it
+
+    Returns:
+        int: number of rows written
+    """
+    query = build_extract_query(table_name, last_checked, key_range, select_columns, until)
+    writer = S3MultipartWriter(s3_client, ingestion_bucket, key)
+    output = writer if not codec or codec["name"] == "none" else CompressedWriter(writer, codec)
+
+    try:
+        db_connection.run(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", stream=output)
+        if output is not writer:
+            # writes the last compressed block
+            output.close()
+    except Exception as error:
+        logger.error(f"copy_new_rows_to_s3_as_csv: There has been an error copying {table_name}: {str(error)}")
+        writer.abort()
+        raise error
+
+    row_count = db_connection.row_count
+    if row_count <= 0:
+        writer.abort()
+        return 0
+
+    writer.close()
+    if stats is not None:
+        stats["bytes"] = writer.bytes_written
+    logger.info(f"{table_name} has been copied to s3://{ingestion_bucket}/{key}")
+    return row_count
+
+
+def stream_new_rows_to_s3_as_csv(s3_client, ingestion_bucket, table, chunks, last_checked, key=None, codec=None,
+                                 stats=None):
+    """
+    Summary:
+    Write the chunks produced by extract_new_rows_in_chunks to
+    s3://<ingestion_bucket>/<table>/<last_checked>.csv as a multipart upload.
+    The file has the same layout as the one written by
+    convert_new_rows_to_df_and_upload_to_s3_as_csv (leading index column),
+    so transform reads it the same way.
+    If there are no rows the upload is aborted and no file is created.
+
+    Args:
+        s3_client: boto3 s3 client
+        ingestion_bucket (str): name of the ingestion bucket
+        table (str): name of the table with the new data
+        chunks (iterable): tuples of (column_names, rows)
+        last_checked (str): timestamp used to name the file
+        key (str): optional key to write to instead, used for part files
+        codec (dict): optional csv codec from parse_codec
+        stats (dict): optional, the size of the file written is stored
+        under "bytes" so the caller does not have to head_object it
+
+    Returns:
+        int: number of rows written
+    """
+    key = key or f"{table}/{last_checked}.csv"
+    writer = S3MultipartWriter(s3_client, ingestion_bucket, key)
+    output = writer if not codec or codec["name"] == "none" else CompressedWriter(writer, codec)
+    row_count = 0
+
+    try:
+        for column_names, rows in chunks:
+            output.write(rows_to_csv_bytes(column_names, rows, row_count, header=row_count == 0))
+            row_count += len(rows)
+        if output is not writer:
+            # writes the last compressed block
+            output.close()
+    except Exception as error:
+        logger.error(f"stream_new_rows_to_s3_as_csv: There has been an error streaming {table}: {str(error)}")
+        writer.abort()
+        raise error
+
+    if row_count == 0:
+        writer.abort()
+        return 0
+
+    writer.close()
+    if stats is not None:
+        stats["bytes"] = writer.bytes_written
+    logger.info(f"{table} has been streamed to s3://{ingestion_bucket}/{key}")
+    return row_count
+
+
+def rows_to_csv_bytes(column_names, rows, first_index=0, header=True):
+    """
+    Summary:
+    Serialise database rows as csv in the layout pandas' to_csv gives
+    (a leading index column), straight from the row lists.
+
+    Args:
+        column_names (list): list of column names
+        rows (list): nested list of row values
+        first_index (int): index of the first row, for the chunks after the first
+        header (bool): write the header line
+
+    Returns:
+        bytes, utf-8 encoded
+    """
+    buffer = io.StringIO()
+    csv_writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        csv_writer.writerow([""] + list(column_names))
+    csv_writer.writerows((index, *row) for index, row in enumerate(rows, start=first_index))
+    return buffer.getvalue().encode("utf-8")
+
+
+def convert_new_rows_to_df_and_upload_to_s3_as_csv(ingestion_bucket, table, column_names, new_rows,last_checked,
+                                                   key=None, codec=None):
+    """
+    Summary:
+    This function will take the column names and new row data
+    and upload them directly to given s3 bucket as a csv file.
+    The csv is written from the rows with rows_to_csv_bytes, no dataframe
+    copy of the table is made.
+    
+
+    Args:
+        ingestion_bucket (str): name of the ingestion bucket
+        table (str): name of the table with the new data
+        column_names (list): list of column names
+        new_rows (list): nested list of new row values
+        key (str): optional key to write to instead, used for part files
+        codec (dict): optional csv codec from parse_codec
+        
+        
+    returns:
+        int: size in bytes of the file written, and a sucess message through a log
+    """
+    import awswrangler as wr
+    
+    key = key or f"{table}/{last_checked}.csv"
+    try:
+        body = rows_to_csv_bytes(column_names, new_rows)
+        if codec and codec["name"] != "none":
+            body = compress_bytes(body, codec)
+        wr.s3.upload(local_file=io.BytesIO(body), path=f"s3://{ingestion_bucket}/{key}")
+        logger.info(f"{table} has been saved to s3://{ingestion_bucket}/{key}")
+        return len(body)
+    except Exception as error:
+        logger.error(f"convert_new_rows_to_df_and_upload_to_s3_as_csv: There has been an error uploading {table}: "
+                     f"{str(error)}")
+        raise error
+
+    
+def convert_chunks_to_arrow(chunks, table=None, columns=None):
+    """
+    Summary:
+    Turn the (column_names, rows) chunks coming from the database into
+    pyarrow Tables, building one Arrow array per column straight from the
+    row lists (no dataframe in between). A column gets its SOURCE_SCHEMA
+    type when the table is registered, else the type of its postgres type
+    oid (ARROW_TYPE_OIDS) from columns, else the type pyarrow infers, so
+    every chunk (and every batch) has the same schema, even a chunk where
+    a column is all null.
+
+    Args:
+        chunks (iterable): tuples of (column_names, rows)
+        table (str): name of the table the rows come from
+        columns (list): optional output of describe_columns, read when the
+        first chunk is converted (stream mode fills it in while fetching)
+
+    Yields:
+        pyarrow.Table for every chunk
+    """
+    import pyarrow as pa
+
+    arrow_types = None
+    for column_names, rows in chunks:
+        if arrow_types is None:
+            arrow_types = get_arrow_types(table, column_names, columns)
+        values = list(zip(*rows)) if rows else [[] for _ in column_names]
+        arrays = [pa.array(column, type=arrow_type) for column, arrow_type in zip(values, arrow_types)]
+        yield pa.Table.from_arrays(arrays, names=list(column_names))
+
+
+def get_arrow_types(table, column_names, columns=None):
+    """
+    Summary:
+    The Arrow type of every column: from SOURCE_SCHEMA, or from the
+    postgres type oid pg8000 reported, or None to let pyarrow infer it.
+    """
+    import pyarrow as pa
+
+    schema = source_arrow_schema(table, column_names)
+    if schema is not None:
+        return list(schema.types)
+    type_oids = {column["name"]: column.get("type_oid") for column in columns or []}
+    arrow_type_oids = {16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 25: pa.string(),
+                       700: pa.float32(), 701: pa.float64(), 1042: pa.string(), 1043: pa.string(),
+                       1082: pa.date32(), 1114: pa.timestamp("us"), 1184: pa.timestamp("us", tz="UTC")}
+    return [arrow_type_oids.get(type_oids.get(name)) for name in column_names]
+
+
+def source_arrow_schema(table, column_names):
+    """
+    Summary:
+    The pyarrow schema of these columns of a table from SOURCE_SCHEMA,
+    None (types are inferred) if the table or a column is not registered.
+    """
+    import pyarrow as pa
+
+    table_schema = SOURCE_SCHEMA.get(table, {})
+    if not column_names or any(name not in table_schema for name in column_names):
+        return None
+    arrow_types = {"int": pa.int64(), "str": pa.string(), "bool": pa.bool_(), "timestamp": pa.timestamp("us")}
+    fields = []
+    for name in column_names:
+        column_type = table_schema[name]
+        if column_type.startswith("decimal"):
+            precision, scale = column_type[len("decimal("):-1].split(",")
+            fields.append(pa.field(name, pa.decimal128(int(precision), int(scale))))
+        else:
+            fields.append(pa.field(name, arrow_types[column_type]))
+    return pa.schema(fields)
+
+
+def write_arrow_tables_to_s3(s3_client, ingestion_bucket, key, tables, ingestion_format, codec=None, stats=None):
+    """
+    Summary:
+    Write a sequence of pyarrow Tables with the same schema to one S3
+    object, either as a parquet file (snappy compressed by default, one
+    row group per table) or as an Arrow IPC file (zstd compressed by
+    default, one record batch per table). The object is written as a multipart upload, so only the table
+    being written has to be in memory.
+    If there are no rows the upload is aborted and no file is created.
+
+    Args:
+        s3_client: boto3 s3 client
+        ingestion_bucket (str): name of the ingestion bucket
+        key (str): object key to write
+        tables (iterable): pyarrow Tables
+        ingestion_format (str): "parquet" or "arrow"
+        codec (dict): optional codec from parse_codec, see INGESTION_CODECS
+        stats (dict): optional, the size of the file written is stored
+        under "bytes" so the caller does not have to head_object it
+
+    Returns:
+        int: number of rows written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    codec = codec or parse_codec(INGESTION_CODECS[ingestion_format][0])
+
+    writer = S3MultipartWriter(s3_client, ingestion_bucket, key)
+    file_writer = None
+    row_count = 0
+
+    try:
+        for table in tables:
+            if file_writer is None:
+                if ingestion_format == "parquet":
+                    file_writer = pq.ParquetWriter(writer, table.schema, compression=codec["name"],
+                                                   compression_level=codec["level"])
+                else:
+                    compression = None
+                    if codec["name"] != "none":
+                        compression = pa.Codec(codec["name"], compression_level=codec["level"])
+                    options = pa.ipc.IpcWriteOptions(compression=compression)
+                    file_writer = pa.ipc.new_file(writer, table.schema, options=options)
+            else:
+                table = table.cast(file_writer.schema)
+            file_writer.write_table(table)
+            row_count += table.num_rows
+        if file_writer is not None:
+            file_writer.close()
+    except Exception as error:
+        logger.error(f"write_arrow_tables_to_s3: There has been an error writing {key}: {str(error)}")
+        writer.abort()
+        raise error
+
+    if row_count == 0:
+        writer.abort()
+        return 0
+
+    writer.close()
+    if stats is not None:
+        stats["bytes"] = writer.bytes_written
+    logger.info(f"{key} has been saved to s3://{ingestion_bucket}/{key}")
+    return row_count
+
+
+def extract_table_to_s3(table, last_checked, db_connection, s3_client, ingestion_bucket, extract_config,
+                        key_range=None, part=None, watermark=None, until=None):
+    """
+    Summary:
+    Extract the new rows for one table and upload them to the ingestion
+    bucket, using the batch or stream path depending on extract_config.
+    This is the unit of work for both the sequential and the concurrent
+    extract.
+
+    Args:
+        table (str): name of the table to extract
+        last_checked (str): timestamp string stored in parameter store
+        db_connection (object): a connection object to the totesys database
+        s3_client: boto3 s3 client
+        ingestion_bucket (str): name of the ingestion bucket
+        extract_config (dict): output of get_extract_config
+        key_range (tuple): optional (first, last) primary key values
+        part (int): part number when the table is split into key ranges
+        watermark (str): only rows updated after this are read,
+        defaults to last_checked (which always names the files)
+        until (str): optional, rows updated after this are not read
+
+    Returns:
+        dict {"table": "sales_order", "row_count": 10, "keys": ["sales_order/....csv"],
+              "bytes": 2048, "columns": [{"name": "sales_order_id", "type_oid": 23}, ...]}
+    """
+    watermark = watermark or last_checked
+    ingestion_format = extract_config["format"]
+    codec = get_table_codec(table, extract_config)
+    extension = ingestion_format + (CSV_CODEC_EXTENSIONS[codec["name"]] if ingestion_format == "csv" else "")
+    if part is None:
+        key = f"{table}/{last_checked}.{extension}"
+    else:
+        key = f"{table}/{last_checked}/part-{part:05d}.{extension}"
+    select_columns = get_table_columns(table, extract_config)
+
+    if get_table_engine(table, extract_config) == "copy":
+        columns = describe_query(build_extract_query(table, watermark, key_range, select_columns, until),
+                                 db_connection)
+        stats = {}
+        row_count = copy_new_rows_to_s3_as_csv(s3_client, ingestion_bucket, table, watermark, db_connection,
+                                               key, key_range, select_columns, codec, until, stats)
+        logger.info(f"copied {row_count} new rows for {table} to s3")
+        if not row_count:
+            return {"table": table, "row_count": 0, "keys": [], "bytes": 0, "columns": []}
+        return {"table": table, "row_count": row_count, "keys": [key], "bytes": stats["bytes"], "columns": columns}
+
+    if extract_config["mode"] == "stream":
+        columns = []
+
+        def describe_first_chunk(chunks):
+            # the connection describes the columns of the last FETCH
+            for chunk in chunks:
+                if not columns:
+                    columns.extend(describe_columns(db_connection.columns))
+                yield chunk
+
+        chunks = describe_first_chunk(
+            extract_new_rows_in_chunks(table, watermark, db_connection, extract_config["chunk_size"], key_range,
+                                       select_columns, until))
+        stats = {}
+        if ingestion_format == "csv":
+            row_count = stream_new_rows_to_s3_as_csv(s3_client, ingestion_bucket, table, chunks, last_checked, key,
+                                                     codec, stats)
+        else:
+            row_count = write_arrow_tables_to_s3(s3_client, ingestion_bucket, key,
+                                                 convert_chunks_to_arrow(chunks, table, columns), ingestion_format,
+                                                 codec, stats)
+        logger.info(f"streamed {row_count} new rows for {table} to s3")
+        if not row_count:
+            return {"table": table, "row_count": 0, "keys": [], "bytes": 0, "columns": []}
+        return {"table": table, "row_count": row_count, "keys": [key], "bytes": stats["bytes"], "columns": columns}
+
+    column_names, new_rows = extract_new_rows(table, watermark, db_connection, key_range, select_columns, until)
+    logger.info(f"obtained new rows for {table}")
+    if not new_rows:
+        return {"table": table, "row_count": 0, "keys": [], "bytes": 0, "columns": []}
+    columns = describe_columns(db_connection.columns)
+    size = upload_rows_to_s3(s3_client, ingestion_bucket, table, key, column_names, new_rows, ingestion_format,
+                             codec, columns)
+    logger.info(f"uploaded {ingestion_format} file for {table} to s3")
+    return {"table": table, "row_count": len(new_rows), "keys": [key], "bytes": size, "columns": columns}
+
+
+def upload_rows_to_s3(s3_client, ingestion_bucket, table, key, column_names, rows, ingestion_format, codec=None,
+                      columns=None):
+    """
+    Summary:
+    Write rows already held in memory to one ingestion file in the given
+    format (the batch path of extract_table_to_s3 and the cdc engine).
+    columns (describe_columns) gives the type oids of the Arrow columns.
+
+    Returns:
+        int: size in bytes of the file written
+    """
+    if ingestion_format == "csv":
+        return convert_new_rows_to_df_and_upload_to_s3_as_csv(ingestion_bucket, table, column_names, rows, None, key,
+                                                              codec)
+    stats = {}
+    write_arrow_tables_to_s3(s3_client, ingestion_bucket, key,
+                             convert_chunks_to_arrow([(column_names, rows)], table, columns), ingestion_format,
+                             codec, stats)
+    return stats["bytes"]
+
+
+def describe_columns(columns):
+    """
+    Summary:
+    Reduce the column descriptions pg8000 keeps on the connection after a
+    query to the name and postgres type oid of every column, the schema
+    recorded in the batch manifest.
+
+    Returns:
+        list of dicts [{"name": "sales_order_id", "type_oid": 23}, ...]
+    """
+    return [{"name": column["name"], "type_oid": column.get("type_oid")} for column in columns]
+
+
+def describe_query(query, db_connection):
+    """
+    Summary:
+    Column names and type oids a query returns, without reading any rows
+    (the query is wrapped in a LIMIT 0). COPY sends no row description, so
+    the copy engine uses this for the manifest schema.
+
+    Returns:
+        list of dicts from describe_columns
+    """
+    db_connection.run(f"SELECT * FROM ({query}) AS described LIMIT 0")
+    return describe_columns(db_connection.columns)
+
+
+def check_schema_drift(db_connection, tables):
+    """
+    Summary:
+    Compare SOURCE_SCHEMA with the columns the totesys tables have now
+    (information_schema.columns), so a renamed, dropped, added or retyped
+    column is caught by extract instead of breaking transform.
+
+    Args:
+        db_connection (object): a connection object to the totesys database
+        tables (list): tables to check
+
+    Returns:
+        list of differences, empty when the database matches
+        ["sales_order.unit_price: numeric in SOURCE_SCHEMA, double precision in the database", ...]
+    """
+    rows = db_connection.run(
+        "SELECT table_name, column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = ANY(CAST(:tables AS text[]))", tables=tables)
+    database = {}
+    for table_name, column_name, data_type in rows:
+        database.setdefault(table_name, {})[column_name] = data_type
+
+    drift = []
+    for table in tables:
+        expected = {name: SCHEMA_DATA_TYPES[column_type.split("(")[0]]
+                    for name, column_type in SOURCE_SCHEMA.get(table, {}).items()}
+        actual = database.get(table, {})
+        for name, data_type in expected.items():
+            if name not in actual:
+                drift.append(f"{table}.{name}: in SOURCE_SCHEMA, missing from the database")
+            elif actual[name] != data_type:
+                drift.append(f"{table}.{name}: {data_type} in SOURCE_SCHEMA, {actual[name]} in the database")
+        for name in sorted(actual.keys() - expected.keys()):
+            drift.append(f"{table}.{name}: in the database, missing from SOURCE_SCHEMA")
+    return drift
+
+
+def enforce_schema(drift, schema_drift):
+    """
+    Summary : log the differences found by check_schema_drift, and stop
+    the run on any of them when SCHEMA_DRIFT is "fail".
+    """
+    for difference in drift:
+        logger.warning(f"schema drift: {difference}")
+    if drift and schema_drift == "fail":
+        raise ValueError(f"enforce_schema: {len(drift)} columns differ from SOURCE_SCHEMA")
+
+
+def extract_task_to_s3(task, last_checked, db_connection, s3_client, ingestion_bucket, extract_config):
+    """
+    Summary:
+    Run one task from plan_extract_tasks with extract_table_to_s3.
+    The task runs inside a savepoint, so a database error only rolls back
+    this task and the connection's snapshot transaction stays usable for
+    the next one. Errors are logged and returned instead of raised.
+    The task is measured on its own thread, see measure().
+
+    Returns:
+        dict from extract_table_to_s3 with the task's "metrics", or
+        {"table": "sales_order", "row_count": 0, "keys": [], "bytes": 0, "columns": [], "metrics": {...},
+         "error": "..."}
+    """
+    with measure(per_thread=True) as task_metrics:
+        try:
+            db_connection.run("SAVEPOINT extract_task")
+            result = extract_table_to_s3(task["table"], last_checked, db_connection, s3_client, ingestion_bucket,
+                                         extract_config, key_range=task["key_range"], part=task["part"],
+                                         watermark=task["watermark"], until=task.get("until"))
+            db_connection.run("RELEASE SAVEPOINT extract_task")
+        except Exception as error:
+            logger.error(f"extract_task_to_s3: extract of {task['table']} failed: {str(error)}")
+            try:
+                db_connection.run("ROLLBACK TO SAVEPOINT extract_task")
+            except Exception as rollback_error:
+                logger.error(f"extract_task_to_s3: could not roll back to savepoint: {str(rollback_error)}")
+            result = {"table": task["table"], "row_count": 0, "keys": [], "bytes": 0, "columns": [],
+                      "error": str(error)}
+        task_metrics["rows_in"] = task_metrics["rows_out"] = result["row_count"]
+    return {**result, "metrics": task_metrics}
+
+
+def open_export_snapshot(db_connection):
+    """
+    Summary:
+    Start a REPEATABLE READ transaction on db_connection and export its
+    snapshot with pg_export_snapshot(), so other connections can read
+    exactly the same state of the database (see import_snapshot).
+    The transaction has to stay open until every importer has started.
+
+    The new watermark is the database clock at the start of the
+    transaction (localtimestamp, same type as last_updated). It is taken
+    just before the snapshot, so rows can at worst be extracted twice,
+    never skipped.
+
+    Args:
+        db_connection (object): a connection object to the totesys database
+
+    Returns:
+        dict {"snapshot_id": "00000003-0000001B-1",
+              "snapshot_time": "2025-06-10 09:15:00.123456"}
+    """
+    try:
+        db_connection.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        snapshot_id, snapshot_time = db_connection.run("SELECT pg_export_snapshot(), localtimestamp")[0]
+        return {"snapshot_id": snapshot_id,
+                "snapshot_time": snapshot_time.strftime("%Y-%m-%d %H:%M:%S.%f")}
+    except DatabaseError as db_error:
+        logger.error(f"open_export_snapshot: could not export snapshot: {str(db_error)}")
+        raise db_error
+
+
+def import_snapshot(db_connection, snapshot_id):
+    """
+    Summary:
+    Start a REPEATABLE READ transaction on db_connection that sees the
+    snapshot exported by open_export_snapshot.
+
+    Args:
+        db_connection (object): a connection object to the totesys database
+        snapshot_id (str): the id returned by pg_export_snapshot()
+    """
+    try:
+        db_connection.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        db_connection.run(f"SET TRANSACTION SNAPSHOT {literal(snapshot_id)}")
+    except DatabaseError as db_error:
+        logger.error(f"import_snapshot: could not import snapshot {snapshot_id}: {str(db_error)}")
+        raise db_error
+
+
+def create_db_connection_pool(db_credentials, pool_size, snapshot_id=None):
+    """
+    Summary:
+    Open pool_size connections to the totesys database and put them in a
+    queue. Every connection is left inside a read only transaction so the
+    stream mode can declare cursors on it. When snapshot_id is given, that
+    transaction imports the exported snapshot so all connections see the
+    same point in time.
+
+    Args:
+        db_credentials (dict): output of get_db_credentials
+        pool_size (int): number of connections to open
+        snapshot_id (str): optional id returned by pg_export_snapshot()
+
+    Returns:
+        queue.Queue of Connection objects
+    """
+    pool = queue.Queue()
+    try:
+        for _ in range(pool_size):
+            db_connection = create_db_connection(db_credentials)
+            if snapshot_id:
+                import_snapshot(db_connection, snapshot_id)
+            else:
+                db_connection.run("START TRANSACTION READ ONLY")
+            pool.put(db_connection)
+    except Exception as error:
+        close_db_connection_pool(pool)
+        raise error
+    logger.info(f"created db connection pool of size {pool_size}")
+    return pool
+
+
+def close_db_connection_pool(pool):
+    """
+    Summary:
+    End the transaction on every connection in the pool and close it.
+    Errors are logged and skipped so one dead connection does not leave
+    the others open.
+    """
+    while not pool.empty():
+        db_connection = pool.get()
+        try:
+            db_connection.run("COMMIT")
+            db_connection.close()
+        except Exception as error:
+            logger.error(f"close_db_connection_pool: could not close connection: {str(error)}")
+    logger.info("db connection pool closed")
+
+
+def extract_tables_concurrently(tasks, last_checked, db_credentials, s3_client, ingestion_bucket, extract_config,
+                                snapshot_id=None):
+    """
+    Summary:
+    Run extract_task_to_s3 for every task on a thread pool of
+    extract_config["pool_size"] workers. Each worker borrows a connection
+    from a pool of the same size for the duration of one task, so the
+    queries and S3 uploads of different tables (and of the key ranges of
+    one partitioned table) overlap.
+
+    Every task is attempted even if another one fails; failed tasks come
+    back with an "error" so the caller can keep their watermarks where
+    they were.
+
+    Args:
+        tasks (list): units of work from plan_extract_tasks
+        last_checked (str): timestamp string stored in parameter store
+        db_credentials (dict): output of get_db_credentials
+        s3_client: boto3 s3 client (thread safe)
+        ingestion_bucket (str): name of the ingestion bucket
+        extract_config (dict): output of get_extract_config
+        snapshot_id (str): optional exported snapshot every worker imports
+
+    Returns:
+        list of dicts from extract_table_to_s3, in the order of tasks
+    """
+    if not tasks:
+        return []
+    pool_size = min(extract_config["pool_size"], len(tasks))
+    pool = create_db_connection_pool(db_credentials, pool_size, snapshot_id)
+
+    def run_task(task):
+        db_connection = pool.get()
+        try:
+            return extract_task_to_s3(task, last_checked, db_connection, s3_client, ingestion_bucket, extract_config)
+        finally:
+            pool.put(db_connection)
+
+    try:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            results = list(executor.map(run_task, tasks))
+    finally:
+        close_db_connection_pool(pool)
+    return results
+
+
+def build_batch_manifest(last_checked, ingestion_format, results, table_changes, previous_manifest=None):
+    """
+    Summary:
+    Describe everything transform needs to know about a batch in one
+    document: for every table the ingestion file keys, row count, bytes,
+    column schema and the watermark the data was extracted up to.
+
+    Tables that were not extracted (unchanged, failed or with no new rows)
+    keep the entry of the previous manifest with "changed" set to False, so
+    builders that need the latest copy of a table (department, address)
+    still find it without listing the bucket.
+
+    Args:
+        last_checked (str): timestamp marking the batch
+        ingestion_format (str): csv, parquet or arrow
+        results (list): output of combine_task_results
+        table_changes (dict): output of probe_table_changes
+        previous_manifest (dict): manifest of the previous batch, if any
+
+    Returns:
+        dict
+        {"batch": "2025-06-10 09:15:00.000000", "ingestion_format": "csv",
+         "tables": {"sales_order": {"changed": True, "batch": "...", "keys": [...],
+                                    "format": "csv", "row_count": 10, "bytes": 2048,
+                                    "columns": [...], "watermark": "..."}}}
+    """
+    tables = {}
+    if previous_manifest:
+        for table, entry in previous_manifest["tables"].items():
+            tables[table] = {key: value for key, value in entry.items() if key != "deletes"} | {"changed": False}
+
+    for result in results:
+        if "error" in result:
+            continue
+        if not result["keys"]:
+            if result.get("deletes"):
+                # cdc engine, deletes only: the latest rows are still the previous files
+                tables[result["table"]] = {**tables.get(result["table"], {"changed": False, "keys": []}),
+                                           "deletes": result["deletes"]}
+            continue
+        tables[result["table"]] = {
+            "changed": True,
+            "batch": last_checked,
+            "keys": result["keys"],
+            "format": ingestion_format,
+            "row_count": result["row_count"],
+            "bytes": result["bytes"],
+            "columns": result["columns"],
+            "watermark": table_changes.get(result["table"], {}).get("max_last_updated"),
+        }
+        if result.get("deletes"):
+            # cdc engine only: files with the primary keys of the rows deleted in this batch
+            tables[result["table"]]["deletes"] = result["deletes"]
+    return {"batch": last_checked, "ingestion_format": ingestion_format, "tables": tables}
+
+
+def upload_manifest(s3_client, ingestion_bucket, manifest):
+    """
+    Summary:
+    Write a batch manifest to s3://<ingestion_bucket>/manifests/<batch>.json
+
+    Returns:
+        str: key of the manifest
+    """
+    key = f"manifests/{manifest['batch']}.json"
+    try:
+        s3_client.put_object(Bucket=ingestion_bucket, Key=key, Body=json.dumps(manifest).encode("utf-8"),
+                             ContentType="application/json")
+        return key
+    except ClientError as error:
+        logger.error(f"upload_manifest: There has been an error writing {key}: {str(error)}")
+        raise error
+
+
+def get_manifest(s3_client, ingestion_bucket, manifest_key):
+    """
+    Summary:
+    Read a batch manifest written by upload_manifest.
+
+    Returns:
+        dict, or None when there is no manifest_key yet (the first run)
+    """
+    if not manifest_key:
+        return None
+    try:
+        response = s3_client.get_object(Bucket=ingestion_bucket, Key=manifest_key)
+        return json.loads(response["Body"].read())
+    except ClientError as error:
+        logger.error(f"get_manifest: There has been an error reading {manifest_key}: {str(error)}")
+        raise error
+
+
+def run_cdc_extract(tables, last_checked, ssm_client, sm_client, s3_client, ingestion_bucket, extract_config,
+                    cold_start, timings, metrics):
+    """
+    Summary:
+    The cdc engine (EXTRACT_ENGINE=cdc). Instead of scanning every table
+    for last_updated > last_checked, read the changes committed since the
+    last run from the logical replication slot CDC_SLOT_NAME (default
+    funland_cdc, created with the wal2json plugin on the first run) and
+    write them with the same per table layout: the inserted and updated
+    rows of a table go to <table>/<last_checked>.<format>, the primary
+    keys of deleted rows to deletes/<table>/<last_checked>.<format>, and
+    both are listed in the batch manifest. The cost follows the number of
+    changes, deletes are seen and the Lambda clock is never compared with
+    the database one.
+
+    At most CDC_MAX_CHANGES changes (default 500000, whole transactions)
+    are read per run, the rest wait for the next one. The changes are only
+    peeked, and the slot is advanced once the files, manifest and
+    last_checked are written, so a failed run reads them again.
+
+    The database needs wal_level=logical, the wal2json plugin and a user
+    with the REPLICATION attribute. Changes made before the slot existed
+    are not in it, load them with the backfill first.
+
+    Returns:
+        dict, same payload as lambda_handler
+    """
+    slot_name = os.environ.get("CDC_SLOT_NAME", "funland_cdc")
+    max_changes = int(os.environ.get("CDC_MAX_CHANGES", "500000"))
+
+    with stage_timer(timings, "connection", metrics):
+        _, db_conn = get_db_connection(sm_client)
+        ensure_replication_slot(db_conn, slot_name)
+        batch_time = db_conn.run("SELECT localtimestamp")[0][0].strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    with stage_timer(timings, "extract", metrics) as extract_stage:
+        table_changes, last_lsn, change_count = read_replication_changes(db_conn, slot_name, tables, max_changes)
+        logger.info(f"read {change_count} changes from slot {slot_name} up to {last_lsn}")
+        results = []
+        for table, changes in table_changes.items():
+            with measure() as table_metrics:
+                result = write_table_changes(s3_client, ingestion_bucket, table, last_checked, changes, extract_config)
+                table_metrics["rows_in"] = changes["change_count"]
+                table_metrics["rows_out"] = result["row_count"]
+            metrics["tables"][table] = table_metrics
+            results.append(result)
+        extract_stage["rows_in"] = change_count
+        extract_stage["rows_out"] = sum(result["row_count"] for result in results)
+    changed_tables = [result["table"] for result in results]
+
+    with stage_timer(timings, "state", metrics):
+        extract_state = get_extract_state(ssm_client)
+        previous_manifest = get_manifest(s3_client, ingestion_bucket, extract_state.get("manifest_key"))
+        manifest = build_batch_manifest(last_checked, extract_config["format"], results,
+                                        {table: {"max_last_updated": batch_time} for table in changed_tables},
+                                        previous_manifest)
+        manifest_key = upload_manifest(s3_client, ingestion_bucket, manifest)
+        # the tables written are current up to batch_time, so switching back to the poll engine
+        # does not re-extract them from watermarks left by its last run
+        watermarks = dict(extract_state.get("watermarks", {}))
+        for table in changed_tables:
+            if table not in FULL_SCAN_TABLES:
+                watermarks[table] = batch_time
+        extract_state = {**extract_state, "watermarks": watermarks, "manifest_key": manifest_key}
+        update_extract_state(ssm_client, extract_state)
+        new_time = update_last_checked(ssm_client, batch_time)
+        if last_lsn is not None:
+            db_conn.run("SELECT pg_replication_slot_advance(:slot_name, CAST(:lsn AS pg_lsn))",
+                        slot_name=slot_name, lsn=last_lsn)
+        if get_cache_ttl() <= 0:
+            db_conn.close()
+    logger.info(f"last checked time updated:  {new_time}, slot {slot_name} advanced to {last_lsn}")
+
+    startup = startup_report(cold_start, timings)
+    emit_metrics("extract", metrics)
+    return {"message": "success", "timestamp_to_transform": last_checked,
+            "ingestion_format": extract_config["format"], "changed_tables": changed_tables,
+            "failed_tables": [], "manifest_key": manifest_key, "startup": startup, "metrics": metrics}
+
+
+def ensure_replication_slot(db_connection, slot_name):
+    """
+    Summary : create the wal2json logical replication slot if it does not exist yet.
+    """
+    if not db_connection.run("SELECT 1 FROM pg_replication_slots WHERE slot_name = :slot_name",
+                             slot_name=slot_name):
+        db_connection.run("SELECT pg_create_logical_replication_slot(:slot_name, 'wal2json')", slot_name=slot_name)
+        logger.info(f"created logical replication slot {slot_name}")
+
+
+def read_replication_changes(db_connection, slot_name, tables, max_changes):
+    """
+    Summary:
+    Peek at the changes waiting in a wal2json slot (format-version 2, one
+    JSON document per change) for the given tables, without consuming
+    them. Several changes to one row are folded into its latest version,
+    so every table has at most one row per primary key, like a poll.
+
+    Args:
+        db_connection (object): a connection object to the totesys database
+        slot_name (str): name of the logical replication slot
+        tables (list): tables to read changes for
+        max_changes (int): stop after the transaction holding this change
+
+    Returns:
+        tuple (table_changes, last_lsn, change_count)
+        table_changes {"sales_order": {"columns": [{"name": "sales_order_id", "type_oid": 23}, ...],
+                                       "upserts": {(1,): [1, ...]}, "deletes": {(2,): [2]},
+                                       "key_columns": ["sales_order_id"], "change_count": 2}}
+        last_lsn is None when there were no changes
+    """
+    rows = db_connection.run(
+        "SELECT lsn::text, data FROM pg_logical_slot_peek_changes(:slot_name, NULL, :max_changes, "
+        "'format-version', '2', 'include-type-oids', '1', 'numeric-data-types-as-string', '1', "
+        "'add-tables', :add_tables)",
+        slot_name=slot_name, max_changes=max_changes,
+        add_tables=",".join(f"public.{table}" for table in tables))
+
+    table_changes = {}
+    last_lsn = None
+    change_count = 0
+    for lsn, data in rows:
+        last_lsn = lsn
+        change = json.loads(data)
+        if change["action"] not in ["I", "U", "D"]:
+            if change["action"] == "T":
+                logger.warning(f"read_replication_changes: {change['table']} was truncated, "
+                               f"the truncate is not extracted")
+            continue
+        change_count += 1
+        table = change["table"]
+        key_column = get_primary_key(table)
+        entry = table_changes.setdefault(table, {"columns": None, "upserts": {}, "deletes": {},
+                                                 "key_columns": [key_column], "change_count": 0})
+        entry["change_count"] += 1
+        if change["action"] == "D":
+            values = {column["name"]: parse_cdc_value(column) for column in change["identity"]}
+            key = values[key_column]
+            entry["upserts"].pop(key, None)
+            entry["deletes"][key] = [key]
+            continue
+        if entry["columns"] is None:
+            entry["columns"] = [{"name": column["name"], "type_oid": column.get("typeoid")}
+                                for column in change["columns"]]
+        key = next(parse_cdc_value(column) for column in change["columns"] if column["name"] == key_column)
+        entry["deletes"].pop(key, None)
+        entry["upserts"][key] = [parse_cdc_value(column) for column in change["columns"]]
+    return table_changes, last_lsn, change_count
+
+
+def parse_cdc_value(column):
+    """
+    Summary:
+    Turn a wal2json column value back into the Python type a SELECT would
+    return: numerics come as strings (kept exact) and timestamps as text.
+    """
+    value = column.get("value")
+    if value is None:
+        return None
+    column_type = column.get("type", "").split("(")[0]
+    if column_type == "numeric":
+        return Decimal(value)
+    if column_type.startswith("timestamp"):
+        return datetime.fromisoformat(value)
+    if column_type == "date":
+        return date.fromisoformat(value)
+    return value
+
+
+def write_table_changes(s3_client, ingestion_bucket, table, last_checked, changes, extract_config):
+    """
+    Summary:
+    Write the folded changes of one table from read_replication_changes:
+    the upserted rows to <table>/<last_checked>.<format> (only the
+    COLUMN_REGISTRY columns unless full fidelity) and the deleted primary
+    keys to deletes/<table>/<last_checked>.<format>.
+
+    Returns:
+        dict like extract_table_to_s3, with "deletes": [key] when rows were deleted
+    """
+    ingestion_format = extract_config["format"]
+    codec = get_table_codec(table, extract_config)
+    extension = ingestion_format + (CSV_CODEC_EXTENSIONS[codec["name"]] if ingestion_format == "csv" else "")
+    result = {"table": table, "row_count": 0, "keys": [], "bytes": 0, "columns": []}
+
+    if changes["upserts"]:
+        columns = changes["columns"]
+        select_columns = get_table_columns(table, extract_config)
+        positions = [index for index, column in enumerate(columns)
+                     if select_columns is None or column["name"] in select_columns]
+        rows = [[row[index] for index in positions] for row in changes["upserts"].values()]
+        key = f"{table}/{last_checked}.{extension}"
+        columns = [columns[index] for index in positions]
+        size = upload_rows_to_s3(s3_client, ingestion_bucket, table, key, [column["name"] for column in columns],
+                                 rows, ingestion_format, codec, columns)
+        result.update({"row_count": len(rows), "keys": [key], "bytes": size, "columns": columns})
+
+    if changes["deletes"]:
+        key = f"deletes/{table}/{last_checked}.{extension}"
+        upload_rows_to_s3(s3_client, ingestion_bucket, table, key, changes["key_columns"],
+                          list(changes["deletes"].values()), ingestion_format, codec)
+        result["deletes"] = [key]
+    logger.info(f"{table}: {result['row_count']} upserted and {len(changes['deletes'])} deleted rows written")
+    return result
+
+
+def run_backfill(backfill_event, ssm_client, sm_client, s3_client):
+    """
+    Summary:
+    Entry point for the backfill state machine, used for the initial
+    historical load that is too big for one 15 minute invocation.
+    backfill_event["action"] is one of:
+
+    - "plan": split every table into primary key chunks (plan_backfill)
+    - "chunk": extract one chunk and checkpoint it (extract_backfill_chunk)
+    - "finish": write the manifest and move the watermarks (finish_backfill)
+
+    Pause the schedule of the normal state machine while a backfill runs,
+    both start from the same last_checked.
+
+    Returns:
+        dict, the output of the action
+    """
+    ingestion_bucket = get_bucket_name()["ingestion_bucket"]
+    action = backfill_event.get("action")
+    if action == "plan":
+        return plan_backfill(backfill_event, ssm_client, sm_client, s3_client, ingestion_bucket)
+    if action == "chunk":
+        return extract_backfill_chunk(backfill_event, sm_client, s3_client, ingestion_bucket)
+    if action == "finish":
+        return finish_backfill(backfill_event, ssm_client, s3_client, ingestion_bucket)
+    raise ValueError(f"run_backfill: unknown backfill action {action}")
+
+
+def get_backfill_chunk_keys():
+    """
+    Summary : number of primary keys per backfill chunk, from
+    BACKFILL_CHUNK_KEYS (default 250000). Pick it so one chunk is
+    extracted well inside the Lambda timeout.
+    """
+    return max(1, int(os.environ.get("BACKFILL_CHUNK_KEYS", "250000")))
+
+
+def plan_backfill(backfill_event, ssm_client, sm_client, s3_client, ingestion_bucket):
+    """
+    Summary:
+    Plan a backfill of every row updated after last_checked, up to the
+    database clock now (as_of). Each table is split into chunks of
+    BACKFILL_CHUNK_KEYS primary keys; the plan is stored at
+    backfill/<last_checked>/plan.json.
+
+    Planning again before the backfill has finished (e.g. after the
+    execution timed out) reuses the stored plan and only returns the
+    chunks that have no checkpoint yet, so a new execution picks up
+    where the last one stopped.
+
+    Args:
+        backfill_event (dict): {"action": "plan", "tables": [...]}, tables
+        defaults to every table
+        ssm_client: boto3 ssm client
+        sm_client: boto3 secretsmanager client
+        s3_client: boto3 s3 client
+        ingestion_bucket (str): name of the ingestion bucket
+
+    Returns:
+        dict {"backfill_id": "2025-06-10 09:15:00.000000", "as_of": "...",
+              "chunks": [{"backfill": {"action": "chunk", "backfill_id": "...",
+                                       "table": "sales_order", "part": 0,
+                                       "key_range": [1, 250000]}}, ...]}
+        every chunk is the event for one extract_backfill_chunk invocation
+    """
+    last_checked = get_last_checked(ssm_client)["last_checked"]
+    plan = get_backfill_plan(s3_client, ingestion_bucket, last_checked)
+    if plan is None:
+        tables = backfill_event.get("tables") or BACKFILL_TABLES
+        extract_config = get_extract_config()
+        _, db_conn = get_db_connection(sm_client)
+        as_of = db_conn.run("SELECT localtimestamp")[0][0].strftime("%Y-%m-%d %H:%M:%S.%f")
+        chunk_keys = get_backfill_chunk_keys()
+        chunks = []
+        for table in tables:
+            if table in FULL_SCAN_TABLES:
+                chunks.append({"table": table, "part": 0, "key_range": None})
+                continue
+            first_key, last_key = get_primary_key_range(table, last_checked, db_conn, until=as_of)
+            if first_key is None:
+                continue
+            partitions = -(-(last_key - first_key + 1) // chunk_keys)
+            for part, key_range in enumerate(split_key_range(first_key, last_key, partitions)):
+                chunks.append({"table": table, "part": part, "key_range": list(key_range)})
+        if get_cache_ttl() <= 0:
+            db_conn.close()
+        plan = {"backfill_id": last_checked, "since": last_checked, "as_of": as_of, "tables": tables,
+                "format": extract_config["format"], "chunks": chunks}
+        upload_backfill_object(s3_client, ingestion_bucket, backfill_key(last_checked, "plan.json"), plan)
+        logger.info(f"planned backfill {last_checked} up to {as_of}: {len(chunks)} chunks")
+
+    done = list_backfill_checkpoints(s3_client, ingestion_bucket, plan["backfill_id"])
+    pending = [chunk for chunk in plan["chunks"] if (chunk["table"], chunk["part"]) not in done]
+    logger.info(f"backfill {plan['backfill_id']}: {len(pending)} of {len(plan['chunks'])} chunks to extract")
+    return {"backfill_id": plan["backfill_id"], "as_of": plan["as_of"],
+            "chunks": [{"backfill": {"action": "chunk", "backfill_id": plan["backfill_id"], **chunk}}
+                       for chunk in pending]}
+
+
+def extract_backfill_chunk(backfill_event, sm_client, s3_client, ingestion_bucket):
+    """
+    Summary:
+    Extract one chunk of a backfill plan to
+    <table>/<backfill_id>/part-<part>.<format> and record a checkpoint
+    with its result. A chunk that already has a checkpoint is skipped, so
+    retrying the chunk, or the whole execution, never extracts it twice.
+    A full scan table's checkpoint also holds the fingerprint of the
+    content it extracted, read in the same transaction, for finish_backfill.
+    Errors are raised for the state machine to retry.
+
+    Args:
+        backfill_event (dict): one chunk returned by plan_backfill
+        sm_client: boto3 secretsmanager client
+        s3_client: boto3 s3 client
+        ingestion_bucket (str): name of the ingestion bucket
+
+    Returns:
+        dict {"table": "sales_order", "part": 0, "row_count": 10, "skipped": False}
+    """
+    table, part = backfill_event["table"], backfill_event["part"]
+    checkpoint_key = backfill_key(backfill_event["backfill_id"], f"checkpoints/{table}/part-{part:05d}.json")
+    try:
+        s3_client.head_object(Bucket=ingestion_bucket, Key=checkpoint_key)
+        logger.info(f"backfill chunk {table} part {part} already extracted, skipping")
+        return {"table": table, "part": part, "row_count": None, "skipped": True}
+    except ClientError:
+        pass
+
+    plan = get_backfill_plan(s3_client, ingestion_bucket, backfill_event["backfill_id"])
+    extract_config = {**get_extract_config(), "format": plan["format"]}
+    key_range = tuple(backfill_event["key_range"]) if backfill_event["key_range"] else None
+    _, db_conn = get_db_connection(sm_client)
+    try:
+        # stream mode needs a transaction for its cursor
+        db_conn.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        result = extract_table_to_s3(table, plan["backfill_id"], db_conn, s3_client, ingestion_bucket,
+                                     extract_config, key_range=key_range, part=part,
+                                     watermark=plan["since"], until=plan["as_of"])
+        if table in FULL_SCAN_TABLES:
+            result["fingerprint"] = probe_table_changes([table], db_conn)[table]["fingerprint"]
+        db_conn.run("COMMIT")
+    except Exception as error:
+        logger.error(f"extract_backfill_chunk: {table} part {part} failed: {str(error)}")
+        db_conn.run("ROLLBACK")
+        raise error
+    finally:
+        if get_cache_ttl() <= 0:
+            db_conn.close()
+
+    upload_backfill_object(s3_client, ingestion_bucket, checkpoint_key, {**result, "part": part})
+    logger.info(f"backfill chunk {table} part {part}: {result['row_count']} rows")
+    return {"table": table, "part": part, "row_count": result["row_count"], "skipped": False}
+
+
+def finish_backfill(backfill_event, ssm_client, s3_client, ingestion_bucket):
+    """
+    Summary:
+    Close a backfill once every chunk has a checkpoint: write one batch
+    manifest with all the part files, move the watermark of every table
+    and last_checked up to the plan's as_of, store the fingerprints of the
+    full scan tables extracted (so the next normal run does not extract
+    them again only to store one), and return the same payload as a
+    normal extract so Transform and Load can follow.
+
+    Raises an error if a chunk is missing (run the backfill again to
+    resume it) or if last_checked moved since the plan was made.
+
+    Args:
+        backfill_event (dict): {"action": "finish", "backfill_id": "..."}
+        ssm_client: boto3 ssm client
+        s3_client: boto3 s3 client
+        ingestion_bucket (str): name of the ingestion bucket
+
+    Returns:
+        dict, see lambda_handler
+    """
+    plan = get_backfill_plan(s3_client, ingestion_bucket, backfill_event["backfill_id"])
+    if plan is None:
+        raise ValueError(f"finish_backfill: no backfill plan for {backfill_event['backfill_id']}")
+    if get_last_checked(ssm_client)["last_checked"] != plan["since"]:
+        raise RuntimeError(f"finish_backfill: last_checked moved since backfill {plan['backfill_id']} was planned")
+
+    done = list_backfill_checkpoints(s3_client, ingestion_bucket, plan["backfill_id"])
+    missing = [chunk for chunk in plan["chunks"] if (chunk["table"], chunk["part"]) not in done]
+    if missing:
+        raise RuntimeError(f"finish_backfill: {len(missing)} chunks of backfill {plan['backfill_id']} "
+                           f"have not been extracted")
+
+    task_results = []
+    for chunk in plan["chunks"]:
+        checkpoint_key = done[(chunk["table"], chunk["part"])]
+        response = s3_client.get_object(Bucket=ingestion_bucket, Key=checkpoint_key)
+        task_results.append(json.loads(response["Body"].read()))
+    results = combine_task_results(task_results)
+    changed_tables = [result["table"] for result in results if result["row_count"]]
+
+    extract_state = get_extract_state(ssm_client)
+    previous_manifest = get_manifest(s3_client, ingestion_bucket, extract_state.get("manifest_key"))
+    table_changes = {table: {"max_last_updated": plan["as_of"]} for table in plan["tables"]}
+    manifest = build_batch_manifest(plan["backfill_id"], plan["format"], results, table_changes, previous_manifest)
+    manifest_key = upload_manifest(s3_client, ingestion_bucket, manifest)
+    logger.info(f"backfill manifest written to s3://{ingestion_bucket}/{manifest_key}")
+
+    # every table was read up to as_of, with or without rows; full scan
+    # tables store the fingerprint of the content their chunk extracted
+    watermarks = dict(extract_state.get("watermarks", {}))
+    for table in plan["tables"]:
+        if table not in FULL_SCAN_TABLES:
+            watermarks[table] = plan["as_of"]
+    fingerprints = dict(extract_state.get("fingerprints", {}))
+    for task_result in task_results:
+        if "fingerprint" in task_result:
+            fingerprints[task_result["table"]] = task_result["fingerprint"]
+    extract_state = {**extract_state, "watermarks": watermarks, "fingerprints": fingerprints,
+                     "manifest_key": manifest_key}
+    update_extract_state(ssm_client, extract_state)
+    new_time = update_last_checked(ssm_client, plan["as_of"])
+    logger.info(f"backfill {plan['backfill_id']} finished, last checked time updated: {new_time}")
+
+    return {"message": "success", "timestamp_to_transform": plan["backfill_id"],
+            "ingestion_format": plan["format"], "changed_tables": changed_tables,
+            "failed_tables": [], "manifest_key": manifest_key}
+
+
+def backfill_key(backfill_id, name):
+    """
+    Summary : key of a backfill object, backfill/<backfill_id>/<name>
+    """
+    return f"backfill/{backfill_id}/{name}"
+
+
+def upload_backfill_object(s3_client, ingestion_bucket, key, body):
+    """
+    Summary : write a backfill plan or checkpoint as json.
+    """
+    try:
+        s3_client.put_object(Bucket=ingestion_bucket, Key=key, Body=json.dumps(body).encode("utf-8"),
+                             ContentType="application/json")
+    except ClientError as error:
+        logger.error(f"upload_backfill_object: There has been an error writing {key}: {str(error)}")
+        raise error
+
+
+def get_backfill_plan(s3_client, ingestion_bucket, backfill_id):
+    """
+    Summary : read the plan written by plan_backfill.
+
+    Returns:
+        dict, or None if this backfill has not been planned
+    """
+    try:
+        response = s3_client.get_object(Bucket=ingestion_bucket, Key=backfill_key(backfill_id, "plan.json"))
+        return json.loads(response["Body"].read())
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        logger.error(f"get_backfill_plan: There has been an error reading plan {backfill_id}: {str(error)}")
+        raise error
+
+
+def list_backfill_checkpoints(s3_client, ingestion_bucket, backfill_id):
+    """
+    Summary : find the chunks of a backfill that have been extracted.
+
+    Returns:
+        dict {("sales_order", 0): "backfill/<backfill_id>/checkpoints/sales_order/part-00000.json", ...}
+    """
+    prefix = backfill_key(backfill_id, "checkpoints/")
+    done = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=ingestion_bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            table, name = item["Key"][len(prefix):].split("/", 1)
+            done[(table, int(name[len("part-"):-len(".json")]))] = item["Key"]
+    return done
+
+
+def update_last_checked(ssm_client, new_last_checked=None):
+    """
+    Summary:
+    Initialise ssm_client using boto3.client("ssm")
+    Use AWS parameter store to access/update the 'last_checked' parameter
+    Use .put_parameter method to update (using Overwrite=TRUE) 
+    the last_checked time each time extract_lambda_handler is run.
+
+    new_last_checked should be the database snapshot time from
+    open_export_snapshot; the Lambda clock is only used as a fallback.
+            
+    """
+
+    now = new_last_checked or str(datetime.now())
+
+    try:
+        ssm_client.put_parameter(
+            Name = "last_checked",
+            Value = now,
+            Description='Timestamp of each Lambda execution',
+            Type="String",
+            Overwrite=True
+        )
+        return now
+    except Exception as e:
+        logger.error(f"There has been an error: {str(e)}")
+        raise e
+    
+
+
+    
+def get_bucket_name(): #completed with tests
+    """
+    Summary : this function should obtain the ingestion bucket name from the
+    environment variables and return it.
+    
+    
+    Returns:
+    dict {"ingestion_bucket" : "funland-ingestion-bucket-......."}
+    
+    """
+
+    bucket_name = os.environ.get("S3_INGESTION_BUCKET")
+    return {"ingestion_bucket":f'{bucket_name}'}
+
+
+def get_extract_config():
+    """
+    Summary : read the extract settings from the environment variables.
+
+    EXTRACT_MODE is "batch" (default, whole table in memory) or "stream"
+    (server-side cursor, chunks uploaded as multipart parts).
+    EXTRACT_CHUNK_SIZE is the number of rows fetched per chunk in stream mode.
+    EXTRACT_POOL_SIZE is the number of tables extracted at the same time,
+    each on its own database connection. 1 (default) keeps the sequential
+    single connection extract.
+    INGESTION_FORMAT is the file format written to the ingestion bucket:
+    "csv" (default), "parquet" or "arrow" (Arrow IPC). parquet and arrow
+    keep the column types, so transform does not have to re-infer them.
+    EXTRACT_PARTITIONS splits big tables into primary key ranges that are
+    extracted as separate part files, e.g. "sales_order=4,transaction=4".
+    The ranges only run in parallel when EXTRACT_POOL_SIZE > 1.
+    EXTRACT_ENGINE is how rows leave the database: "select" (default, rows
+    come back as Python values) or "copy" (COPY ... TO STDOUT, the CSV bytes
+    go straight to S3; only with INGESTION_FORMAT csv) or "cdc" (every table
+    is read from a logical replication slot, see run_cdc_extract).
+    EXTRACT_ENGINES overrides select / copy per table, e.g.
+    "sales_order=copy,transaction=copy".
+    EXTRACT_FULL_FIDELITY "true" reads every column (SELECT *) to keep full
+    archive copies; by default only the COLUMN_REGISTRY columns are read.
+    INGESTION_CODEC is the compression of the ingestion files, "name" or
+    "name:level" (see INGESTION_CODECS for what each format supports, the
+    default is none for csv, snappy for parquet and zstd for arrow).
+    INGESTION_CODECS overrides it per table, e.g. "sales_order=zstd:9".
+    EXTRACT_ROW_BUDGET is the most new rows read for a table in one task;
+    bigger windows are split into sub-windows (0, the default, never splits).
+    EXTRACT_MAX_WINDOWS caps the sub-windows of a table extracted per run,
+    the rest wait for the next runs (0, the default, extracts them all).
+    SCHEMA_DRIFT is what a difference between SOURCE_SCHEMA and the
+    database does: "warn" (default, logged), "fail" (the run stops) or
+    "off" (not checked).
+
+    Returns:
+    dict {"mode": "batch", "chunk_size": 50000, "pool_size": 1, "format": "csv",
+          "partitions": {"sales_order": 4}, "engine": "select", "engines": {"sales_order": "copy"},
+          "full_fidelity": False, "codec": {"name": "none", "level": None},
+          "codecs": {"sales_order": {"name": "zstd", "level": 9}},
+          "row_budget": 0, "max_windows": 0, "schema_drift": "warn"}
+    """
+    ingestion_format = os.environ.get("INGESTION_FORMAT", "csv")
+    if ingestion_format not in ["csv", "parquet", "arrow"]:
+        raise ValueError(f"get_extract_config: unsupported INGESTION_FORMAT {ingestion_format}")
+
+    engine = os.environ.get("EXTRACT_ENGINE", "select")
+    engines = parse_table_settings(os.environ.get("EXTRACT_ENGINES", ""))
+    if engine not in ["select", "copy", "cdc"]:
+        raise ValueError(f"get_extract_config: unsupported extract engine {engine}")
+    for table_engine in engines.values():
+        if table_engine not in ["select", "copy"]:
+            raise ValueError(f"get_extract_config: unsupported per table extract engine {table_engine}")
+    for table_engine in [engine, *engines.values()]:
+        if table_engine == "copy" and ingestion_format != "csv":
+            raise ValueError(f"get_extract_config: the copy engine only writes csv, not {ingestion_format}")
+
+    mode = os.environ.get("EXTRACT_MODE", "batch")
+    if mode not in ["batch", "stream"]:
+        raise ValueError(f"get_extract_config: unsupported EXTRACT_MODE {mode}")
+    chunk_size = int(os.environ.get("EXTRACT_CHUNK_SIZE", "50000"))
+    if chunk_size < 1:
+        # FETCH FORWARD 0 returns no rows, the table would be written empty and its watermark moved on
+        raise ValueError(f"get_extract_config: EXTRACT_CHUNK_SIZE must be at least 1, not {chunk_size}")
+
+    schema_drift = os.environ.get("SCHEMA_DRIFT", "warn")
+    if schema_drift not in ["warn", "fail", "off"]:
+        raise ValueError(f"get_extract_config: unsupported SCHEMA_DRIFT {schema_drift}")
+
+    codec = parse_codec(os.environ.get("INGESTION_CODEC") or INGESTION_CODECS[ingestion_format][0])
+    codecs = parse_table_settings(os.environ.get("INGESTION_CODECS", ""), parse_codec)
+    for table_codec in [codec, *codecs.values()]:
+        if table_codec["name"] not in INGESTION_CODECS[ingestion_format]:
+            raise ValueError(f"get_extract_config: {ingestion_format} files cannot use the {table_codec['name']} codec")
+
+    return {
+        "mode": mode,
+        "chunk_size": chunk_size,
+        "pool_size": max(1, int(os.environ.get("EXTRACT_POOL_SIZE", "1"))),
+        "format": ingestion_format,
+        "partitions": parse_table_settings(os.environ.get("EXTRACT_PARTITIONS", ""), int),
+        "engine": engine,
+        "engines": engines,
+        "full_fidelity": os.environ.get("EXTRACT_FULL_FIDELITY", "false").lower() == "true",
+        "codec": codec,
+        "codecs": codecs,
+        "row_budget": max(0, int(os.environ.get("EXTRACT_ROW_BUDGET", "0"))),
+        "max_windows": max(0, int(os.environ.get("EXTRACT_MAX_WINDOWS", "0"))),
+        "schema_drift": schema_drift,
+    }
+
+
+def get_table_codec(table_name, extract_config):
+    """
+    Summary : the compression codec of a table's ingestion files.
+    """
+    default = extract_config.get("codec") or parse_codec(INGESTION_CODECS[extract_config["format"]][0])
+    return extract_config.get("codecs", {}).get(table_name, default)
+
+
+def get_table_columns(table_name, extract_config):
+    """
+    Summary : the columns extract selects for a table, None for all of them
+    (full fidelity, or a table missing from COLUMN_REGISTRY).
+    """
+    if extract_config.get("full_fidelity", False):
+        return None
+    return COLUMN_REGISTRY.get(table_name)
+
+
+def get_table_engine(table_name, extract_config):
+    """
+    Summary : the extract engine ("select" or "copy") used for a table.
+    """
+    return extract_config.get("engines", {}).get(table_name, extract_config.get("engine", "select"))
+
+
+def parse_table_settings(setting, convert=str):
+    """
+    Summary : parse a "table=value,table=value" environment setting into a
+    dictionary, converting every value with `convert`.
+
+    Returns:
+    dict {"sales_order": 4, "transaction": 4}
+    """
+
+    settings = {}
+    for item in setting.split(","):
+        if item.strip():
+            table, value = item.split("=", 1)
+            settings[table.strip()] = convert(value.strip())
+    return settings
 
     
\ No newline at end of file
@@ -1,18 +1,82 @@
+import time
+MODULE_LOAD_START = time.perf_counter()
 import logging
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timezone
-import pandas as pd
-import awswrangler as wr
 import botocore.exceptions
+import io
 import json
 import os
+import resource
+import threading
+# pandas, awswrangler and pyarrow are imported by the builders once they
+# know their table has rows, so an empty batch never pays for loading them
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# seconds spent importing this module, reported on a cold start
+IMPORT_SECONDS = time.perf_counter() - MODULE_LOAD_START
+# True until the first invocation in this container
+COLD_START = True
+# boto3 clients are created once per container and reused while it stays warm
+AWS_CLIENTS = {}
+# ingestion objects of this run per (bucket, table), {"objects": [...], "keys": {...}}, see build_key_index
+KEY_INDEX = {}
+# source tables the builders read, listed into KEY_INDEX when there is no batch manifest
+INGESTION_TABLES = ["sales_order", "currency", "address", "design", "staff", "department", "counterparty"]
+# dimension source tables kept as compacted current-state snapshots, see update_snapshots
+SNAPSHOT_TABLES = ["address", "department", "counterparty", "staff", "currency", "design"]
+# S3 calls and bytes of this process, and of every thread, counted by install_s3_meter
+S3_METER = {"s3_requests": 0, "bytes_read": 0, "bytes_written": 0}
+S3_METER_LOCK = threading.Lock()
+S3_THREAD_METER = threading.local()
+# the table_timer record of the output table each thread is building
+CURRENT_TABLE = threading.local()
+# type of every column of the 11 totesys tables, csv ingestion files are
+# read with it instead of letting pandas infer the types. A copy of
+# SOURCE_SCHEMA in extract.py (each lambda is a single file), change both together.
+SOURCE_SCHEMA = {
+    "address": {"address_id": "int", "address_line_1": "str", "address_line_2": "str", "district": "str",
+                "city": "str", "postal_code": "str", "country": "str", "phone": "str",
+                "created_at": "timestamp", "last_updated": "timestamp"},
+    "counterparty": {"counterparty_id": "int", "counterparty_legal_name": "str", "legal_address_id": "int",
+                     "commercial_contact": "str", "delivery_contact": "str",
+                     "created_at": "timestamp", "last_updated": "timestamp"},
+    "currency": {"currency_id": "int", "currency_code": "str", "created_at": "timestamp", "last_updated": "timestamp"},
+    "department": {"department_id": "int", "department_name": "str", "location": "str", "manager": "str",
+                   "created_at": "timestamp", "last_updated": "timestamp"},
+    "design": {"design_id": "int", "created_at": "timestamp", "design_name": "str", "file_location": "str",
+               "file_name": "str", "last_updated": "timestamp"},
+    "payment_type": {"payment_type_id": "int", "payment_type_name": "str",
+                     "created_at": "timestamp", "last_updated": "timestamp"},
+    "staff": {"staff_id": "int", "first_name": "str", "last_name": "str", "department_id": "int",
+              "email_address": "str", "created_at": "timestamp", "last_updated": "timestamp"},
+    "sales_order": {"sales_order_id": "int", "created_at": "timestamp", "last_updated": "timestamp",
+                    "design_id": "int", "staff_id": "int", "counterparty_id": "int", "units_sold": "int",
+                    "unit_price": "decimal(10,2)", "currency_id": "int", "agreed_delivery_date": "str",
+                    "agreed_payment_date": "str", "agreed_delivery_location_id": "int"},
+    "purchase_order": {"purchase_order_id": "int", "created_at": "timestamp", "last_updated": "timestamp",
+                       "staff_id": "int", "counterparty_id": "int", "item_code": "str", "item_quantity": "int",
+                       "item_unit_price": "decimal(10,2)", "currency_id": "int", "agreed_delivery_date": "str",
+                       "agreed_payment_date": "str", "agreed_delivery_location_id": "int"},
+    "transaction": {"transaction_id": "int", "transaction_type": "str", "sales_order_id": "int",
+                    "purchase_order_id": "int", "created_at": "timestamp", "last_updated": "timestamp"},
+    "payment": {"payment_id": "int", "created_at": "timestamp", "last_updated": "timestamp",
+                "transaction_id": "int", "counterparty_id": "int", "payment_amount": "decimal(10,2)",
+                "currency_id": "int", "payment_type_id": "int", "paid": "bool", "payment_date": "str",
+                "company_ac_number": "int", "counterparty_ac_number": "int"},
+}
+# CloudWatch unit of every metric emit_metrics writes
+METRIC_UNITS = {"seconds": "Seconds", "rows_in": "Count", "rows_out": "Count", "rows_per_second": "Count/Second",
+                "bytes_read": "Bytes", "bytes_written": "Bytes", "s3_requests": "Count",
+                "peak_memory_mb": "Megabytes"}
+
 def lambda_handler(event, context):
     """Summary:
     This function will utilise the helper function below. The files will be read from the ingestion bucket (if there are any new ones), and the necessary transformations will be done.
@@ -26,41 +90,373 @@ def lambda_handler(event, context):
         dict: which contains the last_checked/filemarker to mark the files to be picked and loaded to the warehouse.
     """
 
-    # Extract marker from event
+    global COLD_START
+    cold_start, COLD_START = COLD_START, False
+    timings = {}
+    metrics = new_run_metrics()
+    install_s3_meter()
+
+    # Extract marker and ingestion file format from event
     last_checked = event['myresult']['timestamp_to_transform']
+    ingestion_format = event['myresult'].get('ingestion_format', 'csv')
+    manifest_key = event['myresult'].get('manifest_key')
     
     # Get S3 bucket names from environment
     ingestion_bucket = os.getenv('S3_INGESTION_BUCKET')
     processed_bucket = os.getenv('S3_PROCESSED_BUCKET')
     
-    # Initialize S3 client with config
-    my_config = Config(
-        region_name = 'eu-west-2'
-    )
-    s3_client = boto3.client('s3', config = my_config)
-    
-    # Apply transformations for each table
-    fact_sales_order(last_checked, ingestion_bucket, processed_bucket)
-    dim_currency(last_checked, ingestion_bucket, processed_bucket)
-    dim_location(last_checked, ingestion_bucket, processed_bucket)
-    dim_design(last_checked, ingestion_bucket, processed_bucket)
-    dim_staff(last_checked, ingestion_bucket, processed_bucket)
-    dim_counterparty(last_checked, ingestion_bucket, processed_bucket, s3_client)
-    
+    # Initialize S3 client with config (once per container)
+    with stage_timer(timings, "clients", metrics):
+        s3_client = get_s3_client()
+
+    # the batch manifest lists every ingestion file, so no per-table probes are needed
+    with stage_timer(timings, "manifest", metrics):
+        manifest = get_batch_manifest(s3_client, ingestion_bucket, manifest_key)
+        KEY_INDEX.clear()
+        if manifest is None:
+            # without one, list the tables once and answer every lookup from that listing
+            build_key_index(s3_client, ingestion_bucket, INGESTION_TABLES)
     
+    # Apply transformations for each table, the builders do not depend on each other
+    builders = {
+        "fact_sales_order": lambda: fact_sales_order(last_checked, ingestion_bucket, processed_bucket,
+                                                     ingestion_format, manifest),
+        "dim_currency": lambda: dim_currency(last_checked, ingestion_bucket, processed_bucket, ingestion_format,
+                                             manifest),
+        "dim_location": lambda: dim_location(last_checked, ingestion_bucket, processed_bucket, ingestion_format,
+                                             manifest),
+        "dim_design": lambda: dim_design(last_checked, ingestion_bucket, processed_bucket, ingestion_format,
+                                         manifest),
+        "dim_staff": lambda: dim_staff(last_checked, ingestion_bucket, processed_bucket, ingestion_format, manifest,
+                                       snapshot_changes),
+        "dim_counterparty": lambda: dim_counterparty(last_checked, ingestion_bucket, processed_bucket, s3_client,
+                                                     ingestion_format, manifest, snapshot_changes),
+    }
     # Only create dim_date if run within a certain window
-    if datetime.now() < datetime(2025, 6, 11, 10, 50, 00): # manually alter this so the time on the right is 10 mins after current time
-        dim_date(last_checked = last_checked, processed_bucket = processed_bucket, start='2020-01-01', end='2030-12-31')
+    # manually alter this so the time on the right is 10 mins after current time
+    if datetime.now() < datetime(2025, 6, 11, 10, 50, 00):
+        builders["dim_date"] = lambda: dim_date(last_checked = last_checked, processed_bucket = processed_bucket,
+                                                start='2020-01-01', end='2030-12-31')
+
+    # merge this batch into the current state of every dimension source table before the joins read it
+    with stage_timer(timings, "snapshots", metrics):
+        snapshot_changes = update_snapshots(s3_client, ingestion_bucket, last_checked, ingestion_format, manifest)
+
+    transform_config = get_transform_config()
+    with stage_timer(timings, "transform", metrics) as transform_stage:
+        results = run_builders(builders, metrics, transform_config)
+        for name in ["rows_in", "rows_out"]:
+            transform_stage[name] = sum(table[name] for table in metrics["tables"].values())
+    KEY_INDEX.clear()
+
+    startup = startup_report(cold_start, timings)
+    logger.info(f"startup report: {startup}")
+    emit_metrics("transform", metrics)
+
+    failed_tables = {result["table"]: result["error"] for result in results if "error" in result}
+    if failed_tables:
+        # every other builder has written its table, a retry rewrites them under the same keys
+        raise RuntimeError(f"transform failed for {sorted(failed_tables)}: {failed_tables}")
 
     # Return result for downstream steps    
     return {
         "statusCode": 200,
         "timestamp_to_transform": last_checked,
-        "message": "Transformation complete. Files are in the processed S3 bucket."
+        "message": "Transformation complete. Files are in the processed S3 bucket.",
+        "startup": startup,
+        "metrics": metrics,
+        "builders": {result["table"]: result["result"] for result in results}
         }    
+
+
+def get_transform_config():
+    """
+    Summary : read the transform settings from the environment variables.
+
+    TRANSFORM_POOL_SIZE is the number of builders run at the same time on a
+    thread pool (they mostly wait on S3). 1 (default) runs them one after
+    another.
+    TRANSFORM_FAIL_FAST "true" stops starting builders after the first one
+    fails; by default every builder runs and the failures are reported
+    together at the end.
+
+    Returns:
+        dict {"pool_size": 1, "fail_fast": False}
+    """
+    return {
+        "pool_size": max(1, int(os.environ.get("TRANSFORM_POOL_SIZE", "1"))),
+        "fail_fast": os.environ.get("TRANSFORM_FAIL_FAST", "false").lower() == "true",
+    }
+
+
+def run_builders(builders, metrics, transform_config):
+    """
+    Summary:
+    Run the output table builders, on a thread pool of
+    transform_config["pool_size"] workers when it is above 1. Each builder
+    is measured with table_timer, and an exception in one builder is
+    caught and returned with its table instead of stopping the others
+    (unless fail_fast is set, then builders not started yet are skipped).
+
+    Args:
+        builders (dict): {output table: function building it}
+        metrics (dict): output of new_run_metrics
+        transform_config (dict): output of get_transform_config
+
+    Returns:
+        list of dicts in the order of builders, {"table": "dim_staff", "result": ...}
+        or {"table": "dim_staff", "error": "..."}; skipped builders are left out
+    """
+    def run_builder(table):
+        with table_timer(metrics, table):
+            try:
+                return {"table": table, "result": builders[table]()}
+            except Exception as error:
+                logger.error(f"run_builders: {table} failed: {str(error)}")
+                return {"table": table, "error": str(error)}
+
+    results = {}
+    pool_size = min(transform_config["pool_size"], len(builders))
+    if pool_size <= 1:
+        for table in builders:
+            results[table] = run_builder(table)
+            if "error" in results[table] and transform_config["fail_fast"]:
+                break
+    else:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            futures = [executor.submit(run_builder, table) for table in builders]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result["table"]] = result
+                if "error" in result and transform_config["fail_fast"]:
+                    for pending in futures:
+                        pending.cancel()
+    return [results[table] for table in builders if table in results]
+
+
+def get_s3_client():
+    """
+    Summary:
+    Return the S3 client of this container, creating it on the first call
+    only. Creating a client loads the service model and builds a session,
+    which is a noticeable part of a cold start. Every S3 call of transform
+    goes through it, and its connection pool is sized for the builders
+    running at the same time.
+
+    Returns:
+        boto3 s3 client
+    """
+    if "s3" not in AWS_CLIENTS:
+        my_config = Config(
+            region_name = 'eu-west-2',
+            max_pool_connections = 50
+        )
+        AWS_CLIENTS["s3"] = boto3.client('s3', config = my_config)
+    return AWS_CLIENTS["s3"]
+
+
+@contextmanager
+def stage_timer(timings, stage, metrics=None):
+    """
+    Summary:
+    Time the block it wraps and store the seconds under timings[stage],
+    and with the run's metrics the whole measure() record of the stage
+    under metrics["stages"][stage].
+    """
+    record = {}
+    try:
+        with measure() as record:
+            yield record
+    finally:
+        # measure() fills in the seconds when its block exits, one clock for both
+        timings[stage] = record.get("seconds")
+        if metrics is not None:
+            metrics["stages"][stage] = record
+
+
+def new_run_metrics():
+    """
+    Summary : the metrics of one invocation, one record per stage and per table.
+    """
+    return {"stages": {}, "tables": {}}
+
+
+@contextmanager
+def measure(per_thread=False):
+    """
+    Summary:
+    Measure the block it wraps. The record yielded is filled in when the
+    block ends with its duration, the S3 requests and bytes read and
+    written (see install_s3_meter) and the peak memory of the process so
+    far. per_thread only counts the S3 calls made by this thread.
+
+    Yields:
+        dict {"rows_in": 0, "rows_out": 0} the block can update, then
+        {"rows_in": 10, "rows_out": 10, "seconds": 0.52, "s3_requests": 3,
+         "bytes_read": 0, "bytes_written": 2048, "peak_memory_mb": 210.5}
+    """
+    start = time.perf_counter()
+    s3_start = read_s3_meter(per_thread)
+    record = {"rows_in": 0, "rows_out": 0}
+    try:
+        yield record
+    finally:
+        s3_end = read_s3_meter(per_thread)
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        for name, value in s3_end.items():
+            record[name] = value - s3_start[name]
+        record["peak_memory_mb"] = peak_memory_mb()
+
+
+def peak_memory_mb():
+    """
+    Summary : the most memory (RSS) this process has used, in MiB.
+    """
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def install_s3_meter():
+    """
+    Summary:
+    Count the S3 calls and bytes of every client of the default boto3
+    session (boto3.client and awswrangler both use it). Clients copy the
+    hooks when they are created, so call this before get_s3_client.
+    """
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    session = boto3.DEFAULT_SESSION
+    if getattr(session, "s3_meter_installed", False):
+        return
+    session.events.register("before-call.s3", count_s3_request)
+    session.events.register("after-call.s3.GetObject", count_s3_bytes_read)
+    session.events.register("before-parameter-build.s3.PutObject", count_s3_bytes_written)
+    session.events.register("before-parameter-build.s3.UploadPart", count_s3_bytes_written)
+    session.s3_meter_installed = True
+
+
+def add_to_s3_meter(name, amount):
+    """
+    Summary : add to the process wide and to this thread's S3 counters.
+    """
+    with S3_METER_LOCK:
+        S3_METER[name] += amount
+    setattr(S3_THREAD_METER, name, getattr(S3_THREAD_METER, name, 0) + amount)
+
+
+def read_s3_meter(per_thread=False):
+    """
+    Summary : current S3 counters of the process, or of this thread.
+
+    Returns:
+        dict {"s3_requests": 12, "bytes_read": 0, "bytes_written": 4096}
+    """
+    if per_thread:
+        return {name: getattr(S3_THREAD_METER, name, 0) for name in S3_METER}
+    with S3_METER_LOCK:
+        return dict(S3_METER)
+
+
+def count_s3_request(**kwargs):
+    add_to_s3_meter("s3_requests", 1)
+
+
+def count_s3_bytes_read(parsed=None, **kwargs):
+    add_to_s3_meter("bytes_read", (parsed or {}).get("ContentLength") or 0)
+
+
+def count_s3_bytes_written(params=None, **kwargs):
+    body = (params or {}).get("Body")
+    if isinstance(body, (bytes, bytearray, memoryview, str)):
+        size = len(body)
+    else:
+        try:
+            position = body.tell()
+            size = body.seek(0, 2) - position
+            body.seek(position)
+        except Exception:
+            size = 0
+    add_to_s3_meter("bytes_written", size)
+
+
+def emit_metrics(function_name, metrics):
+    """
+    Summary:
+    Print every stage and output table record as a CloudWatch Embedded
+    Metric Format line (namespace METRICS_NAMESPACE, default funland-etl),
+    the same format extract uses.
+
+    Args:
+        function_name (str): "transform"
+        metrics (dict): from new_run_metrics
+    """
+    namespace = os.environ.get("METRICS_NAMESPACE", "funland-etl")
+    timestamp = int(time.time() * 1000)
+    for dimension, records in [("Stage", metrics["stages"]), ("Table", metrics["tables"])]:
+        for name, record in records.items():
+            values = {metric: record.get(metric, 0) for metric in METRIC_UNITS if metric != "rows_per_second"}
+            values["rows_per_second"] = round(values["rows_out"] / values["seconds"], 1) if values["seconds"] else 0.0
+            print(json.dumps({
+                "_aws": {"Timestamp": timestamp,
+                         "CloudWatchMetrics": [{"Namespace": namespace, "Dimensions": [["Function", dimension]],
+                                                "Metrics": [{"Name": metric, "Unit": unit}
+                                                            for metric, unit in METRIC_UNITS.items()]}]},
+                "Function": function_name, dimension: name, **values}))
+
+
+@contextmanager
+def table_timer(metrics, table):
+    """
+    Summary:
+    Measure the builder of one output table into metrics["tables"][table].
+    read_ingestion_files and write_processed_parquet add the rows they read
+    and write to the table being built on their thread.
+    """
+    with measure(per_thread=True) as record:
+        CURRENT_TABLE.record = record
+        try:
+            yield record
+        finally:
+            CURRENT_TABLE.record = None
+            metrics["tables"][table] = record
+
+
+def count_table_rows(name, rows):
+    """
+    Summary : add rows to "rows_in" or "rows_out" of the table being built.
+    """
+    record = getattr(CURRENT_TABLE, "record", None)
+    if record is not None:
+        record[name] += rows
+
+
+def write_processed_parquet(df, path, table):
+    """
+    Summary:
+    Write an output table to the processed bucket as parquet, with the
+    table's compression settings (see processed_parquet_options).
+    """
+    import awswrangler as wr
+
+    wr.s3.to_parquet(df, path, **processed_parquet_options(table))
+    count_table_rows("rows_out", len(df))
+
+
+def startup_report(cold_start, timings):
+    """
+    Summary:
+    What the handler reports about its start up: whether this was the
+    first invocation in the container, how long the module imports took
+    (only paid on a cold start) and the seconds spent in every stage.
+
+    Returns:
+        dict {"cold_start": True, "import_seconds": 0.12, "stage_seconds": {"clients": 0.09, ...}}
+    """
+    return {"cold_start": cold_start,
+            "import_seconds": round(IMPORT_SECONDS, 4) if cold_start else 0.0,
+            "stage_seconds": timings}
     
 
-def dim_currency(last_checked,ingestion_bucket,processed_bucket):
+def dim_currency(last_checked,ingestion_bucket,processed_bucket, ingestion_format="csv", manifest=None):
 
     """
     We will read the csv file for the currency table from the s3 ingestion bucket using awswrangler.
@@ -72,23 +468,24 @@ def dim_currency(last_checked,ingestion_bucket,processed_bucket):
 
     Convert it to parquet file and then upload it to the processed bucket.
 
-    ARGS:ingestion_bucket,last_checked, processed_bucket
+    ARGS:ingestion_bucket,last_checked, processed_bucket, ingestion_format, manifest
     """
     
-    file_key = f"currency/{last_checked}.csv"
+    file_key = ingestion_file_key("currency", last_checked, ingestion_format)
+    file_keys = find_ingestion_keys(ingestion_bucket, "currency", last_checked, ingestion_format, manifest)
 
-    if not check_file_exists_in_ingestion_bucket(bucket=ingestion_bucket, filename=file_key):
+    if not file_keys:
         logger.info(f"File_key: '{file_key}' does not exist!")
         return 'No file found'
     
-    #reading the csv file
-    df_currency = wr.s3.read_csv(f"s3://{ingestion_bucket}/currency/{last_checked}.csv")
+    #reading the ingestion file(s)
+    df_currency = read_ingestion_files(ingestion_bucket, file_keys)
     
     #columns_currency=[currency_id, currency_code, created_at, last_updated]
     #columns_dim_currency=[currency_id, currency_code, currency_name]
 
     #dropping the columns that we dont need
-    df_dim_currency=df_currency.drop(["Unnamed: 0", "created_at", "last_updated"], axis=1)
+    df_dim_currency=df_currency.drop(["created_at", "last_updated"], axis=1, errors="ignore")
 
     #we have to add a new column(currency_name)
     df_dim_currency=df_dim_currency.assign(currency_name=lambda x: x['currency_code'] + '_Name')
@@ -96,13 +493,15 @@ def dim_currency(last_checked,ingestion_bucket,processed_bucket):
     
     #upload to s3 as a parquet file
     try:
-        wr.s3.to_parquet(df_dim_currency,f"s3://{processed_bucket}/dim_currency/{last_checked}.parquet")   #need processed bucket as a argument as well
+        #need processed bucket as a argument as well
+        write_processed_parquet(df_dim_currency, f"s3://{processed_bucket}/dim_currency/{last_checked}.parquet",
+                                "dim_currency")
         logger.info(f"dim_currency parquet has been uploaded to ingestion s3 at: s3://{processed_bucket}/currency/{last_checked}.csv")
     except botocore.exceptions.ClientError as client_error:
         logger.error(f"there has been a error in converting to parquet and uploading for dim_design {str(client_error)}")
 
 
-def dim_location(last_checked, ingestion_bucket, processed_bucket):
+def dim_location(last_checked, ingestion_bucket, processed_bucket, ingestion_format="csv", manifest=None):
     """
     Summary:
     read the csv file (as a dataframe) that was uploaded (address/<timestamp>.csv) at the extract section.
@@ -119,25 +518,27 @@ def dim_location(last_checked, ingestion_bucket, processed_bucket):
     ingestion_bucket (str): Source S3 bucket
     processed_bucket (str): Destination S3 bucket
     last_checked (str): Timestamp to locate the file
+    ingestion_format (str): csv, parquet or arrow, as written by extract
+    manifest (dict): batch manifest written by extract, if there is one
     """
 
-    file_key = f"address/{last_checked}.csv"
+    file_key = ingestion_file_key("address", last_checked, ingestion_format)
 
     try:    
-        if not check_file_exists_in_ingestion_bucket(bucket=ingestion_bucket, filename=file_key):
+        file_keys = find_ingestion_keys(ingestion_bucket, "address", last_checked, ingestion_format, manifest)
+        if not file_keys:
             logger.info(f"No file found at '{file_key}'. Skipping dim_location transformation.")
             return 'No file found'
         
-        # read address...csv file from ingestion bucket
-        file_path_s3 = f's3://{ingestion_bucket}/{file_key}' 
-        location_df = wr.s3.read_csv(file_path_s3)
+        # read address file(s) from ingestion bucket
+        location_df = read_ingestion_files(ingestion_bucket, file_keys)
         logger.info(f"File {file_key} read successfully from ingestion bucket.")
 
         #addressID to be updated to locationID 
         dim_location_col_name_df = location_df.rename(columns = {"address_id" : "location_id"})
 
         # drop unneccessery columns
-        dim_location_df = dim_location_col_name_df.drop(['Unnamed: 0', 'last_updated', "created_at"], axis=1)
+        dim_location_df = dim_location_col_name_df.drop(['last_updated', "created_at"], axis=1, errors="ignore")
         logger.info("dim_location dataframe has been created and transformed.")
 
         #change order of columns 
@@ -149,7 +550,7 @@ def dim_location(last_checked, ingestion_bucket, processed_bucket):
 
         # save to processed s3 bucket as parquet
         processed_file_key = f"dim_location/{last_checked}.parquet"
-        wr.s3.to_parquet(dim_location_df, f"s3://{processed_bucket}/{processed_file_key}")
+        write_processed_parquet(dim_location_df, f"s3://{processed_bucket}/{processed_file_key}", "dim_location")
         logger.info(f"dim_location parquet has been uploaded to s3://{processed_bucket}/{processed_file_key}")
         return('dim_location transformation and upload complete')
 
@@ -161,7 +562,7 @@ def dim_location(last_checked, ingestion_bucket, processed_bucket):
         logger.error(f"Unexpected error in dim_location transform: {str(e)}")
         raise
 
-def dim_design(last_checked, ingestion_bucket, processed_bucket):
+def dim_design(last_checked, ingestion_bucket, processed_bucket, ingestion_format="csv", manifest=None):
     """
     Summary:
     read the file (as a dataframe) that was uploaded (design/<timestamp>.csv) at the extract section  
@@ -175,32 +576,38 @@ def dim_design(last_checked, ingestion_bucket, processed_bucket):
         last_checked (str): a string which marks the files 
         that were uploaded to the ingestion bucket that we 
         need to pick out and use in this function.
+        ingestion_format (str): csv, parquet or arrow, as written by extract
+        manifest (dict): batch manifest written by extract, if there is one
     """
     
-    file_key = f"design/{last_checked}.csv"
+    file_key = ingestion_file_key("design", last_checked, ingestion_format)
+    file_keys = find_ingestion_keys(ingestion_bucket, "design", last_checked, ingestion_format, manifest)
     
-    if not check_file_exists_in_ingestion_bucket(bucket=ingestion_bucket, filename=file_key):
+    if not file_keys:
         logger.info(f"Key: '{file_key}' does not exist!")
         return 'No file found'
     
     
-    file_path_s3 = f's3://{ingestion_bucket}/{file_key}' 
-    design_df = wr.s3.read_csv(file_path_s3)
-    dim_design_df = design_df.drop(['Unnamed: 0','last_updated', "created_at"], axis=1)
+    design_df = read_ingestion_files(ingestion_bucket, file_keys)
+    dim_design_df = design_df.drop(['last_updated', "created_at"], axis=1, errors="ignore")
     logger.info("dim_design dataframe has been created")
     
     processed_file_key = f"dim_design/{last_checked}.parquet" # TODO: check the .parquet
     try:
-        wr.s3.to_parquet(dim_design_df, f"s3://{processed_bucket}/{processed_file_key}")
+        write_processed_parquet(dim_design_df, f"s3://{processed_bucket}/{processed_file_key}", "dim_design")
         logger.info(f"dim_design parquet has been uploaded to ingestion s3 at: s3://{processed_bucket}/{processed_file_key}")
     except botocore.exceptions.ClientError as client_error:
         logger.error(f"there has been a error in converting to parquet and uploading for dim_design {str(client_error)}")
         
         
-def dim_staff(last_checked, ingestion_bucket, processed_bucket):
+def dim_staff(last_checked, ingestion_bucket, processed_bucket, ingestion_format="csv", manifest=None,
+              changed_keys=None):
     """
     Summary:
     Read staff and department CSVs from S3 ingestion bucket. If either is missing, return a skip message.
+    The rows rebuilt are the staff changed in this batch and, with the
+    snapshots, the staff of the departments changed in it (see
+    select_affected_rows), so a department change reaches its staff.
     Transformations:
     - Join staff and department on department_id
     - Drop unnecessary columns:[department_id, manager, last_updated, created_at]
@@ -212,30 +619,47 @@ def dim_staff(last_checked, ingestion_bucket, processed_bucket):
         last_checked (str): Timestamp string used to locate the files
         ingestion_bucket (str): S3 source bucket
         processed_bucket (str): S3 destination bucket
+        ingestion_format (str): csv, parquet or arrow, as written by extract
+        manifest (dict): batch manifest written by extract, if there is one
+        changed_keys (dict): output of update_snapshots for this batch
     """
-    key_staff = f"staff/{last_checked}.csv"
-    key_department = f"department/{last_checked}.csv"
+    key_staff = ingestion_file_key("staff", last_checked, ingestion_format)
+    key_department = ingestion_file_key("department", last_checked, ingestion_format)
     try:
         # Check both files exist
-        if not check_file_exists_in_ingestion_bucket(bucket=ingestion_bucket, filename=key_staff):
+        staff_keys = find_ingestion_keys(ingestion_bucket, "staff", last_checked, ingestion_format, manifest)
+        changed_departments = (changed_keys or {}).get("department", [])
+        if not staff_keys and not changed_departments:
             logger.warning(f"Missing file: {key_staff}")
             return 'Missing staff file'
         # if not check_file_exists_in_ingestion_bucket(bucket=ingestion_bucket, key=key_department):
         #     logger.warning(f"Missing file: {key_department}")
         #     return 'Missing department file'
-        # Read both CSVs
-        staff_path = f"s3://{ingestion_bucket}/{key_staff}"
-        department_path = f"s3://{ingestion_bucket}/{key_department}"
-        staff_df = wr.s3.read_csv(staff_path)
-        department_df = wr.s3.read_csv(department_path)
+        # every department, from the snapshot; without one the latest copy, as department is a full scan
+        department_df = read_snapshot(ingestion_bucket, "department")
+        if department_df is None:
+            department_keys = (find_ingestion_keys(ingestion_bucket, "department", last_checked, ingestion_format,
+                                                   manifest)
+                               or find_latest_ingestion_keys(ingestion_bucket, "department", manifest))
+            if not department_keys:
+                logger.warning(f"Missing file: {key_department}")
+                return 'Missing department file'
+            department_df = read_ingestion_files(ingestion_bucket, department_keys)
+        import pandas as pd
+        # Read both files
+        staff_df = read_ingestion_files(ingestion_bucket, staff_keys) if staff_keys else None
+        staff_df = select_affected_rows(ingestion_bucket, "staff", staff_df, "department_id", changed_departments)
+        if staff_df is None or staff_df.empty:
+            logger.warning(f"Missing file: {key_staff}")
+            return 'Missing staff file'
         logger.info("Staff and department files loaded successfully.")
         # Merge on department_id
         merged_df = pd.merge(staff_df, department_df, on="department_id", how="left")
         # Drop unwanted columns
-        drop_cols = [col for col in ['Unnamed: 0_x', 'Unnamed: 0_y', 'department_id', 'manager', 
+        drop_cols = [col for col in ['department_id', 'manager', 
                                      'last_updated_x', 'last_updated_y', 'created_at_x',
                                      'created_at_y']]# if col in merged_df.columns]
-        dim_staff_df = merged_df.drop(columns=drop_cols, axis=1)
+        dim_staff_df = merged_df.drop(columns=drop_cols, errors="ignore")
         # Check for missing values in required columns
         # required_cols = ['staff_id', 'first_name', 'last_name', 'email_address']
         # if dim_staff_df[required_cols].isnull().any().any():
@@ -243,7 +667,7 @@ def dim_staff(last_checked, ingestion_bucket, processed_bucket):
         #     raise ("Null values in NOT NULL fields.")
         # Upload as parquet
         output_key = f"dim_staff/{last_checked}.parquet"
-        wr.s3.to_parquet(dim_staff_df, f"s3://{processed_bucket}/{output_key}")
+        write_processed_parquet(dim_staff_df, f"s3://{processed_bucket}/{output_key}", "dim_staff")
         logger.info(f"dim_staff uploaded successfully to s3://{processed_bucket}/{output_key}")
         return 'dim_staff transformation complete'
     except botocore.exceptions.ClientError as e:
@@ -254,38 +678,49 @@ def dim_staff(last_checked, ingestion_bucket, processed_bucket):
         raise e
 
 
-def dim_counterparty(last_checked, ingestion_bucket, processed_bucket, s3_client):
-    
-    key_counterparty = f"counterparty/{last_checked}.csv"
+def dim_counterparty(last_checked, ingestion_bucket, processed_bucket, s3_client, ingestion_format="csv", manifest=None,
+                     changed_keys=None):
+    """
+    Summary:
+    Join counterparties to their legal address. The rows rebuilt are the
+    counterparties changed in this batch and, with the snapshots, the
+    counterparties whose address changed in it (see select_affected_rows).
+    changed_keys is the output of update_snapshots for this batch.
+    """
+    key_counterparty = ingestion_file_key("counterparty", last_checked, ingestion_format)
+    counterparty_keys = find_ingestion_keys(ingestion_bucket, "counterparty", last_checked, ingestion_format, manifest)
+    changed_addresses = (changed_keys or {}).get("address", [])
 
-    if not check_file_exists_in_ingestion_bucket(bucket=ingestion_bucket, filename=key_counterparty):
+    if not counterparty_keys and not changed_addresses:
         logger.warning(f"Missing file: {key_counterparty}")
         return 'Missing staff file'
+    import pandas as pd
 
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket=ingestion_bucket, Prefix='address/')
-    address_files = response['Contents']        
-    key_address = max(address_files, key=lambda x: x['LastModified'])['Key']
-    
-
-    counterparty_path = f"s3://{ingestion_bucket}/{key_counterparty}"
-    address_path = f"s3://{ingestion_bucket}/{key_address}"
-
-    counterparty_df = wr.s3.read_csv(counterparty_path)
-    address_df = wr.s3.read_csv(address_path)
+    counterparty_df = read_ingestion_files(ingestion_bucket, counterparty_keys) if counterparty_keys else None
+    counterparty_df = select_affected_rows(ingestion_bucket, "counterparty", counterparty_df, "legal_address_id",
+                                           changed_addresses, s3_client)
+    if counterparty_df is None or counterparty_df.empty:
+        logger.warning(f"Missing file: {key_counterparty}")
+        return 'Missing staff file'
+    # every address, not only the ones in the latest address batch
+    address_df = read_snapshot(ingestion_bucket, "address", s3_client)
+    if address_df is None:
+        address_df = read_ingestion_files(ingestion_bucket,
+                                          find_latest_ingestion_keys(ingestion_bucket, "address", manifest))
     logger.info("Counterparty and address files loaded successfully.")
     
     
     counterparty_df = counterparty_df.rename(columns={"legal_address_id": "address_id"})
 
     
-    merged_df = pd.merge(counterparty_df, address_df, on='address_id', how="outer")
+    # left: the snapshot holds every address, only the counterparties' own ones are wanted
+    merged_df = pd.merge(counterparty_df, address_df, on='address_id', how="left")
     
     
-    columns=['Unnamed: 0_x', 'Unnamed: 0_y', 'commercial_contact', 'created_at_x',
+    columns=['commercial_contact', 'created_at_x',
               'delivery_contact', 'last_updated_x', 'address_id',
               'address_id','created_at_y', 'last_updated_y']
-    dim_counterparty_df = merged_df.drop(columns=columns, axis=1)
+    dim_counterparty_df = merged_df.drop(columns=columns, errors="ignore")
     
     
     dim_counterparty_df = dim_counterparty_df.rename(columns={
@@ -299,11 +734,255 @@ def dim_counterparty(last_checked, ingestion_bucket, processed_bucket, s3_client
     })
     
     output_key = f"dim_counterparty/{last_checked}.parquet"
-    wr.s3.to_parquet(dim_counterparty_df, f"s3://{processed_bucket}/{output_key}")
+    write_processed_parquet(dim_counterparty_df, f"s3://{processed_bucket}/{output_key}", "dim_counterparty")
     logger.info(f"dim_counterparty uploaded successfully to s3://{processed_bucket}/{output_key}")
     return 'dim_counterparty transformation complete'
 
 
+def processed_parquet_options(table):
+    """
+    Summary:
+    Compression settings for a processed parquet file, as keyword arguments
+    for wr.s3.to_parquet. PROCESSED_CODEC is the codec for every table,
+    "name" or "name:level" with name snappy (default), gzip, zstd or none.
+    PROCESSED_CODECS overrides it per output table, e.g.
+    "fact_sales_order=zstd:9,dim_date=gzip".
+
+    Args:
+        table (str): name of the output table, e.g. "dim_staff"
+
+    Returns:
+        dict {"compression": "zstd", "pyarrow_additional_kwargs": {"compression_level": 9}}
+    """
+    codecs = {}
+    for item in os.environ.get("PROCESSED_CODECS", "").split(","):
+        if item.strip():
+            name, spec = item.split("=", 1)
+            codecs[name.strip()] = spec.strip()
+    spec = codecs.get(table, os.environ.get("PROCESSED_CODEC", "snappy"))
+
+    codec, _, level = spec.lower().partition(":")
+    if codec not in ["snappy", "gzip", "zstd", "none"]:
+        raise ValueError(f"processed_parquet_options: unsupported codec {codec} for {table}")
+    options = {"compression": None if codec == "none" else codec}
+    if level:
+        options["pyarrow_additional_kwargs"] = {"compression_level": int(level)}
+    return options
+
+
+def ingestion_file_key(table, last_checked, ingestion_format="csv"):
+    """
+    Summary:
+    Build the key extract writes a table's batch to. The file extension
+    is the ingestion format (csv, parquet or arrow).
+
+    Returns:
+        str: e.g. "currency/2025-06-10 09:15:00.000000.parquet"
+    """
+    return f"{table}/{last_checked}.{ingestion_format}"
+
+
+def read_ingestion_file(bucket, file_key):
+    """
+    Summary:
+    Read one ingestion file into a dataframe, picking the reader from the
+    file extension. parquet and Arrow IPC files carry their own types;
+    csv files (also gzip / zstd compressed .csv.gz / .csv.zst) are read
+    with the SOURCE_SCHEMA types of their table (the first part of the key)
+    and have the index column written by extract removed.
+
+    Args:
+        bucket (str): name of the ingestion bucket
+        file_key (str): key of the file, as built by ingestion_file_key
+
+    Returns:
+        pandas DataFrame
+    """
+    import awswrangler as wr
+    import pyarrow as pa
+
+    path = f"s3://{bucket}/{file_key}"
+    table = file_key.split("/", 1)[0]
+    if file_key.endswith((".csv.gz", ".csv.zst")):
+        import pandas as pd
+
+        compression = "gzip" if file_key.endswith(".gz") else "zstd"
+        s3_client = get_s3_client()
+        body = s3_client.get_object(Bucket=bucket, Key=file_key)["Body"].read()
+        df = pd.read_csv(pa.input_stream(pa.py_buffer(body), compression=compression), **csv_read_options(table))
+        return cast_source_columns(df.drop(columns=["Unnamed: 0"], errors="ignore"), table)
+    if file_key.endswith(".parquet"):
+        return wr.s3.read_parquet(path)
+    if file_key.endswith(".arrow"):
+        s3_client = get_s3_client()
+        body = s3_client.get_object(Bucket=bucket, Key=file_key)["Body"].read()
+        return pa.ipc.open_file(pa.py_buffer(body)).read_all().to_pandas()
+    df = wr.s3.read_csv(path, **csv_read_options(table))
+    return cast_source_columns(df.drop(columns=["Unnamed: 0"], errors="ignore"), table)
+
+
+def csv_read_options(table):
+    """
+    Summary:
+    read_csv arguments giving the columns of a table their SOURCE_SCHEMA
+    types: nullable Int64 for ints (a null key stays an int), str for text
+    (postal codes and phone numbers keep their leading zeros) and Decimal
+    for numerics (unit_price is not rounded through a float). Timestamps
+    are read as str and converted by cast_source_columns. Booleans are
+    read from both True/False (the select engine) and t/f (COPY).
+
+    Returns:
+        dict {"dtype": {...}, "converters": {...}, "true_values": [...], "false_values": [...]}
+    """
+    dtypes = {"int": "Int64", "str": str, "bool": "boolean", "timestamp": str}
+    dtype = {}
+    converters = {}
+    for name, column_type in SOURCE_SCHEMA.get(table, {}).items():
+        if column_type.startswith("decimal"):
+            converters[name] = parse_decimal
+        else:
+            dtype[name] = dtypes[column_type]
+    return {"dtype": dtype, "converters": converters, "true_values": ["t"], "false_values": ["f"]}
+
+
+def parse_decimal(value):
+    """
+    Summary : a csv numeric as a Decimal, None when it is empty.
+    """
+    from decimal import Decimal
+
+    return Decimal(value) if value else None
+
+
+def cast_source_columns(df, table):
+    """
+    Summary:
+    Convert the timestamp columns of a csv read with csv_read_options to
+    datetimes. parse_dates is not used as it fails on the columns extract
+    did not select and falls back to str when the fractional seconds vary.
+    """
+    import pandas as pd
+
+    for name, column_type in SOURCE_SCHEMA.get(table, {}).items():
+        if column_type == "timestamp" and name in df.columns:
+            df[name] = pd.to_datetime(df[name], format="ISO8601")
+    return df
+
+
+def find_ingestion_keys(bucket, table, last_checked, ingestion_format="csv", manifest=None):
+    """
+    Summary:
+    Find the ingestion file(s) extract wrote for a table in this batch.
+    That is either the single file <table>/<last_checked>.<format>, or,
+    for tables extract split into primary key ranges, every part file
+    under <table>/<last_checked>/.
+    With a batch manifest the keys are read from it and the bucket is not
+    touched; without one (older batches) the bucket is probed.
+
+    Args:
+        bucket (str): name of the ingestion bucket
+        table (str): name of the source table
+        last_checked (str): timestamp marking the batch
+        ingestion_format (str): csv, parquet or arrow
+        manifest (dict): batch manifest written by extract
+
+    Returns:
+        list of keys, empty if the table has no new data in this batch
+    """
+    if manifest is not None:
+        entry = manifest["tables"].get(table)
+        return list(entry["keys"]) if entry and entry["changed"] else []
+
+    file_key = ingestion_file_key(table, last_checked, ingestion_format)
+    if check_file_exists_in_ingestion_bucket(bucket=bucket, filename=file_key):
+        return [file_key]
+
+    part_keys = [obj["Key"] for obj in list_ingestion_objects(bucket, table, f"{table}/{last_checked}/")
+                 if obj["Key"].endswith(f".{ingestion_format}")]
+    if part_keys:
+        logger.info(f"Found {len(part_keys)} part files for {table}")
+    return sorted(part_keys)
+
+
+def find_latest_ingestion_keys(bucket, table, manifest=None):
+    """
+    Summary:
+    Find the most recently written ingestion file(s) of a table, whatever
+    batch they belong to. Used for tables a builder needs even when they
+    did not change in this batch. If the newest file is a part file, all
+    the parts of its batch are returned.
+    The batch manifest carries the latest keys of unchanged tables forward,
+    so with a manifest the bucket is only listed for tables it does not know.
+
+    Args:
+        bucket (str): name of the ingestion bucket
+        table (str): name of the source table
+        manifest (dict): batch manifest written by extract
+
+    Returns:
+        list of keys, empty if the table was never extracted
+    """
+    if manifest is not None and table in manifest["tables"]:
+        return list(manifest["tables"][table]["keys"])
+
+    objects = list_ingestion_objects(bucket, table, f"{table}/")
+    if not objects:
+        return []
+
+    latest_key = max(objects, key=lambda x: x['LastModified'])['Key']
+    batch_folder = latest_key.rsplit("/", 1)[0]
+    if batch_folder == table:
+        return [latest_key]
+    return sorted(obj["Key"] for obj in objects if obj["Key"].startswith(f"{batch_folder}/"))
+
+
+def get_batch_manifest(s3_client, bucket, manifest_key):
+    """
+    Summary:
+    Read the manifest extract wrote for this batch (manifests/<batch>.json).
+    It lists, for every table, the ingestion file keys, row count, bytes,
+    schema and watermark, and whether the table changed in this batch.
+
+    Args:
+        s3_client: boto3 s3 client
+        bucket (str): name of the ingestion bucket
+        manifest_key (str): key from the extract payload
+
+    Returns:
+        dict, or None if extract did not pass a manifest
+    """
+    if not manifest_key:
+        logger.info("No batch manifest in the payload, ingestion files will be looked up in the bucket.")
+        return None
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=manifest_key)
+        manifest = json.loads(response["Body"].read())
+        logger.info(f"Batch manifest {manifest_key} read, {len(manifest['tables'])} tables listed.")
+        return manifest
+    except botocore.exceptions.ClientError as client_error:
+        logger.error(f"S3 client error reading the batch manifest {manifest_key}: {str(client_error)}")
+        raise
+
+
+def read_ingestion_files(bucket, file_keys):
+    """
+    Summary:
+    Read one or more ingestion files of the same table (the part files of
+    a split table) into a single dataframe.
+
+    Returns:
+        pandas DataFrame
+    """
+    import pandas as pd
+
+    if len(file_keys) == 1:
+        df = read_ingestion_file(bucket, file_keys[0])
+    else:
+        df = pd.concat([read_ingestion_file(bucket, file_key) for file_key in file_keys], ignore_index=True)
+    count_table_rows("rows_in", len(df))
+    return df
+
+
 def check_file_exists_in_ingestion_bucket(bucket, filename):
 
     """
@@ -317,7 +996,10 @@ def check_file_exists_in_ingestion_bucket(bucket, filename):
     Returns:
         Boolean.
     """
-    s3_client = boto3.client("s3")
+    indexed = KEY_INDEX.get((bucket, filename.split("/", 1)[0]))
+    if indexed is not None:
+        return filename in indexed["keys"]
+    s3_client = get_s3_client()
     try:
         s3_client.head_object(Bucket=bucket, Key=filename)
         logger.info(f"Key: '{filename}' found!")
@@ -331,11 +1013,257 @@ def check_file_exists_in_ingestion_bucket(bucket, filename):
             return False
 
 
+def build_key_index(s3_client, bucket, tables):
+    """
+    Summary:
+    List every ingestion object of the given tables once (one paginated
+    listing per table prefix) into KEY_INDEX, so that
+    check_file_exists_in_ingestion_bucket, find_ingestion_keys and
+    find_latest_ingestion_keys answer from memory for the rest of the run
+    instead of sending a head_object or a listing per question.
+
+    Args:
+        s3_client: boto3 s3 client
+        bucket (str): name of the ingestion bucket
+        tables (list): source tables to list
+
+    Returns:
+        int: number of objects indexed
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    count = 0
+    for table in tables:
+        objects = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{table}/"):
+            objects.extend(page.get("Contents", []))
+        KEY_INDEX[(bucket, table)] = {"objects": objects, "keys": {obj["Key"] for obj in objects}}
+        count += len(objects)
+    logger.info(f"Indexed {count} ingestion objects of {len(tables)} tables.")
+    return count
+
+
+def list_ingestion_objects(bucket, table, prefix):
+    """
+    Summary:
+    The objects of a table under a prefix, from KEY_INDEX when the table
+    has been indexed in this run, else from a listing of the bucket.
+
+    Returns:
+        list of dicts from list_objects_v2 ("Key", "LastModified", ...)
+    """
+    indexed = KEY_INDEX.get((bucket, table))
+    if indexed is not None:
+        return [obj for obj in indexed["objects"] if obj["Key"].startswith(prefix)]
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get("Contents", []))
+    return objects
+
+
+def snapshot_key(table):
+    """
+    Summary : key of a table's current-state snapshot in the ingestion bucket.
+    """
+    return f"snapshots/{table}.parquet"
+
+
+def read_snapshot(bucket, table, s3_client=None, with_merge=False):
+    """
+    Summary:
+    Read the current-state snapshot of a source table, one row per primary
+    key with its latest values (see update_snapshots).
+
+    Args:
+        bucket (str): name of the ingestion bucket
+        table (str): name of the source table
+        s3_client: boto3 s3 client, the container's client by default
+        with_merge (bool): also return the last merge into it, the batch
+        and the keys it changed
+
+    Returns:
+        pandas DataFrame, None if the table has no snapshot yet
+        (DataFrame, {"batch": ..., "changed_keys": [...]}) / (None, {}) with with_merge
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    s3_client = s3_client or get_s3_client()
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=snapshot_key(table))["Body"].read()
+    except botocore.exceptions.ClientError as client_error:
+        if client_error.response["Error"]["Code"] not in ["NoSuchKey", "404"]:
+            raise
+        return (None, {}) if with_merge else None
+    snapshot = pq.read_table(pa.py_buffer(body))
+    df = snapshot.to_pandas()
+    if not with_merge:
+        return df
+    metadata = snapshot.schema.metadata or {}
+    return df, {"batch": metadata.get(b"batch", b"").decode(),
+                "changed_keys": json.loads(metadata.get(b"changed_keys", b"[]"))}
+
+
+def write_snapshot(s3_client, bucket, table, df, batch, changed_keys=()):
+    """
+    Summary:
+    Write a table's snapshot, recording the last batch merged into it and
+    the keys that merge changed, so a retried run can hand them on again.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    snapshot = pa.Table.from_pandas(df, preserve_index=False)
+    snapshot = snapshot.replace_schema_metadata({**(snapshot.schema.metadata or {}), b"batch": batch.encode(),
+                                                 b"changed_keys": json.dumps(list(changed_keys), default=int).encode()})
+    buffer = io.BytesIO()
+    pq.write_table(snapshot, buffer, compression="zstd")
+    s3_client.put_object(Bucket=bucket, Key=snapshot_key(table), Body=buffer.getvalue())
+
+
+def merge_snapshot(snapshot_df, changes_df, primary_key, deleted_keys=()):
+    """
+    Summary:
+    Merge changed rows into a snapshot by primary key: the row with the
+    latest last_updated wins (the changes on a tie, or when the files
+    have no last_updated), deleted keys are removed. Merging the same
+    batch twice gives the same snapshot.
+
+    Returns:
+        pandas DataFrame sorted by primary key
+    """
+    import pandas as pd
+
+    merged = pd.concat([df for df in [snapshot_df, changes_df] if df is not None], ignore_index=True)
+    if "last_updated" in merged.columns:
+        merged = merged.sort_values("last_updated", kind="stable")
+    merged = merged.drop_duplicates(subset=[primary_key], keep="last")
+    if len(deleted_keys):
+        merged = merged[~merged[primary_key].isin(list(deleted_keys))]
+    return merged.sort_values(primary_key).reset_index(drop=True)
+
+
+def find_changed_keys(snapshot_df, merged_df, changes_df, primary_key, deleted_keys=()):
+    """
+    Summary:
+    The primary keys whose current row a merge changed: new keys, keys
+    with a different value in any column of the batch and deleted keys.
+    Only the keys of the batch are compared, so a full scan batch
+    (department) that repeats unchanged rows does not mark them as
+    changed. Values are compared rather than last_updated, which full
+    scan tables cannot be trusted to move.
+
+    Returns:
+        list of primary keys
+    """
+    if snapshot_df is None:
+        return merged_df[primary_key].tolist()
+    candidates = changes_df[primary_key].drop_duplicates() if changes_df is not None else []
+    changed = list(deleted_keys)
+    if len(candidates):
+        columns = [name for name in changes_df.columns if name != primary_key and name in snapshot_df.columns]
+        before = snapshot_df.set_index(primary_key).reindex(candidates)[columns]
+        after = merged_df.set_index(primary_key).reindex(candidates)[columns]
+        same = (before.eq(after).fillna(False).astype(bool) | (before.isna() & after.isna())).all(axis=1)
+        new_keys = ~candidates.isin(snapshot_df[primary_key])
+        changed.extend(candidates[new_keys.to_numpy() | ~same.to_numpy()].tolist())
+    return changed
+
+
+def select_affected_rows(bucket, table, changes_df, foreign_key, changed_references, s3_client=None):
+    """
+    Summary:
+    The current rows of a table a joined dimension has to rebuild: the
+    rows changed in this batch, plus the rows whose foreign key points at
+    a changed row of the other side of the join. Both come from the
+    table's snapshot, so the work follows the size of the change and not
+    of the dimension. Without a snapshot the batch rows are returned.
+
+    Args:
+        bucket (str): name of the ingestion bucket
+        table (str): table on the many side of the join, e.g. staff
+        changes_df (DataFrame): rows of table in this batch, or None
+        foreign_key (str): column referencing the other side, e.g. department_id
+        changed_references (list): changed keys of the other side
+
+    Returns:
+        pandas DataFrame, or None when there is nothing to rebuild
+    """
+    snapshot_df = read_snapshot(bucket, table, s3_client)
+    if snapshot_df is None or not len(changed_references):
+        return changes_df
+    primary_key = f"{table}_id"
+    own_keys = changes_df[primary_key].tolist() if changes_df is not None else []
+    affected = snapshot_df[snapshot_df[primary_key].isin(own_keys)
+                           | snapshot_df[foreign_key].isin(list(changed_references))]
+    logger.info(f"{table}: {len(affected)} rows to rebuild, {len(own_keys)} changed in this batch")
+    return affected.reset_index(drop=True)
+
+
+def update_snapshots(s3_client, bucket, last_checked, ingestion_format="csv", manifest=None):
+    """
+    Summary:
+    Keep snapshots/<table>.parquet in the ingestion bucket as the current
+    state of every SNAPSHOT_TABLES table: the rows of this batch (and the
+    keys deleted in it, from the cdc engine) are merged by primary key
+    (<table>_id) into the previous snapshot. A table without a snapshot
+    is built once from all of its ingestion files. Joins then read one
+    compact object instead of the history, or a latest batch that only
+    holds the changed rows.
+    Only the snapshots of tables in the batch are read (and those not
+    built yet, found with one listing), so a batch without dimension
+    changes does not load pandas. A batch already merged (a retried run)
+    is not merged again, the keys its first merge changed are returned
+    instead so the joined dimensions still rebuild them.
+
+    Args:
+        s3_client: boto3 s3 client
+        bucket (str): name of the ingestion bucket
+        last_checked (str): timestamp marking the batch
+        ingestion_format (str): csv, parquet or arrow
+        manifest (dict): batch manifest written by extract, if there is one
+
+    Returns:
+        dict {table: [primary keys changed by the merge]} for the snapshots
+        written, see find_changed_keys
+    """
+    updated = {}
+    built = {obj["Key"] for obj in list_ingestion_objects(bucket, "snapshots", "snapshots/")}
+    for table in SNAPSHOT_TABLES:
+        keys = find_ingestion_keys(bucket, table, last_checked, ingestion_format, manifest)
+        delete_keys = (manifest or {}).get("tables", {}).get(table, {}).get("deletes", [])
+        if not keys and not delete_keys and snapshot_key(table) in built:
+            continue
+        snapshot_df, last_merge = read_snapshot(bucket, table, s3_client, with_merge=True)
+        if snapshot_df is not None and last_merge["batch"] == last_checked:
+            updated[table] = last_merge["changed_keys"]
+            continue
+        if snapshot_df is not None and last_merge["batch"] > last_checked:
+            continue
+        if snapshot_df is None:
+            keys = sorted(obj["Key"] for obj in list_ingestion_objects(bucket, table, f"{table}/"))
+        if not keys and not delete_keys:
+            continue
+        primary_key = f"{table}_id"
+        changes_df = read_ingestion_files(bucket, keys) if keys else None
+        deleted = read_ingestion_files(bucket, delete_keys)[primary_key] if delete_keys else []
+        if changes_df is None and snapshot_df is None:
+            continue
+        merged = merge_snapshot(snapshot_df, changes_df, primary_key, deleted)
+        updated[table] = find_changed_keys(snapshot_df, merged, changes_df, primary_key, deleted)
+        write_snapshot(s3_client, bucket, table, merged, last_checked, updated[table])
+    if updated:
+        logger.info(f"Snapshots updated: { {table: len(keys) for table, keys in updated.items()} } keys changed")
+    return updated
+
+
 def dim_date(last_checked, processed_bucket, start='2020-01-01', end='2030-12-31'):
     """
     Creates a dim_date table with full range between start and end.
     PK: date_id => FK: created_date, last_updated_date, agreed_payment_date, agreed_delivery_date
     """
+    import pandas as pd
+
     last_checked = str(datetime.now())
 
     df_dim_date = pd.DataFrame({"date_id": pd.date_range(start, end)})
@@ -351,7 +1279,7 @@ def dim_date(last_checked, processed_bucket, start='2020-01-01', end='2030-12-31
     processed_file_key = f"dim_date/{last_checked}.parquet"
 
     try:
-        wr.s3.to_parquet(df_dim_date, f"s3://{processed_bucket}/{processed_file_key}")
+        write_processed_parquet(df_dim_date, f"s3://{processed_bucket}/{processed_file_key}", "dim_date")
         logger.info(f"dim_date parquet has been uploaded to ingestion s3 at: s3://{processed_bucket}/{processed_file_key}")
     except botocore.exceptions.ClientError as client_error:
         logger.error(f"there has been a error in converting to parquet and uploading for dim_date {str(client_error)}")
@@ -360,46 +1288,28 @@ def dim_date(last_checked, processed_bucket, start='2020-01-01', end='2030-12-31
 
 
 
-def fact_sales_order(last_checked,ingestion_bucket,processed_bucket):
+def fact_sales_order(last_checked,ingestion_bucket,processed_bucket, ingestion_format="csv", manifest=None):
        
-    key_sales = f"sales_order/{last_checked}.csv"
+    key_sales = ingestion_file_key("sales_order", last_checked, ingestion_format)
+    sales_keys = find_ingestion_keys(ingestion_bucket, "sales_order", last_checked, ingestion_format, manifest)
 
-    if not check_file_exists_in_ingestion_bucket(bucket=ingestion_bucket, filename=key_sales):
+    if not sales_keys:
         logger.warning(f"Missing file: {key_sales}")
         return 'Missing staff file'
     
-    file_path_s3 = f's3://{ingestion_bucket}/{key_sales}' 
-    fact_sales_df = wr.s3.read_csv(file_path_s3)
-    fact_sales_df = fact_sales_df.drop(["Unnamed: 0"], axis=1)
+    fact_sales_df = read_ingestion_files(ingestion_bucket, sales_keys)
     
     # SERIAL ID needed for sales_record_id?
-    fact_sales_df["sales_record_id"] = fact_sales_df["sales_order_id"]
-
-    #convert created_at to datetime obj, then split into created_date and created_time
-    fact_sales_df["created_at"] = pd.to_datetime(fact_sales_df["created_at"])
-    for d in fact_sales_df["created_at"]:
-        fact_sales_df["created_date"] = d.date()
-        fact_sales_df["created_time"] = d.time()
-    
-    #convert last_updated to datetime obj, then split into last_updated_date and last_updated_time
-    fact_sales_df["last_updated"] = pd.to_datetime(fact_sales_df["last_updated"])
-    for d in fact_sales_df["last_updated"]:
-        fact_sales_df["last_updated_date"] = d.date()
-        fact_sales_df["last_updated_time"] = d.time()
-    
-    fact_sales_df = fact_sales_df.drop(["created_at"], axis=1)
-    fact_sales_df = fact_sales_df.drop(["last_updated"], axis=1)
+    fact_sales_df = alias_columns(fact_sales_df, {"sales_record_id": "sales_order_id"})
 
-      #change sales_id to sales_staff_id
-    #fact_sales_df = fact_sales_df.rename({"staff_id": "sales_staff_id"})
-    fact_sales_df["sales_staff_id"] = fact_sales_df["staff_id"]
-    fact_sales_df = fact_sales_df.drop(["staff_id"], axis=1)
+    #split created_at and last_updated into <name>_date and <name>_time columns
+    fact_sales_df = split_datetime_columns(fact_sales_df, {"created_at": "created", "last_updated": "last_updated"})
 
-    #change delivery date from varchar to datetime 
-    fact_sales_df["agreed_delivery_date"] = pd.to_datetime(fact_sales_df["agreed_delivery_date"]).dt.date
+    #change sales_id to sales_staff_id
+    fact_sales_df = fact_sales_df.rename(columns={"staff_id": "sales_staff_id"})
 
-    #change agreed_payment_date from varchar to datetime
-    fact_sales_df["agreed_payment_date"] = pd.to_datetime(fact_sales_df["agreed_payment_date"]).dt.date
+    #change delivery and payment dates from varchar to date
+    fact_sales_df = coerce_date_columns(fact_sales_df, ["agreed_delivery_date", "agreed_payment_date"])
     #change order of columns
     final_columns = [
         'sales_record_id', 'sales_order_id',
@@ -411,11 +1321,81 @@ def fact_sales_order(last_checked,ingestion_bucket,processed_bucket):
         'agreed_payment_date', 'agreed_delivery_date',
         'agreed_delivery_location_id']
     
-    fact_sales_df = fact_sales_df[final_columns]
+    fact_sales_df = order_columns(fact_sales_df, final_columns)
 
     logger.info("fact_sales dataframe has been created")
 
     output_key = f"fact_sales_order/{last_checked}.parquet"
-    wr.s3.to_parquet(fact_sales_df, f"s3://{processed_bucket}/{output_key}")
+    write_processed_parquet(fact_sales_df, f"s3://{processed_bucket}/{output_key}", "fact_sales_order")
     logger.info(f"fact_sales uploaded successfully to s3://{processed_bucket}/{output_key}")
     return 'fact_sales transformation complete'
+
+
+##################################################################################
+# Column transforms shared by the fact builders
+##################################################################################
+
+def split_datetime_columns(df, columns):
+    """
+    Summary:
+    Replace datetime columns by a date and a time column each, e.g.
+    created_at -> created_date, created_time. The split is a cast of the
+    whole column in pyarrow (date32 / time64), not a Python loop, so it is
+    linear in the rows and the columns are written to parquet as date and
+    time types.
+
+    Args:
+        df (DataFrame): the fact rows
+        columns (dict): {datetime column: prefix of the new columns}
+
+    Returns:
+        DataFrame without the datetime columns
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    for column, prefix in columns.items():
+        values = pa.array(pd.to_datetime(df[column], format="ISO8601"), type=pa.timestamp("us"))
+        df[f"{prefix}_date"] = pd.Series(values.cast(pa.date32()), index=df.index, dtype=pd.ArrowDtype(pa.date32()))
+        df[f"{prefix}_time"] = pd.Series(values.cast(pa.time64("us")), index=df.index,
+                                         dtype=pd.ArrowDtype(pa.time64("us")))
+    return df.drop(columns=list(columns))
+
+
+def coerce_date_columns(df, columns):
+    """
+    Summary:
+    Turn columns holding dates as text ("2022-11-07", the varchar dates of
+    totesys) or as datetimes into date columns, vectorised like
+    split_datetime_columns.
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    for column in columns:
+        values = pa.array(pd.to_datetime(df[column], format="ISO8601"), type=pa.timestamp("us"))
+        df[column] = pd.Series(values.cast(pa.date32()), index=df.index, dtype=pd.ArrowDtype(pa.date32()))
+    return df
+
+
+def alias_columns(df, aliases):
+    """
+    Summary:
+    Add columns that hold the same ids as an existing column under another
+    name, e.g. {"sales_record_id": "sales_order_id"}.
+    """
+    return df.assign(**{alias: df[column] for alias, column in aliases.items()})
+
+
+def order_columns(df, columns):
+    """
+    Summary:
+    Keep only the given columns of a fact table, in that order.
+
+    Raises:
+        KeyError naming the columns the dataframe does not have
+    """
+    missing = [column for column in columns if column not in df.columns]
+    if missing:
+        raise KeyError(f"order_columns: missing columns {missing}")
+    return df[columns]
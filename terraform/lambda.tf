@@ -56,6 +56,23 @@ resource "aws_lambda_function" "extract_lambda_handler" {
   environment {
     variables = {
       S3_INGESTION_BUCKET = aws_s3_bucket.ingestion_bucket.bucket
+      EXTRACT_MODE        = var.extract_mode
+      EXTRACT_CHUNK_SIZE  = var.extract_chunk_size
+      EXTRACT_POOL_SIZE   = var.extract_pool_size
+      INGESTION_FORMAT    = var.ingestion_format
+      EXTRACT_PARTITIONS  = var.extract_partitions
+      CACHE_TTL_SECONDS   = var.cache_ttl_seconds
+      EXTRACT_ENGINE      = var.extract_engine
+      EXTRACT_ENGINES     = var.extract_engines
+      EXTRACT_FULL_FIDELITY = var.extract_full_fidelity
+      INGESTION_CODEC     = var.ingestion_codec
+      INGESTION_CODECS    = var.ingestion_codecs
+      BACKFILL_CHUNK_KEYS = var.backfill_chunk_keys
+      EXTRACT_ROW_BUDGET  = var.extract_row_budget
+      EXTRACT_MAX_WINDOWS = var.extract_max_windows
+      CDC_SLOT_NAME       = var.cdc_slot_name
+      CDC_MAX_CHANGES     = var.cdc_max_changes
+      SCHEMA_DRIFT        = var.schema_drift
     }
   }
 }
@@ -84,6 +101,10 @@ resource "aws_lambda_function" "transform_lambda_handler" {
     variables = {
       S3_INGESTION_BUCKET = aws_s3_bucket.ingestion_bucket.bucket
       S3_PROCESSED_BUCKET = aws_s3_bucket.processed_bucket.bucket
+      PROCESSED_CODEC     = var.processed_codec
+      PROCESSED_CODECS    = var.processed_codecs
+      TRANSFORM_POOL_SIZE = var.transform_pool_size
+      TRANSFORM_FAIL_FAST = var.transform_fail_fast
     }
   }
 }
@@ -30,4 +30,81 @@ resource "aws_sfn_state_machine" "sfn_state_machine" {
     }
   }
     EOF
-}
\ No newline at end of file
+}
+
+# Initial historical load, started by hand with the input
+# {"backfill": {"action": "plan"}} while the schedule is paused.
+# Every chunk is checkpointed in the ingestion bucket, so starting it
+# again after a timeout or failure only extracts the missing chunks.
+resource "aws_sfn_state_machine" "backfill_state_machine" {
+  name     = "${var.step_function}-backfill"
+  role_arn = aws_iam_role.step_function_role.arn
+
+    definition = <<EOF
+    {
+  "StartAt": "Plan",
+  "States": {
+    "Plan": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.extract_lambda_handler.arn}",
+      "Next": "ExtractChunks",
+      "TimeoutSeconds": 900,
+      "ResultPath": "$.plan"
+    },
+    "ExtractChunks": {
+      "Type": "Map",
+      "ItemsPath": "$.plan.chunks",
+      "MaxConcurrency": ${var.backfill_concurrency},
+      "Iterator": {
+        "StartAt": "ExtractChunk",
+        "States": {
+          "ExtractChunk": {
+            "Type": "Task",
+            "Resource": "${aws_lambda_function.extract_lambda_handler.arn}",
+            "TimeoutSeconds": 900,
+            "Retry": [
+              {
+                "ErrorEquals": ["States.ALL"],
+                "IntervalSeconds": 30,
+                "MaxAttempts": 3,
+                "BackoffRate": 2
+              }
+            ],
+            "End": true
+          }
+        }
+      },
+      "ResultPath": null,
+      "Next": "Finish"
+    },
+    "Finish": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.extract_lambda_handler.arn}",
+      "Parameters": {
+        "backfill": {
+          "action": "finish",
+          "backfill_id.$": "$.plan.backfill_id"
+        }
+      },
+      "Next": "Transform",
+      "TimeoutSeconds": 900,
+      "ResultPath": "$.myresult"
+    },
+    "Transform": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.transform_lambda_handler.arn}",
+      "Next": "Load",
+      "TimeoutSeconds": 900,
+      "ResultPath": "$.myresult"
+    },
+    "Load": {
+      "Type": "Task",
+      "Resource": "${aws_lambda_function.load_lambda_handler.arn}",
+      "ResultPath": "$.myresult",
+      "TimeoutSeconds": 900,
+      "End": true
+    }
+    }
+  }
+    EOF
+}
@@ -46,4 +46,135 @@ variable "notification_email" {
 variable "aws_region" {
   type    = string
   default = "eu-west-2"
-}
\ No newline at end of file
+}
+
+variable "extract_mode" {
+  description = "batch loads each table in memory, stream uses a server-side cursor and multipart upload"
+  type        = string
+  default     = "batch"
+}
+
+variable "extract_chunk_size" {
+  description = "Rows fetched per chunk when extract_mode is stream"
+  type        = number
+  default     = 50000
+}
+
+variable "extract_pool_size" {
+  description = "Tables extracted in parallel, each on its own db connection (1 = sequential)"
+  type        = number
+  default     = 1
+}
+
+variable "ingestion_format" {
+  description = "File format extract writes to the ingestion bucket: csv, parquet or arrow"
+  type        = string
+  default     = "csv"
+}
+
+variable "extract_partitions" {
+  description = "Tables split into primary key ranges, e.g. sales_order=4,transaction=4 (empty = none)"
+  type        = string
+  default     = ""
+}
+
+variable "cache_ttl_seconds" {
+  description = "Seconds a warm extract Lambda keeps db credentials and the schema drift check (0 = no warm cache)"
+  type        = number
+  default     = 3600
+}
+variable "extract_engine" {
+  description = "How extract reads rows: select (rows as Python values), copy (COPY TO STDOUT, csv only) or cdc (wal2json logical replication slot)"
+  type        = string
+  default     = "select"
+}
+
+variable "extract_engines" {
+  description = "Per table extract engine overrides, e.g. sales_order=copy,transaction=copy (empty = none)"
+  type        = string
+  default     = ""
+}
+
+variable "extract_full_fidelity" {
+  description = "true reads every column of every table, false only the columns transform uses"
+  type        = bool
+  default     = false
+}
+
+variable "ingestion_codec" {
+  description = "Compression of ingestion files, name or name:level (empty = none for csv, snappy for parquet, zstd for arrow)"
+  type        = string
+  default     = ""
+}
+
+variable "ingestion_codecs" {
+  description = "Per table ingestion codec overrides, e.g. sales_order=zstd:9 (empty = none)"
+  type        = string
+  default     = ""
+}
+
+variable "extract_row_budget" {
+  description = "Most new rows extracted for a table in one task, bigger windows are split (0 = never split)"
+  type        = number
+  default     = 0
+}
+
+variable "extract_max_windows" {
+  description = "Most sub-windows of a table extracted per run, the rest wait for the next run (0 = all)"
+  type        = number
+  default     = 0
+}
+
+variable "processed_codec" {
+  description = "Compression of processed parquet files: snappy, gzip, zstd or none, optionally name:level"
+  type        = string
+  default     = "snappy"
+}
+
+variable "processed_codecs" {
+  description = "Per output table processed codec overrides, e.g. fact_sales_order=zstd:9 (empty = none)"
+  type        = string
+  default     = ""
+}
+
+variable "backfill_chunk_keys" {
+  description = "Primary keys per backfill chunk, each chunk is one extract invocation"
+  type        = number
+  default     = 250000
+}
+
+variable "backfill_concurrency" {
+  description = "Backfill chunks extracted at the same time"
+  type        = number
+  default     = 4
+}
+
+variable "cdc_slot_name" {
+  description = "Logical replication slot read by the cdc extract engine (created with wal2json if missing)"
+  type        = string
+  default     = "funland_cdc"
+}
+
+variable "cdc_max_changes" {
+  description = "Most changes the cdc extract engine reads from the slot per run"
+  type        = number
+  default     = 500000
+}
+
+variable "schema_drift" {
+  description = "What extract does when the totesys columns differ from SOURCE_SCHEMA: warn, fail or off"
+  type        = string
+  default     = "warn"
+}
+
+variable "transform_pool_size" {
+  description = "Transform builders run at the same time (1 = one after another)"
+  type        = number
+  default     = 1
+}
+
+variable "transform_fail_fast" {
+  description = "true stops starting transform builders after the first failure, false runs them all"
+  type        = bool
+  default     = false
+}
@@ -1,4 +1,16 @@
 from src.lambda_handler.extract import get_db_credentials, get_last_checked, create_db_connection, update_last_checked, extract_new_rows, convert_new_rows_to_df_and_upload_to_s3_as_csv, get_bucket_name
+from src.lambda_handler.extract import extract_new_rows_in_chunks, stream_new_rows_to_s3_as_csv, S3MultipartWriter
+from src.lambda_handler.extract import extract_tables_concurrently, get_extract_config, open_export_snapshot
+from src.lambda_handler.extract import import_snapshot
+from src.lambda_handler.extract import write_arrow_tables_to_s3, convert_chunks_to_arrow
+from src.lambda_handler.extract import build_extract_query, split_key_range, plan_extract_tasks, combine_task_results
+from src.lambda_handler.extract import probe_table_changes, select_changed_tables, get_extract_state
+from src.lambda_handler.extract import update_extract_state
+from src.lambda_handler.extract import advance_extract_state, build_batch_manifest, upload_manifest, get_manifest
+from src.lambda_handler.extract import extract_table_to_s3
+from decimal import Decimal
+import pyarrow as pa
+import src.lambda_handler.extract as extract
 import pytest
 from pg8000.native import DatabaseError, InterfaceError, Connection
 from moto import mock_aws
@@ -7,6 +19,11 @@ from botocore.config import Config
 from datetime import datetime
 import json
 import os
+import subprocess
+import sys
+import io
+import gzip
+import pyarrow.parquet
 from botocore.exceptions import ClientError
 import os
 from dotenv import load_dotenv
@@ -59,6 +76,35 @@ def s3_client():
     return boto3.client('s3', config = my_config)
 
 
+class FakeCursorConnection:
+    """Stands in for a pg8000 Connection: answers FETCH with the next slice of rows."""
+    def __init__(self, column_names, rows):
+        self.columns = [{"name": name} for name in column_names]
+        self.rows = rows
+        self.position = 0
+        self.queries = []
+
+    def run(self, query, **params):
+        self.queries.append(query)
+        if query.startswith("DECLARE"):
+            self.position = 0
+        if query.startswith("SELECT pg_export_snapshot()"):
+            return [["00000003-0000001B-1", datetime(2025, 6, 10, 9, 15)]]
+        if query.startswith("FETCH"):
+            size = int(query.split()[2])
+            chunk = self.rows[self.position:self.position + size]
+            self.position += size
+            return chunk
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+def table_tasks(tables):
+    return [{"table": table, "key_range": None, "part": None, "watermark": None} for table in tables]
+
+
 @mock_aws
 class TestGetLastChecked:
     def test_get_last_checked_obtains_the_correct_vaiable(self, ssm_client):
@@ -221,6 +267,13 @@ class TestUpdateLastChecked:
 
         assert datetime.strptime(last_checked,"%Y-%m-%d %H:%M:%S.%f") > datetime.strptime(now,"%Y-%m-%d %H:%M:%S.%f")
 
+    def test_update_last_checked_stores_the_given_snapshot_time(self, ssm_client):
+        ssm_client.put_parameter(Name = "last_checked", Value = "2020-01-01 00:00:00.000000", Type="String")
+
+        update_last_checked(ssm_client, "2025-06-10 09:15:00.000000")
+
+        assert get_last_checked(ssm_client)["last_checked"] == "2025-06-10 09:15:00.000000"
+
 
 class TestExtractNewRows:
     def test_extract_new_rows_returns_all_data(self, db_conn):   
@@ -281,3 +334,1074 @@ class TestConvertNewRowsToDfAndUploadToS3:
         last_checked="2020-01-01 00:00:00.000000"
         with pytest.raises(Exception):
             convert_new_rows_to_df_and_upload_to_s3_as_csv("testingbucket","person",column_names,new_rows,last_checked)
+
+
+
+class TestExtractNewRowsInChunks:
+    def test_rows_are_fetched_in_chunks_of_the_given_size(self):
+        conn = FakeCursorConnection(["id", "name"], [[1, "a"], [2, "b"], [3, "c"], [4, "d"], [5, "e"]])
+
+        chunks = list(extract_new_rows_in_chunks("address", "1995-01-01 00:00:00.000000", conn, 2))
+
+        assert [len(rows) for _, rows in chunks] == [2, 2, 1]
+        assert chunks[0][0] == ["id", "name"]
+        assert conn.queries[0].startswith("DECLARE")
+        assert conn.queries[-1].startswith("CLOSE")
+
+    def test_no_chunks_when_there_are_no_new_rows(self):
+        conn = FakeCursorConnection(["id"], [])
+
+        assert list(extract_new_rows_in_chunks("address", "2030-01-01 00:00:00.000000", conn, 2)) == []
+
+
+@mock_aws
+class TestStreamNewRowsToS3AsCsv:
+    def test_streamed_file_reads_back_like_a_batch_file(self, s3_client):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+        last_checked = "2020-01-01 00:00:00.000000"
+        chunks = [(["age", "height"], [[18, 192.0], [33, 177.4]]), (["age", "height"], [[40, None]])]
+
+        row_count = stream_new_rows_to_s3_as_csv(s3_client, "testbucket", "person", iter(chunks), last_checked)
+
+        df_read = wr.s3.read_csv(f"s3://testbucket/person/{last_checked}.csv")
+        assert row_count == 3
+        assert list(df_read.columns.values) == ["Unnamed: 0", "age", "height"]
+        assert list(df_read["Unnamed: 0"]) == [0, 1, 2]
+        assert list(df_read["age"]) == [18, 33, 40]
+
+    def test_no_file_is_created_when_there_are_no_rows(self, s3_client):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+
+        row_count = stream_new_rows_to_s3_as_csv(s3_client, "testbucket", "person", iter([]),
+                                                 "2020-01-01 00:00:00.000000")
+
+        assert row_count == 0
+        assert "Contents" not in s3_client.list_objects_v2(Bucket="testbucket")
+        assert s3_client.list_multipart_uploads(Bucket="testbucket").get("Uploads", []) == []
+
+    def test_writer_uploads_a_part_each_time_the_buffer_fills(self, s3_client):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+        writer = S3MultipartWriter(s3_client, "testbucket", "big.bin")
+
+        writer.write(b"x" * (S3MultipartWriter.MIN_PART_SIZE + 10))
+        writer.close()
+
+        assert len(writer.parts) == 2
+        size = s3_client.head_object(Bucket="testbucket", Key="big.bin")["ContentLength"]
+        assert size == S3MultipartWriter.MIN_PART_SIZE + 10
+
+
+class TestGetExtractConfig:
+    def test_defaults_to_sequential_batch_extract(self, monkeypatch):
+        for name in ["EXTRACT_MODE", "EXTRACT_CHUNK_SIZE", "EXTRACT_POOL_SIZE", "INGESTION_FORMAT",
+                     "EXTRACT_PARTITIONS", "EXTRACT_ENGINE", "EXTRACT_ENGINES", "EXTRACT_FULL_FIDELITY",
+                     "INGESTION_CODEC", "INGESTION_CODECS", "EXTRACT_ROW_BUDGET", "EXTRACT_MAX_WINDOWS",
+                     "SCHEMA_DRIFT"]:
+            monkeypatch.delenv(name, raising=False)
+
+        assert get_extract_config() == {"mode": "batch", "chunk_size": 50000, "pool_size": 1, "format": "csv",
+                                        "partitions": {}, "engine": "select", "engines": {},
+                                        "full_fidelity": False, "codec": {"name": "none", "level": None},
+                                        "codecs": {}, "row_budget": 0, "max_windows": 0,
+                                        "schema_drift": "warn"}
+
+    def test_reads_pool_size_from_environment(self, monkeypatch):
+        monkeypatch.setenv("EXTRACT_POOL_SIZE", "4")
+
+        assert get_extract_config()["pool_size"] == 4
+
+    def test_rejects_unknown_ingestion_format(self, monkeypatch):
+        monkeypatch.setenv("INGESTION_FORMAT", "xml")
+
+        with pytest.raises(ValueError):
+            get_extract_config()
+
+    @pytest.mark.parametrize("name, value", [("EXTRACT_MODE", "streaming"), ("EXTRACT_CHUNK_SIZE", "0"),
+                                             ("EXTRACT_CHUNK_SIZE", "-5")])
+    def test_rejects_unknown_mode_and_empty_chunks(self, monkeypatch, name, value):
+        monkeypatch.setenv(name, value)
+
+        with pytest.raises(ValueError):
+            get_extract_config()
+
+
+@mock_aws
+class TestExtractTablesConcurrently:
+    def test_every_table_is_uploaded_using_the_pool(self, s3_client, monkeypatch):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+        connections = []
+        def fake_create_db_connection(db_credentials):
+            connections.append(FakeCursorConnection(["id", "name"], [[1, "a"], [2, "b"]]))
+            return connections[-1]
+        monkeypatch.setattr(extract, "create_db_connection", fake_create_db_connection)
+        config = {"mode": "stream", "chunk_size": 1, "pool_size": 2, "format": "csv"}
+        last_checked = "2020-01-01 00:00:00.000000"
+
+        results = extract_tables_concurrently(table_tasks(["currency", "design", "staff"]), last_checked, {},
+                                              s3_client, "testbucket", config)
+
+        assert [result["table"] for result in results] == ["currency", "design", "staff"]
+        assert all(result["row_count"] == 2 for result in results)
+        keys = [obj["Key"] for obj in s3_client.list_objects_v2(Bucket="testbucket")["Contents"]]
+        assert sorted(keys) == [f"{table}/{last_checked}.csv" for table in ["currency", "design", "staff"]]
+        assert len(connections) == 2
+        assert all(conn.closed and conn.queries[-1] == "COMMIT" for conn in connections)
+
+    def test_one_failing_table_does_not_stop_the_others(self, s3_client, monkeypatch):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+        monkeypatch.setattr(extract, "create_db_connection",
+                            lambda db_credentials: FakeCursorConnection(["id"], [[1]]))
+        real_extract_table = extract.extract_table_to_s3
+        def failing_extract_table(table, *args, **kwargs):
+            if table == "design":
+                raise DatabaseError("boom")
+            return real_extract_table(table, *args, **kwargs)
+        monkeypatch.setattr(extract, "extract_table_to_s3", failing_extract_table)
+        config = {"mode": "stream", "chunk_size": 10, "pool_size": 3, "format": "csv"}
+
+        results = extract_tables_concurrently(table_tasks(["currency", "design", "staff"]),
+                                              "2020-01-01 00:00:00.000000", {}, s3_client, "testbucket", config)
+
+        keys = [obj["Key"] for obj in s3_client.list_objects_v2(Bucket="testbucket")["Contents"]]
+        assert len(keys) == 2
+        design_metrics = results[1].pop("metrics")
+        assert results[1] == {"table": "design", "row_count": 0, "keys": [], "bytes": 0, "columns": [], "error": "boom"}
+        assert design_metrics["rows_out"] == 0
+        assert "error" not in results[0] and "error" not in results[2]
+
+
+class TestSharedSnapshot:
+    def test_open_export_snapshot_returns_id_and_database_time(self):
+        conn = FakeCursorConnection([], [])
+
+        snapshot = open_export_snapshot(conn)
+
+        assert snapshot == {"snapshot_id": "00000003-0000001B-1", "snapshot_time": "2025-06-10 09:15:00.000000"}
+        assert conn.queries[0] == "START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY"
+
+    def test_import_snapshot_sets_the_transaction_snapshot(self):
+        conn = FakeCursorConnection([], [])
+
+        import_snapshot(conn, "00000003-0000001B-1")
+
+        assert conn.queries == ["START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY",
+                                "SET TRANSACTION SNAPSHOT '00000003-0000001B-1'"]
+
+    @mock_aws
+    def test_every_pool_connection_imports_the_snapshot(self, s3_client, monkeypatch):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+        connections = []
+        def fake_create_db_connection(db_credentials):
+            connections.append(FakeCursorConnection(["id"], [[1]]))
+            return connections[-1]
+        monkeypatch.setattr(extract, "create_db_connection", fake_create_db_connection)
+        config = {"mode": "stream", "chunk_size": 10, "pool_size": 2, "format": "csv"}
+
+        extract_tables_concurrently(table_tasks(["currency", "design"]), "2020-01-01 00:00:00.000000", {},
+                                    s3_client, "testbucket", config, snapshot_id="00000003-0000001B-1")
+
+        assert all("SET TRANSACTION SNAPSHOT '00000003-0000001B-1'" in conn.queries for conn in connections)
+
+
+@mock_aws
+class TestWriteArrowTablesToS3:
+    def test_parquet_file_keeps_timestamp_and_decimal_types(self, s3_client):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+        column_names = ["sales_order_id", "created_at", "unit_price"]
+        chunks = [(column_names, [[1, datetime(2022, 11, 3, 14, 20, 52, 186000), Decimal("3.94")]]),
+                  (column_names, [[2, datetime(2022, 11, 4, 9, 0, 0, 0), Decimal("2.50")]])]
+
+        row_count = write_arrow_tables_to_s3(s3_client, "testbucket", "sales_order/x.parquet",
+                                             convert_chunks_to_arrow(chunks), "parquet")
+
+        df_read = wr.s3.read_parquet("s3://testbucket/sales_order/x.parquet")
+        assert row_count == 2
+        assert list(df_read.columns) == column_names
+        assert df_read["created_at"][0] == pd.Timestamp(2022, 11, 3, 14, 20, 52, 186000)
+        assert df_read["unit_price"][0] == Decimal("3.94")
+
+    def test_arrow_ipc_file_can_be_read_back(self, s3_client):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+        chunks = [(["age", "height"], [[18, 192.0], [33, 177.4]])]
+
+        write_arrow_tables_to_s3(s3_client, "testbucket", "person/x.arrow", convert_chunks_to_arrow(chunks), "arrow")
+
+        body = s3_client.get_object(Bucket="testbucket", Key="person/x.arrow")["Body"].read()
+        table = pa.ipc.open_file(pa.py_buffer(body)).read_all()
+        assert table.column("age").to_pylist() == [18, 33]
+
+    def test_no_file_is_created_when_there_are_no_rows(self, s3_client):
+        s3_client.create_bucket(
+            Bucket='testbucket',
+            CreateBucketConfiguration={
+                'LocationConstraint': 'eu-west-2'
+                }
+            )
+
+        assert write_arrow_tables_to_s3(s3_client, "testbucket", "person/x.parquet", iter([]), "parquet") == 0
+        assert "Contents" not in s3_client.list_objects_v2(Bucket="testbucket")
+
+
+class TestArrowFromRows:
+    def test_unregistered_columns_use_their_type_oids(self):
+        columns = [{"name": "id", "type_oid": 23}, {"name": "note", "type_oid": 1043},
+                   {"name": "at", "type_oid": 1114}]
+        chunks = [(["id", "note", "at"], [[1, None, datetime(2025, 6, 10, 9, 15)], [2, None, None]])]
+
+        table = next(convert_chunks_to_arrow(chunks, "not_registered", columns))
+
+        assert table.schema.types == [pa.int32(), pa.string(), pa.timestamp("us")]
+        assert table.column("id").to_pylist() == [1, 2]
+
+    def test_decimals_are_kept_without_a_dataframe(self):
+        table = next(convert_chunks_to_arrow([(["sales_order_id", "unit_price"], [[1, Decimal("3.94")]])],
+                                             "sales_order"))
+
+        assert table.column("unit_price").to_pylist() == [Decimal("3.94")]
+
+    def test_csv_from_rows_matches_the_pandas_layout(self):
+        rows = [[1, "GBP", datetime(2025, 6, 10, 9, 15)], [2, None, datetime(2025, 6, 10, 9, 16)]]
+        columns = ["currency_id", "currency_code", "last_updated"]
+
+        body = extract.rows_to_csv_bytes(columns, rows)
+
+        assert body == pd.DataFrame(rows, columns=columns).to_csv(lineterminator="\n").encode("utf-8")
+
+
+class TestPrimaryKeyRangePartitions:
+    def test_key_range_is_added_to_the_query(self):
+        query = build_extract_query("sales_order", "2020-01-01 00:00:00.000000", (1, 500))
+
+        assert "last_updated >" in query
+        assert '"sales_order_id" BETWEEN 1 AND 500' in query
+
+    def test_split_key_range_covers_every_key_once(self):
+        assert split_key_range(1, 10, 3) == [(1, 4), (5, 7), (8, 10)]
+        assert split_key_range(5, 6, 4) == [(5, 5), (6, 6)]
+
+    def test_only_partitioned_tables_are_split(self):
+        conn = FakeCursorConnection([], [])
+        conn.run = lambda query, **params: [[1, 100]]
+        config = {"partitions": {"sales_order": 2}}
+
+        tasks = plan_extract_tasks(["sales_order", "currency"], "2020-01-01 00:00:00.000000", conn, config)
+
+        assert tasks == [{"table": "sales_order", "key_range": (1, 50), "part": 0,
+                          "watermark": "2020-01-01 00:00:00.000000", "until": None},
+                         {"table": "sales_order", "key_range": (51, 100), "part": 1,
+                          "watermark": "2020-01-01 00:00:00.000000", "until": None},
+                         {"table": "currency", "key_range": None, "part": None,
+                          "watermark": "2020-01-01 00:00:00.000000", "until": None}]
+
+    def test_part_results_are_combined_per_table(self):
+        columns = [{"name": "sales_order_id", "type_oid": 23}]
+        task_results = [{"table": "sales_order", "row_count": 3, "keys": ["sales_order/x/part-00000.csv"],
+                         "bytes": 30, "columns": columns},
+                        {"table": "currency", "row_count": 0, "keys": [], "bytes": 0, "columns": []},
+                        {"table": "sales_order", "row_count": 2, "keys": ["sales_order/x/part-00001.csv"],
+                         "bytes": 20, "columns": columns}]
+
+        assert combine_task_results(task_results) == [
+            {"table": "sales_order", "row_count": 5,
+             "keys": ["sales_order/x/part-00000.csv", "sales_order/x/part-00001.csv"], "bytes": 50,
+             "columns": columns},
+            {"table": "currency", "row_count": 0, "keys": [], "bytes": 0, "columns": []}]
+
+
+class TestChangeProbe:
+    def test_probe_is_one_query_for_all_tables(self):
+        conn = FakeCursorConnection([], [])
+        probe_rows = [["sales_order", datetime(2025, 6, 10, 9, 15), 11000, None],
+                      ["department", datetime(2022, 11, 3, 14, 20, 49, 962000), 8, "abc"]]
+        conn.run = lambda query, **params: conn.queries.append(query) or probe_rows
+
+        table_changes = probe_table_changes(["sales_order", "department"], conn)
+
+        assert len(conn.queries) == 1
+        assert "md5(string_agg" in conn.queries[0].split("UNION ALL")[1]
+        assert table_changes["sales_order"] == {"max_last_updated": "2025-06-10 09:15:00.000000",
+                                                "row_count": 11000, "fingerprint": None}
+        assert table_changes["department"]["fingerprint"] == "abc"
+
+    def test_only_changed_tables_are_selected(self):
+        table_changes = {
+            "sales_order": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 5, "fingerprint": None},
+            "currency": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 3, "fingerprint": None},
+            "payment": {"max_last_updated": None, "row_count": 0, "fingerprint": None},
+            "department": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 8, "fingerprint": "abc"},
+        }
+
+        changed = select_changed_tables(table_changes, "2025-01-01 00:00:00.000000", {"department": "abc"})
+
+        assert changed == ["sales_order"]
+
+    def test_table_with_deleted_rows_is_selected(self):
+        table_changes = {
+            "sales_order": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 4, "fingerprint": None},
+            "currency": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 3, "fingerprint": None},
+            "payment": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 7, "fingerprint": None},
+        }
+
+        changed = select_changed_tables(table_changes, "2025-01-01 00:00:00.000000", {}, {},
+                                        {"sales_order": 5, "currency": 3})
+
+        # payment has no stored count yet, so only its watermark is compared
+        assert changed == ["sales_order"]
+
+    def test_full_scan_table_with_new_fingerprint_is_selected(self):
+        table_changes = {
+            "department": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 8, "fingerprint": "def"},
+        }
+
+        changed = select_changed_tables(table_changes, "2025-01-01 00:00:00.000000", {"department": "abc"})
+
+        assert changed == ["department"]
+
+
+@mock_aws
+class TestExtractState:
+    def test_state_is_empty_before_the_first_run(self, ssm_client):
+        assert get_extract_state(ssm_client) == {}
+
+    def test_state_round_trips_through_parameter_store(self, ssm_client):
+        update_extract_state(ssm_client, {"fingerprints": {"department": "abc"}})
+
+        assert get_extract_state(ssm_client) == {"fingerprints": {"department": "abc"}}
+
+
+class TestPerTableWatermarks:
+    def test_each_table_is_compared_with_its_own_watermark(self):
+        table_changes = {
+            "sales_order": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 5, "fingerprint": None},
+            "currency": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 3, "fingerprint": None},
+        }
+        watermarks = {"currency": "2025-06-10 09:15:00.000000"}
+
+        changed = select_changed_tables(table_changes, "2025-01-01 00:00:00.000000", {}, watermarks)
+
+        assert changed == ["sales_order"]
+
+    def test_tasks_read_from_the_table_watermark(self):
+        tasks = plan_extract_tasks(["sales_order", "currency"], "2025-01-01 00:00:00.000000", None,
+                                   {"partitions": {}}, {"sales_order": "2025-06-10 09:15:00.000000"})
+
+        assert [task["watermark"] for task in tasks] == ["2025-06-10 09:15:00.000000", "2025-01-01 00:00:00.000000"]
+
+    def test_only_successful_tables_advance_their_watermark(self):
+        extract_state = {"watermarks": {"payment": "2025-01-01 00:00:00.000000"}, "fingerprints": {"department": "abc"}}
+        table_changes = {
+            "sales_order": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 5, "fingerprint": None},
+            "payment": {"max_last_updated": "2025-06-10 09:14:00.000000", "row_count": 3, "fingerprint": None},
+            "department": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 8, "fingerprint": "def"},
+        }
+
+        new_state = advance_extract_state(extract_state, table_changes, ["sales_order", "payment", "department"],
+                                          ["payment"], "2025-01-01 00:00:00.000000")
+
+        assert new_state == {"watermarks": {"payment": "2025-01-01 00:00:00.000000",
+                                            "sales_order": "2025-06-10 09:15:00.000000"},
+                             "fingerprints": {"department": "def"}, "row_counts": {"sales_order": 5}}
+
+    def test_failed_table_on_first_run_keeps_the_last_checked_it_was_read_from(self):
+        table_changes = {
+            "sales_order": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 5, "fingerprint": None},
+            "payment": {"max_last_updated": "2025-06-10 09:14:00.000000", "row_count": 3, "fingerprint": None},
+            "currency": {"max_last_updated": "2022-11-03 14:20:49.962000", "row_count": 3, "fingerprint": None},
+        }
+
+        new_state = advance_extract_state({}, table_changes, ["sales_order", "payment"], ["sales_order"],
+                                          "2025-01-01 00:00:00.000000")
+
+        assert new_state["watermarks"] == {"sales_order": "2025-01-01 00:00:00.000000",
+                                           "payment": "2025-06-10 09:14:00.000000",
+                                           "currency": "2025-01-01 00:00:00.000000"}
+        # the next run, with last_checked moved on, still reads sales_order from the old point
+        assert select_changed_tables(table_changes, "2025-06-10 09:15:00.000000", {},
+                                     new_state["watermarks"]) == ["sales_order"]
+
+
+@mock_aws
+class TestBatchManifest:
+    def test_extract_result_describes_the_file(self, s3_client):
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        conn = FakeCursorConnection(["currency_id", "currency_code"], [[1, "GBP"], [2, "USD"]])
+        config = {"mode": "stream", "chunk_size": 1, "format": "csv"}
+
+        result = extract_table_to_s3("currency", "2020-01-01 00:00:00.000000", conn, s3_client, "testbucket", config)
+
+        size = s3_client.head_object(Bucket="testbucket",
+                                     Key="currency/2020-01-01 00:00:00.000000.csv")["ContentLength"]
+        assert result["bytes"] == size
+        assert result["columns"] == [{"name": "currency_id", "type_oid": None},
+                                     {"name": "currency_code", "type_oid": None}]
+
+    def test_unchanged_tables_are_carried_forward(self):
+        previous = build_batch_manifest("2020-01-01 00:00:00.000000", "csv",
+                                        [{"table": "department", "row_count": 8, "keys": ["department/2020.csv"],
+                                          "bytes": 80, "columns": []}], {})
+        results = [{"table": "staff", "row_count": 2, "keys": ["staff/2025.csv"], "bytes": 20, "columns": []},
+                   {"table": "design", "row_count": 0, "keys": [], "bytes": 0, "columns": [], "error": "boom"}]
+        table_changes = {"staff": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 2,
+                                   "fingerprint": None}}
+
+        manifest = build_batch_manifest("2025-06-10 09:15:00.000000", "csv", results, table_changes, previous)
+
+        assert manifest["tables"]["staff"] == {"changed": True, "batch": "2025-06-10 09:15:00.000000",
+                                               "keys": ["staff/2025.csv"], "format": "csv", "row_count": 2,
+                                               "bytes": 20, "columns": [],
+                                               "watermark": "2025-06-10 09:15:00.000000"}
+        assert manifest["tables"]["department"]["changed"] is False
+        assert manifest["tables"]["department"]["keys"] == ["department/2020.csv"]
+        assert "design" not in manifest["tables"]
+
+    def test_manifest_round_trips_through_s3(self, s3_client):
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        manifest = build_batch_manifest("2025-06-10 09:15:00.000000", "parquet", [], {})
+
+        key = upload_manifest(s3_client, "testbucket", manifest)
+
+        assert key == "manifests/2025-06-10 09:15:00.000000.json"
+        assert get_manifest(s3_client, "testbucket", key) == manifest
+        assert get_manifest(s3_client, "testbucket", None) is None
+
+
+class TestColdStart:
+    def test_importing_extract_does_not_load_dataframe_libraries(self):
+        code = ("import sys, src.lambda_handler.extract; "
+                "print(any(name in sys.modules for name in ['pandas', 'awswrangler', 'pyarrow']))")
+
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+
+        assert output.strip() == "False"
+
+    def test_clients_are_created_once_per_container(self, monkeypatch):
+        monkeypatch.setattr(extract, "AWS_CLIENTS", {})
+
+        assert extract.get_aws_client("ssm") is extract.get_aws_client("ssm")
+        assert list(extract.AWS_CLIENTS) == ["ssm"]
+
+    def test_import_time_is_only_reported_on_a_cold_start(self):
+        timings = {}
+        with extract.stage_timer(timings, "probe"):
+            pass
+
+        assert extract.startup_report(True, timings)["import_seconds"] == round(extract.IMPORT_SECONDS, 4)
+        assert extract.startup_report(False, timings) == {"cold_start": False, "import_seconds": 0.0,
+                                                          "stage_seconds": {"probe": timings["probe"]}}
+
+
+class TestWarmCache:
+    @pytest.fixture(autouse=True)
+    def empty_cache(self, monkeypatch):
+        monkeypatch.setattr(extract, "WARM_CACHE", {})
+        monkeypatch.setattr(extract, "DB_CONNECTIONS", {})
+        monkeypatch.delenv("CACHE_TTL_SECONDS", raising=False)
+
+    def test_value_is_fetched_once_until_its_ttl_runs_out(self, monkeypatch):
+        fetches = []
+        now = [100.0]
+        monkeypatch.setattr(extract.time, "monotonic", lambda: now[0])
+
+        def fetch():
+            fetches.append(1)
+            return len(fetches)
+
+        assert extract.get_cached("db_credentials", fetch) == 1
+        assert extract.get_cached("db_credentials", fetch) == 1
+        now[0] += 3600
+        assert extract.get_cached("db_credentials", fetch) == 2
+
+    def test_zero_ttl_turns_the_cache_off(self, monkeypatch):
+        monkeypatch.setenv("CACHE_TTL_SECONDS", "0")
+
+        extract.get_cached("db_credentials", lambda: {"DB_USER": "totesys"})
+
+        assert extract.WARM_CACHE == {}
+
+    def test_live_connection_is_reused(self, monkeypatch):
+        kept = FakeCursorConnection([], [])
+        extract.DB_CONNECTIONS["totesys"] = kept
+        monkeypatch.setattr(extract, "get_db_credentials", lambda sm_client: {"DB_USER": "totesys"})
+        monkeypatch.setattr(extract, "create_db_connection", lambda db_credentials: pytest.fail("reconnected"))
+
+        db_credentials, db_connection = extract.get_db_connection(None)
+
+        assert db_connection is kept
+        assert kept.queries == ["ROLLBACK"]
+
+    def test_dead_connection_is_reopened(self, monkeypatch):
+        dead = FakeCursorConnection([], [])
+        dead.run = lambda query, **params: (_ for _ in ()).throw(InterfaceError("network error"))
+        extract.DB_CONNECTIONS["totesys"] = dead
+        fresh = FakeCursorConnection([], [])
+        monkeypatch.setattr(extract, "get_db_credentials", lambda sm_client: {"DB_USER": "totesys"})
+        monkeypatch.setattr(extract, "create_db_connection", lambda db_credentials: fresh)
+
+        db_credentials, db_connection = extract.get_db_connection(None)
+
+        assert db_connection is fresh
+        assert dead.closed
+        assert extract.DB_CONNECTIONS["totesys"] is fresh
+
+    def test_rejected_credentials_are_fetched_again(self, monkeypatch):
+        secrets = iter([{"DB_PASSWORD": "old"}, {"DB_PASSWORD": "rotated"}])
+        monkeypatch.setattr(extract, "get_db_credentials", lambda sm_client: next(secrets))
+
+        def fake_create_db_connection(db_credentials):
+            if db_credentials["DB_PASSWORD"] == "old":
+                raise DatabaseError({"S": "FATAL", "C": "28P01", "M": "password authentication failed"})
+            return FakeCursorConnection([], [])
+
+        monkeypatch.setattr(extract, "create_db_connection", fake_create_db_connection)
+
+        db_credentials, db_connection = extract.get_db_connection(None)
+
+        assert db_credentials == {"DB_PASSWORD": "rotated"}
+        assert extract.cache_get("db_credentials") == {"DB_PASSWORD": "rotated"}
+
+
+class FakeCopyConnection(FakeCursorConnection):
+    """Answers COPY ... TO STDOUT by writing csv bytes to the stream, like pg8000 does."""
+    def __init__(self, column_names, csv_bytes, row_count):
+        super().__init__(column_names, [])
+        self.csv_bytes = csv_bytes
+        self.copied_rows = row_count
+        self.row_count = -1
+
+    def run(self, query, stream=None, **params):
+        self.queries.append(query)
+        if query.startswith("COPY"):
+            stream.write(self.csv_bytes)
+            self.row_count = self.copied_rows
+        return []
+
+
+@mock_aws
+class TestCopyEngine:
+    def test_copy_output_is_streamed_to_s3_untouched(self, s3_client):
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        csv_bytes = b"currency_id,currency_code\n1,GBP\n2,USD\n"
+        conn = FakeCopyConnection(["currency_id", "currency_code"], csv_bytes, 2)
+        config = {"mode": "batch", "format": "csv", "engines": {"currency": "copy"}}
+
+        result = extract_table_to_s3("currency", "2020-01-01 00:00:00.000000", conn, s3_client, "testbucket", config)
+
+        body = s3_client.get_object(Bucket="testbucket", Key="currency/2020-01-01 00:00:00.000000.csv")["Body"].read()
+        assert body == csv_bytes
+        assert result["row_count"] == 2
+        assert result["bytes"] == len(csv_bytes)
+        assert result["columns"] == [{"name": "currency_id", "type_oid": None},
+                                     {"name": "currency_code", "type_oid": None}]
+        assert conn.queries[-1].startswith("COPY (")
+        assert conn.queries[-1].endswith("TO STDOUT WITH (FORMAT csv, HEADER true)")
+
+    def test_no_file_when_nothing_is_copied(self, s3_client):
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        conn = FakeCopyConnection(["currency_id"], b"currency_id\n", 0)
+        config = {"mode": "batch", "format": "csv", "engine": "copy"}
+
+        result = extract_table_to_s3("currency", "2020-01-01 00:00:00.000000", conn, s3_client, "testbucket", config)
+
+        assert result["keys"] == []
+        assert "Contents" not in s3_client.list_objects_v2(Bucket="testbucket")
+
+    def test_engine_is_chosen_per_table(self, monkeypatch):
+        monkeypatch.setenv("EXTRACT_ENGINES", "sales_order=copy")
+        monkeypatch.delenv("EXTRACT_ENGINE", raising=False)
+        monkeypatch.delenv("INGESTION_FORMAT", raising=False)
+
+        config = get_extract_config()
+
+        assert extract.get_table_engine("sales_order", config) == "copy"
+        assert extract.get_table_engine("currency", config) == "select"
+
+    def test_copy_engine_needs_csv(self, monkeypatch):
+        monkeypatch.setenv("EXTRACT_ENGINE", "copy")
+        monkeypatch.setenv("INGESTION_FORMAT", "parquet")
+
+        with pytest.raises(ValueError):
+            get_extract_config()
+
+
+class TestColumnProjection:
+    def test_registered_tables_select_only_their_columns(self):
+        select_columns = extract.get_table_columns("counterparty", {"full_fidelity": False})
+        query = build_extract_query("counterparty", "2020-01-01 00:00:00.000000", select_columns=select_columns)
+
+        assert ('SELECT "counterparty_id", "counterparty_legal_name", "legal_address_id", "last_updated" '
+                'FROM "counterparty"') in query
+        assert "last_updated >" in query
+
+    def test_registered_tables_keep_last_updated_for_the_transform_snapshots(self):
+        assert all("last_updated" in columns for columns in extract.COLUMN_REGISTRY.values())
+
+    def test_full_fidelity_and_unregistered_tables_select_everything(self):
+        assert extract.get_table_columns("counterparty", {"full_fidelity": True}) is None
+        assert extract.get_table_columns("sales_order", {"full_fidelity": False}) is None
+        assert "SELECT * FROM" in build_extract_query("sales_order", "2020-01-01 00:00:00.000000")
+
+    def test_full_fidelity_switch_is_read_from_environment(self, monkeypatch):
+        monkeypatch.setenv("EXTRACT_FULL_FIDELITY", "true")
+
+        assert get_extract_config()["full_fidelity"] is True
+
+    def test_extract_uses_the_projected_query(self):
+        conn = FakeCursorConnection(["design_id"], [])
+
+        extract_table_to_s3("design", "2020-01-01 00:00:00.000000", conn, None, "testbucket",
+                            {"mode": "batch", "format": "csv", "full_fidelity": False})
+
+        assert ('SELECT "design_id", "design_name", "file_location", "file_name", "last_updated" '
+                'FROM "design"') in conn.queries[0]
+
+
+class TestSourceSchema:
+    def test_arrow_chunks_get_the_registry_types(self):
+        chunks = [(["address_id", "address_line_2"], [[1, None]]), (["address_id", "address_line_2"], [[2, "Flat 1"]])]
+
+        tables = list(convert_chunks_to_arrow(chunks, "address"))
+
+        assert tables[0].schema == tables[1].schema
+        assert tables[0].schema.field("address_line_2").type == pa.string()
+
+    def test_numerics_keep_their_precision_and_scale(self):
+        schema = extract.source_arrow_schema("sales_order", ["sales_order_id", "unit_price"])
+
+        assert schema.field("unit_price").type == pa.decimal128(10, 2)
+        assert extract.source_arrow_schema("sales_order", ["not_registered"]) is None
+
+    def test_drift_lists_missing_new_and_retyped_columns(self):
+        conn = FakeCursorConnection([], [])
+        expected = [["currency", name, extract.SCHEMA_DATA_TYPES[column_type]]
+                    for name, column_type in extract.SOURCE_SCHEMA["currency"].items() if name != "created_at"]
+        expected[0][2] = "bigint"
+        conn.run = lambda query, **params: expected + [["currency", "symbol", "character varying"]]
+
+        drift = extract.check_schema_drift(conn, ["currency"])
+
+        assert drift == ["currency.currency_id: integer in SOURCE_SCHEMA, bigint in the database",
+                         "currency.created_at: in SOURCE_SCHEMA, missing from the database",
+                         "currency.symbol: in the database, missing from SOURCE_SCHEMA"]
+
+    def test_drift_only_stops_the_run_when_asked(self):
+        extract.enforce_schema(["currency.symbol: in the database, missing from SOURCE_SCHEMA"], "warn")
+
+        with pytest.raises(ValueError):
+            extract.enforce_schema(["currency.symbol: in the database, missing from SOURCE_SCHEMA"], "fail")
+
+
+@mock_aws
+class TestIngestionCodecs:
+    def test_codecs_are_read_per_table(self, monkeypatch):
+        monkeypatch.setenv("INGESTION_FORMAT", "parquet")
+        monkeypatch.setenv("INGESTION_CODECS", "sales_order=zstd:9")
+        monkeypatch.delenv("INGESTION_CODEC", raising=False)
+        monkeypatch.delenv("EXTRACT_ENGINE", raising=False)
+        monkeypatch.delenv("EXTRACT_ENGINES", raising=False)
+
+        config = get_extract_config()
+
+        assert extract.get_table_codec("sales_order", config) == {"name": "zstd", "level": 9}
+        assert extract.get_table_codec("currency", config) == {"name": "snappy", "level": None}
+
+    def test_codec_must_suit_the_format(self, monkeypatch):
+        monkeypatch.setenv("INGESTION_FORMAT", "csv")
+        monkeypatch.setenv("INGESTION_CODEC", "snappy")
+
+        with pytest.raises(ValueError):
+            get_extract_config()
+
+    def test_compressed_csv_holds_the_same_rows(self, s3_client):
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        rows = [[i, f"name {i}"] for i in range(100)]
+        config = {"mode": "stream", "chunk_size": 30, "format": "csv",
+                  "codecs": {"staff": {"name": "zstd", "level": 3}}}
+
+        result = extract_table_to_s3("staff", "2020-01-01 00:00:00.000000", FakeCursorConnection(["id", "name"], rows),
+                                     s3_client, "testbucket", config)
+        extract_table_to_s3("design", "2020-01-01 00:00:00.000000", FakeCursorConnection(["id", "name"], rows),
+                            s3_client, "testbucket", config)
+
+        assert result["keys"] == ["staff/2020-01-01 00:00:00.000000.csv.zst"]
+        compressed = s3_client.get_object(Bucket="testbucket", Key=result["keys"][0])["Body"].read()
+        plain = s3_client.get_object(Bucket="testbucket", Key="design/2020-01-01 00:00:00.000000.csv")["Body"].read()
+        assert pa.input_stream(pa.py_buffer(compressed), compression="zstd").read() == plain
+        assert len(compressed) < len(plain)
+
+    def test_compressed_writer_writes_one_frame_per_block(self):
+        raw = io.BytesIO()
+        writer = extract.CompressedWriter(raw, {"name": "gzip", "level": 1}, block_size=10)
+
+        for _ in range(5):
+            writer.write(b"0123456789")
+        writer.close()
+
+        assert gzip.decompress(raw.getvalue()) == b"0123456789" * 5
+        assert not raw.closed
+
+    def test_parquet_codec_and_level_are_used(self, s3_client):
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        table = pa.table({"id": list(range(10))})
+
+        write_arrow_tables_to_s3(s3_client, "testbucket", "person/x.parquet", [table], "parquet",
+                                 {"name": "zstd", "level": 9})
+
+        body = s3_client.get_object(Bucket="testbucket", Key="person/x.parquet")["Body"].read()
+        metadata = pa.parquet.ParquetFile(io.BytesIO(body)).metadata
+        assert metadata.row_group(0).column(0).compression == "ZSTD"
+
+
+class FakeBackfillConnection(FakeCursorConnection):
+    """Answers the backfill plan queries and returns the rows inside a query's key range."""
+    def run(self, query, **params):
+        self.queries.append(query)
+        if query.startswith("SELECT localtimestamp"):
+            return [[datetime(2025, 6, 10, 9, 15)]]
+        if "SELECT min(" in query:
+            return [[self.rows[0][0], self.rows[-1][0]]]
+        if "md5(string_agg" in query:
+            return [["department", datetime(2022, 11, 3, 14, 20), 8, "9e107d9d"]]
+        if "BETWEEN" in query:
+            first_key, last_key = [int(key) for key in query.split("BETWEEN")[1].split()[0:3:2]]
+            return [row for row in self.rows if first_key <= row[0] <= last_key]
+        return []
+
+
+class TestBackfill:
+    @pytest.fixture(autouse=True)
+    def backfill_setup(self, monkeypatch, ssm_client, s3_client):
+        with mock_aws():
+            self.set_up(monkeypatch, ssm_client, s3_client)
+            yield
+
+    def set_up(self, monkeypatch, ssm_client, s3_client):
+        monkeypatch.setattr(extract, "WARM_CACHE", {})
+        monkeypatch.setenv("S3_INGESTION_BUCKET", "testbucket")
+        monkeypatch.setenv("BACKFILL_CHUNK_KEYS", "3")
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        ssm_client.put_parameter(Name="last_checked", Value="2020-01-01 00:00:00.000000", Type="String")
+        self.conn = FakeBackfillConnection(["currency_id", "currency_code"],
+                                           [[1, "GBP"], [2, "USD"], [3, "EUR"], [4, "JPY"], [5, "CHF"]])
+        monkeypatch.setattr(extract, "get_db_connection", lambda sm_client: ({}, self.conn))
+
+    def run_backfill(self, ssm_client, s3_client, backfill_event):
+        return extract.run_backfill(backfill_event, ssm_client, None, s3_client)
+
+    def test_plan_splits_tables_into_key_chunks(self, ssm_client, s3_client):
+        plan = self.run_backfill(ssm_client, s3_client, {"action": "plan", "tables": ["currency"]})
+
+        assert plan["as_of"] == "2025-06-10 09:15:00.000000"
+        assert [chunk["backfill"]["key_range"] for chunk in plan["chunks"]] == [[1, 3], [4, 5]]
+        assert plan["chunks"][0]["backfill"] == {"action": "chunk", "backfill_id": "2020-01-01 00:00:00.000000",
+                                                 "table": "currency", "part": 0, "key_range": [1, 3]}
+
+    def test_chunk_reads_up_to_as_of_and_is_checkpointed(self, ssm_client, s3_client):
+        plan = self.run_backfill(ssm_client, s3_client, {"action": "plan", "tables": ["currency"]})
+
+        first = self.run_backfill(ssm_client, s3_client, plan["chunks"][0]["backfill"])
+        again = self.run_backfill(ssm_client, s3_client, plan["chunks"][0]["backfill"])
+
+        assert first == {"table": "currency", "part": 0, "row_count": 3, "skipped": False}
+        assert again["skipped"] is True
+        assert any("last_updated <= '2025-06-10T09:15:00'" in query for query in self.conn.queries)
+        s3_client.head_object(Bucket="testbucket", Key="currency/2020-01-01 00:00:00.000000/part-00000.csv")
+
+    def test_planning_again_resumes_with_the_missing_chunks(self, ssm_client, s3_client, monkeypatch):
+        plan = self.run_backfill(ssm_client, s3_client, {"action": "plan", "tables": ["currency"]})
+        self.run_backfill(ssm_client, s3_client, plan["chunks"][0]["backfill"])
+        monkeypatch.setattr(extract, "get_db_connection", lambda sm_client: pytest.fail("planned again"))
+
+        resumed = self.run_backfill(ssm_client, s3_client, {"action": "plan", "tables": ["currency"]})
+
+        assert resumed["as_of"] == plan["as_of"]
+        assert [chunk["backfill"]["part"] for chunk in resumed["chunks"]] == [1]
+
+    def test_finish_needs_every_chunk(self, ssm_client, s3_client):
+        plan = self.run_backfill(ssm_client, s3_client, {"action": "plan", "tables": ["currency"]})
+        self.run_backfill(ssm_client, s3_client, plan["chunks"][0]["backfill"])
+
+        with pytest.raises(RuntimeError):
+            self.run_backfill(ssm_client, s3_client, {"action": "finish", "backfill_id": plan["backfill_id"]})
+        assert get_last_checked(ssm_client)["last_checked"] == "2020-01-01 00:00:00.000000"
+
+    def test_finish_writes_the_manifest_and_moves_the_watermarks(self, ssm_client, s3_client):
+        plan = self.run_backfill(ssm_client, s3_client, {"action": "plan", "tables": ["currency"]})
+        for chunk in plan["chunks"]:
+            self.run_backfill(ssm_client, s3_client, chunk["backfill"])
+
+        result = self.run_backfill(ssm_client, s3_client, {"action": "finish", "backfill_id": plan["backfill_id"]})
+
+        manifest = get_manifest(s3_client, "testbucket", result["manifest_key"])
+        assert manifest["tables"]["currency"]["row_count"] == 5
+        assert manifest["tables"]["currency"]["keys"] == [
+            "currency/2020-01-01 00:00:00.000000/part-00000.csv",
+            "currency/2020-01-01 00:00:00.000000/part-00001.csv"]
+        assert result["timestamp_to_transform"] == "2020-01-01 00:00:00.000000"
+        assert get_last_checked(ssm_client)["last_checked"] == "2025-06-10 09:15:00.000000"
+        assert get_extract_state(ssm_client)["watermarks"] == {"currency": "2025-06-10 09:15:00.000000"}
+
+    def test_finish_stores_the_fingerprint_of_the_full_scan_tables(self, ssm_client, s3_client):
+        plan = self.run_backfill(ssm_client, s3_client, {"action": "plan", "tables": ["currency", "department"]})
+        for chunk in plan["chunks"]:
+            self.run_backfill(ssm_client, s3_client, chunk["backfill"])
+
+        self.run_backfill(ssm_client, s3_client, {"action": "finish", "backfill_id": plan["backfill_id"]})
+
+        # the next normal run finds department unchanged and does not extract it again
+        assert get_extract_state(ssm_client)["fingerprints"] == {"department": "9e107d9d"}
+
+
+class TestAdaptiveWindows:
+    def boundary_connection(self, boundaries):
+        """Only sales_order has more rows than the budget."""
+        conn = FakeCursorConnection([], [])
+
+        def run(query, **params):
+            conn.queries.append(query)
+            return [[boundary] for boundary in boundaries] if '"sales_order"' in query else []
+
+        conn.run = run
+        return conn
+
+    def test_window_within_budget_is_one_task(self):
+        conn = self.boundary_connection([])
+
+        tasks = plan_extract_tasks(["sales_order"], "2025-01-01 00:00:00.000000", conn,
+                                   {"partitions": {}, "row_budget": 1000})
+
+        assert tasks == [{"table": "sales_order", "key_range": None, "part": None,
+                          "watermark": "2025-01-01 00:00:00.000000", "until": None}]
+        assert "position % 1000 = 0" in conn.queries[0]
+
+    def test_large_window_is_split_into_sub_windows(self):
+        conn = self.boundary_connection([datetime(2025, 2, 1), datetime(2025, 3, 1)])
+
+        tasks = plan_extract_tasks(["sales_order"], "2025-01-01 00:00:00.000000", conn,
+                                   {"partitions": {}, "row_budget": 1000})
+
+        assert [(task["part"], task["watermark"], task["until"]) for task in tasks] == [
+            (0, "2025-01-01 00:00:00.000000", "2025-02-01 00:00:00.000000"),
+            (1, "2025-02-01 00:00:00.000000", "2025-03-01 00:00:00.000000"),
+            (2, "2025-03-01 00:00:00.000000", None)]
+
+    def test_sub_window_reads_between_its_bounds(self):
+        query = build_extract_query("sales_order", "2025-02-01 00:00:00.000000",
+                                    until="2025-03-01 00:00:00.000000")
+
+        assert "last_updated > '2025-02-01T00:00:00' AND last_updated <= '2025-03-01T00:00:00'" in query
+
+    def test_full_scan_tables_are_never_split(self):
+        conn = self.boundary_connection([datetime(2025, 2, 1)])
+
+        tasks = plan_extract_tasks(["department"], "2025-01-01 00:00:00.000000", conn,
+                                   {"partitions": {}, "row_budget": 1})
+
+        assert len(tasks) == 1
+        assert conn.queries == []
+
+    def test_deferred_windows_hold_back_the_watermark(self):
+        conn = self.boundary_connection([datetime(2025, 2, 1), datetime(2025, 3, 1)])
+        tasks = plan_extract_tasks(["sales_order", "currency"], "2025-01-01 00:00:00.000000", conn,
+                                   {"partitions": {}, "row_budget": 1000, "max_windows": 2})
+        table_changes = {
+            "sales_order": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 5, "fingerprint": None},
+            "currency": {"max_last_updated": "2025-06-10 09:15:00.000000", "row_count": 3, "fingerprint": None},
+        }
+
+        limited = extract.limit_table_changes(table_changes, tasks)
+
+        assert len([task for task in tasks if task["table"] == "sales_order"]) == 2
+        assert limited["sales_order"]["max_last_updated"] == "2025-03-01 00:00:00.000000"
+        assert limited["currency"] == table_changes["currency"]
+
+
+def wal2json_change(action, table, columns=None, identity=None):
+    change = {"action": action, "schema": "public", "table": table}
+    if columns is not None:
+        change["columns"] = columns
+    if identity is not None:
+        change["identity"] = identity
+    return json.dumps(change)
+
+
+def currency_columns(currency_id, code, updated):
+    return [{"name": "currency_id", "type": "integer", "typeoid": 23, "value": currency_id},
+            {"name": "currency_code", "type": "character varying(3)", "typeoid": 1043, "value": code},
+            {"name": "last_updated", "type": "timestamp without time zone", "typeoid": 1114, "value": updated}]
+
+
+class TestCdcEngine:
+    def slot_connection(self, changes):
+        conn = FakeCursorConnection([], [])
+
+        def run(query, **params):
+            conn.queries.append(query)
+            return [[f"0/{index + 1:X}", data] for index, data in enumerate(changes)]
+
+        conn.run = run
+        return conn
+
+    def test_changes_are_folded_to_one_row_per_key(self):
+        conn = self.slot_connection([
+            json.dumps({"action": "B"}),
+            wal2json_change("I", "currency", currency_columns(1, "GBP", "2025-06-10 09:00:00")),
+            wal2json_change("U", "currency", currency_columns(1, "EUR", "2025-06-10 09:05:00.5")),
+            wal2json_change("I", "currency", currency_columns(2, "USD", "2025-06-10 09:06:00")),
+            wal2json_change("D", "currency", identity=[{"name": "currency_id", "type": "integer", "value": 2}]),
+            json.dumps({"action": "C"}),
+        ])
+
+        table_changes, last_lsn, change_count = extract.read_replication_changes(conn, "funland_cdc",
+                                                                                 ["currency"], 100)
+
+        currency = table_changes["currency"]
+        assert last_lsn == "0/6"
+        assert change_count == 4
+        assert currency["upserts"] == {1: [1, "EUR", datetime(2025, 6, 10, 9, 5, 0, 500000)]}
+        assert currency["deletes"] == {2: [2]}
+        assert "pg_logical_slot_peek_changes" in conn.queries[0]
+
+    def test_numeric_values_stay_exact(self):
+        column = {"name": "unit_price", "type": "numeric(10,2)", "value": "3.10"}
+
+        assert extract.parse_cdc_value(column) == Decimal("3.10")
+
+    @mock_aws
+    def test_upserts_and_deletes_are_written_and_listed(self, s3_client):
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        changes = {"columns": [{"name": "currency_id", "type_oid": 23}, {"name": "currency_code", "type_oid": 1043},
+                               {"name": "last_updated", "type_oid": 1114}],
+                   "upserts": {1: [1, "EUR", datetime(2025, 6, 10, 9, 5)]}, "deletes": {2: [2]},
+                   "key_columns": ["currency_id"], "change_count": 3}
+
+        result = extract.write_table_changes(s3_client, "testbucket", "currency", "2025-06-10 09:00:00.000000",
+                                             changes, {"format": "csv"})
+        manifest = build_batch_manifest("2025-06-10 09:00:00.000000", "csv", [result], {})
+
+        deleted = s3_client.get_object(Bucket="testbucket", Key=result["deletes"][0])["Body"].read().decode()
+        assert result["keys"] == ["currency/2025-06-10 09:00:00.000000.csv"]
+        assert result["deletes"] == ["deletes/currency/2025-06-10 09:00:00.000000.csv"]
+        assert pd.read_csv(io.StringIO(deleted))["currency_id"].tolist() == [2]
+        assert manifest["tables"]["currency"]["deletes"] == result["deletes"]
+
+    def test_cdc_run_advances_the_watermarks_of_the_tables_it_wrote(self, monkeypatch):
+        conn = FakeCursorConnection([], [])
+        conn.run = lambda query, **params: conn.queries.append(query) or [[datetime(2025, 6, 10, 9, 15)]]
+        changes = {"columns": [{"name": "currency_id", "type_oid": 23}, {"name": "currency_code", "type_oid": 1043}],
+                   "upserts": {1: [1, "EUR"]}, "deletes": {}, "key_columns": ["currency_id"], "change_count": 1}
+        monkeypatch.setattr(extract, "get_db_connection", lambda sm_client: ({}, conn))
+        monkeypatch.setattr(extract, "ensure_replication_slot", lambda db_connection, slot_name: None)
+        monkeypatch.setattr(extract, "read_replication_changes",
+                            lambda *args: ({"currency": changes}, "0/1A", 1))
+
+        with mock_aws():
+            s3_client = boto3.client("s3", region_name="eu-west-2")
+            ssm_client = boto3.client("ssm", region_name="eu-west-2")
+            s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+            update_extract_state(ssm_client, {"watermarks": {"currency": "2025-01-01 00:00:00.000000",
+                                                             "payment": "2025-01-01 00:00:00.000000"}})
+
+            extract.run_cdc_extract(["currency", "payment"], "2025-06-10 09:00:00.000000", ssm_client, None,
+                                    s3_client, "testbucket", {"format": "csv"}, False, {},
+                                    extract.new_run_metrics())
+
+            watermarks = get_extract_state(ssm_client)["watermarks"]
+        assert watermarks == {"currency": "2025-06-10 09:15:00.000000", "payment": "2025-01-01 00:00:00.000000"}
+
+    def test_only_select_and_copy_can_be_set_per_table(self, monkeypatch):
+        monkeypatch.setenv("EXTRACT_ENGINE", "cdc")
+        monkeypatch.setenv("EXTRACT_ENGINES", "sales_order=cdc")
+        monkeypatch.delenv("INGESTION_FORMAT", raising=False)
+
+        with pytest.raises(ValueError):
+            get_extract_config()
+
+
+@mock_aws
+class TestRunMetrics:
+    def test_measure_counts_s3_requests_and_bytes(self):
+        extract.install_s3_meter()
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        s3_client.create_bucket(Bucket="testbucket", CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+
+        with extract.measure() as record:
+            s3_client.put_object(Bucket="testbucket", Key="a", Body=b"12345")
+            s3_client.get_object(Bucket="testbucket", Key="a")["Body"].read()
+
+        assert record["s3_requests"] == 2
+        assert record["bytes_written"] == 5
+        assert record["bytes_read"] == 5
+        assert record["peak_memory_mb"] > 0
+
+    def test_stage_records_are_kept_in_the_run_metrics(self):
+        metrics = extract.new_run_metrics()
+        timings = {}
+
+        with extract.stage_timer(timings, "extract", metrics) as stage:
+            stage["rows_out"] = 10
+
+        assert metrics["stages"]["extract"]["rows_out"] == 10
+        assert metrics["stages"]["extract"]["seconds"] == timings["extract"]
+
+    def test_task_metrics_are_added_up_per_table(self):
+        task_results = [{"table": "sales_order", "row_count": 3, "keys": [], "bytes": 30, "columns": [],
+                         "metrics": {"rows_out": 3, "seconds": 1.0, "peak_memory_mb": 200.0}},
+                        {"table": "sales_order", "row_count": 2, "keys": [], "bytes": 20, "columns": [],
+                         "metrics": {"rows_out": 2, "seconds": 0.5, "peak_memory_mb": 250.0}}]
+
+        assert combine_task_results(task_results)[0]["metrics"] == {"rows_out": 5, "seconds": 1.5,
+                                                                    "peak_memory_mb": 250.0}
+
+    def test_metrics_are_printed_as_embedded_metric_format(self, capsys):
+        metrics = {"stages": {"extract": {"rows_in": 10, "rows_out": 10, "seconds": 2.0, "s3_requests": 3,
+                                          "bytes_read": 0, "bytes_written": 100, "peak_memory_mb": 200.0}},
+                   "tables": {}}
+
+        extract.emit_metrics("extract", metrics)
+
+        line = json.loads(capsys.readouterr().out)
+        directive = line["_aws"]["CloudWatchMetrics"][0]
+        assert directive["Dimensions"] == [["Function", "Stage"]]
+        assert {"Name": "rows_per_second", "Unit": "Count/Second"} in directive["Metrics"]
+        assert line["Function"] == "extract" and line["Stage"] == "extract"
+        assert line["rows_per_second"] == 5.0
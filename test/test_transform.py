@@ -1,15 +1,26 @@
 from src.lambda_handler.transform import (dim_design, check_file_exists_in_ingestion_bucket, dim_currency,
                                           check_file_exists_in_ingestion_bucket, dim_staff, dim_counterparty,
-                                          dim_location, fact_sales_order, dim_date)
+                                          dim_location, fact_sales_order, dim_date, read_ingestion_file,
+                                          find_ingestion_keys, find_latest_ingestion_keys, get_batch_manifest,
+                                          processed_parquet_options)
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import io
 import pytest
 import boto3
 import awswrangler as wr
 from datetime import datetime, date, time
+from decimal import Decimal
 import pandas as pd
 from moto import mock_aws
 import os
+import subprocess
+import sys
+import threading
 import numpy as np
 from pandas.testing import assert_series_equal
+import src.lambda_handler.transform as transform
 
 
 
@@ -132,6 +143,36 @@ class TestDimDesignFunction:
         # assert len(df_expected.values[0]) == len(df_result.values[0])
         # assert all([a == b for a, b in zip(df_result.values[0], df_expected.values[0])])
 
+    def test_reads_a_parquet_ingestion_file(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        s3_client.create_bucket(
+        Bucket='processed-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        file_marker = "1995-01-01 00:00:00.000000"
+        columns = ['design_id', 'created_at', 
+                'last_updated', 'design_name', 
+                'file_location', 'file_name']
+        new_rows = [
+            [0,datetime(2022, 11, 3, 14, 20, 49, 962000), datetime(2022, 11, 3, 14, 20, 49, 962000),
+             'Wooden', '/usr', 'wooden-20220717-npgz.json' ]
+        ]
+        df = pd.DataFrame(new_rows, columns = columns)
+        wr.s3.to_parquet(df, f"s3://ingestion-bucket-124-33/design/{file_marker}.parquet")
+
+        dim_design(last_checked=file_marker, ingestion_bucket="ingestion-bucket-124-33",
+                   processed_bucket='processed-bucket-124-33', ingestion_format="parquet")
+
+        df_result = wr.s3.read_parquet(f"s3://processed-bucket-124-33/dim_design/{file_marker}.parquet")
+        assert list(df_result.values[0]) == [0, 'Wooden', '/usr', 'wooden-20220717-npgz.json']
+
     #def test_logs_error_if_wrong_last_checked_arg_passed(self, s3_client):
     
     
@@ -194,6 +235,38 @@ class TestDimStaffFunction:
 
         assert list(df_result.values[0]) == list(df_expected.values[0])
 
+    def test_unchanged_department_falls_back_to_its_latest_file(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        s3_client.create_bucket(
+        Bucket='processed-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        staff_df = pd.DataFrame([[1, 'Jeremie', 'Franey', 2, 'jeremie.franey@terrifictotes.com',
+                                  datetime(2022, 11, 3, 14, 20, 51, 563000),
+                                  datetime(2022, 11, 3, 14, 20, 51, 563000)]],
+                                columns=['staff_id', 'first_name', 'last_name', 'department_id', 'email_address',
+                                         'created_at', 'last_updated'])
+        wr.s3.to_csv(staff_df, "s3://ingestion-bucket-124-33/staff/2025-06-10 09:15:00.000000.csv")
+        department_df = pd.DataFrame([[2, 'Purchasing', 'Manchester', 'Naomi Lapaglia',
+                                       datetime(2022, 11, 3, 14, 20, 49, 962000),
+                                       datetime(2022, 11, 3, 14, 20, 49, 962000)]],
+                                     columns=['department_id', 'department_name', 'location',
+                                              'manager', 'created_at', 'last_updated'])
+        wr.s3.to_csv(department_df, "s3://ingestion-bucket-124-33/department/1995-01-01 00:00:00.000000.csv")
+
+        dim_staff(last_checked="2025-06-10 09:15:00.000000", ingestion_bucket="ingestion-bucket-124-33",
+                  processed_bucket='processed-bucket-124-33')
+
+        df_result = wr.s3.read_parquet("s3://processed-bucket-124-33/dim_staff/2025-06-10 09:15:00.000000.parquet")
+        assert list(df_result["department_name"]) == ['Purchasing']
+
 @mock_aws
 class TestDimLocationFunction:
     def test_dim_location_file_lands_in_processed_bucket(self, s3_client):
@@ -349,7 +422,7 @@ class TestDimCounterpartyFunction:
         
         #read the file from processed bucket
         df_result = wr.s3.read_parquet(f"s3://processed-bucket-124-33/dim_counterparty/1995-01-01 00:00:00.000000.parquet")
-        df_result = df_result.replace(np.nan, None)
+        df_result = df_result.astype(object).where(df_result.notna(), None)
         
         dim_counterparty_columns=[
         'counterparty_id', 
@@ -373,6 +446,38 @@ class TestDimCounterpartyFunction:
         assert list(df_result.values[0]) == list(df_expected.values[0])
         assert set(df_result.columns) == set(df_expected.columns)
 
+    def test_projected_ingestion_files_give_the_same_columns(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        s3_client.create_bucket(
+        Bucket='processed-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        file_marker = "1995-01-01 00:00:00.000000"
+        # only the columns extract selects for these tables (COLUMN_REGISTRY)
+        df_counterparty = pd.DataFrame([[1, 'Fahey and Sons', 15]],
+                                       columns=['counterparty_id', 'counterparty_legal_name', 'legal_address_id'])
+        wr.s3.to_csv(df_counterparty, f"s3://ingestion-bucket-124-33/counterparty/{file_marker}.csv")
+        df_address = pd.DataFrame([[15, '605 Haskell Trafficway', 'Axel Freeway', None, 'East Bobbie', '88253-4257',
+                                    'Heard Island and McDonald Islands', '9687 937447']],
+                                  columns=['address_id', 'address_line_1', 'address_line_2', 'district', 'city',
+                                           'postal_code', 'country', 'phone'])
+        wr.s3.to_csv(df_address, f"s3://ingestion-bucket-124-33/address/{file_marker}.csv")
+
+        dim_counterparty(file_marker, "ingestion-bucket-124-33", 'processed-bucket-124-33', s3_client)
+
+        df_result = wr.s3.read_parquet(f"s3://processed-bucket-124-33/dim_counterparty/{file_marker}.parquet")
+        assert set(df_result.columns) == {
+            'counterparty_id', 'counterparty_legal_name', 'counterparty_legal_address_line_1',
+            'counterparty_legal_address_line_2', 'counterparty_legal_district', 'counterparty_legal_city',
+            'counterparty_legal_postal_code', 'counterparty_legal_country', 'counterparty_legal_phone_number'}
+
 
 @mock_aws
 class TestDimDateFunction:
@@ -492,7 +597,7 @@ class TestFactSalesOrderFunction:
         date(2022,11,3), time(14, 20, 52, 186000), 
         date(2022,11,3), time(14, 20, 52, 186000), 
         19, 8,
-        42972, 3.94,
+        42972, Decimal("3.94"),
         2, 3,
         date(2022,11,8),date(2022,11,7),
         8]]
@@ -514,6 +619,286 @@ class TestFactSalesOrderFunction:
 
 
 
+@mock_aws
+class TestKeyIndex:
+    def test_lookups_are_answered_from_one_listing(self, s3_client):
+        s3_client.create_bucket(Bucket='ingestion-bucket-124-33',
+                                CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        for key in ["currency/2025-01-01 00:00:00.000000.csv", "staff/2025-01-01 00:00:00.000000/part-00000.csv",
+                    "staff/2025-01-01 00:00:00.000000/part-00001.csv"]:
+            s3_client.put_object(Bucket='ingestion-bucket-124-33', Key=key, Body=b"x")
+
+        try:
+            assert transform.build_key_index(s3_client, 'ingestion-bucket-124-33', ["currency", "staff"]) == 3
+            # the index is not refreshed by later writes, so these answers cannot come from S3
+            s3_client.delete_object(Bucket='ingestion-bucket-124-33', Key="currency/2025-01-01 00:00:00.000000.csv")
+
+            assert check_file_exists_in_ingestion_bucket('ingestion-bucket-124-33',
+                                                         "currency/2025-01-01 00:00:00.000000.csv")
+            assert not check_file_exists_in_ingestion_bucket('ingestion-bucket-124-33', "currency/other.csv")
+            assert find_ingestion_keys('ingestion-bucket-124-33', "staff", "2025-01-01 00:00:00.000000") == [
+                "staff/2025-01-01 00:00:00.000000/part-00000.csv", "staff/2025-01-01 00:00:00.000000/part-00001.csv"]
+            assert find_latest_ingestion_keys('ingestion-bucket-124-33', "currency") == [
+                "currency/2025-01-01 00:00:00.000000.csv"]
+        finally:
+            transform.KEY_INDEX.clear()
+
+
+@mock_aws
+class TestSnapshots:
+    def put_batch(self, s3_client, table, batch, df):
+        wr.s3.to_csv(df, f"s3://ingestion-bucket-124-33/{table}/{batch}.csv")
+
+    def address(self, address_id, city, updated):
+        return {"address_id": address_id, "address_line_1": "1 Road", "address_line_2": None, "district": None,
+                "city": city, "postal_code": "01234", "country": "UK", "phone": "0207", "last_updated": updated}
+
+    def test_latest_row_per_key_wins_and_deletes_are_removed(self):
+        snapshot = pd.DataFrame([self.address(1, "Leeds", datetime(2022, 1, 1)),
+                                 self.address(2, "York", datetime(2022, 1, 1))])
+        changes = pd.DataFrame([self.address(1, "Bath", datetime(2023, 1, 1)),
+                                self.address(3, "Ely", datetime(2023, 1, 1))])
+
+        merged = transform.merge_snapshot(snapshot, changes, "address_id", [2])
+
+        assert merged[["address_id", "city"]].values.tolist() == [[1, "Bath"], [3, "Ely"]]
+        assert merged.equals(transform.merge_snapshot(merged, changes, "address_id", [2]))
+
+    def test_snapshot_is_built_from_history_then_merged_per_batch(self, s3_client):
+        s3_client.create_bucket(Bucket='ingestion-bucket-124-33',
+                                CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        self.put_batch(s3_client, "address", "2024-01-01 00:00:00.000000",
+                       pd.DataFrame([self.address(1, "Leeds", datetime(2024, 1, 1)),
+                                     self.address(2, "York", datetime(2024, 1, 1))]))
+        self.put_batch(s3_client, "address", "2024-02-01 00:00:00.000000",
+                       pd.DataFrame([self.address(2, "Hull", datetime(2024, 2, 1))]))
+
+        assert transform.update_snapshots(s3_client, 'ingestion-bucket-124-33',
+                                          "2024-02-01 00:00:00.000000") == {"address": [1, 2]}
+        self.put_batch(s3_client, "address", "2024-03-01 00:00:00.000000",
+                       pd.DataFrame([self.address(3, "Ely", datetime(2024, 3, 1))]))
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-03-01 00:00:00.000000")
+        # a retried run does not merge its batch again but gets the keys it changed
+        assert transform.update_snapshots(s3_client, 'ingestion-bucket-124-33',
+                                          "2024-03-01 00:00:00.000000") == {"address": [3]}
+
+        snapshot, last_merge = transform.read_snapshot('ingestion-bucket-124-33', "address", s3_client,
+                                                       with_merge=True)
+        assert snapshot[["address_id", "city"]].values.tolist() == [[1, "Leeds"], [2, "Hull"], [3, "Ely"]]
+        assert last_merge == {"batch": "2024-03-01 00:00:00.000000", "changed_keys": [3]}
+
+    def test_snapshots_are_not_read_for_tables_outside_the_batch(self, s3_client, monkeypatch):
+        s3_client.create_bucket(Bucket='ingestion-bucket-124-33',
+                                CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        self.put_batch(s3_client, "address", "2024-01-01 00:00:00.000000",
+                       pd.DataFrame([self.address(1, "Leeds", datetime(2024, 1, 1))]))
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-01-01 00:00:00.000000")
+        read = []
+        monkeypatch.setattr(transform, "read_snapshot",
+                            lambda bucket, table, *args, **kwargs: read.append(table) or (None, {}))
+
+        changes = transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-02-01 00:00:00.000000",
+                                             manifest={"tables": {"staff": {"keys": [], "changed": False}}})
+
+        # only the tables that have no snapshot yet are looked at
+        assert changes == {}
+        assert read == [table for table in transform.SNAPSHOT_TABLES if table != "address"]
+
+    def test_counterparty_joins_addresses_from_earlier_batches(self, s3_client):
+        for bucket in ['ingestion-bucket-124-33', 'processed-bucket-124-33']:
+            s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        self.put_batch(s3_client, "address", "2024-01-01 00:00:00.000000",
+                       pd.DataFrame([self.address(15, "Leeds", datetime(2024, 1, 1))]))
+        self.put_batch(s3_client, "address", "2024-02-01 00:00:00.000000",
+                       pd.DataFrame([self.address(16, "York", datetime(2024, 2, 1))]))
+        self.put_batch(s3_client, "counterparty", "2024-02-01 00:00:00.000000",
+                       pd.DataFrame({"counterparty_id": [1], "counterparty_legal_name": ["Fahey and Sons"],
+                                     "legal_address_id": [15]}))
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-02-01 00:00:00.000000")
+
+        dim_counterparty("2024-02-01 00:00:00.000000", 'ingestion-bucket-124-33', 'processed-bucket-124-33', s3_client)
+
+        df_result = wr.s3.read_parquet(
+            "s3://processed-bucket-124-33/dim_counterparty/2024-02-01 00:00:00.000000.parquet")
+        row = df_result[df_result["counterparty_id"] == 1]
+        assert row["counterparty_legal_city"].tolist() == ["Leeds"]
+
+
+@mock_aws
+class TestIncrementalJoins:
+    def set_up(self, s3_client):
+        for bucket in ['ingestion-bucket-124-33', 'processed-bucket-124-33']:
+            s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+
+    def put_batch(self, table, batch, rows):
+        wr.s3.to_csv(pd.DataFrame(rows), f"s3://ingestion-bucket-124-33/{table}/{batch}.csv")
+
+    def department(self, department_id, name, updated):
+        return {"department_id": department_id, "department_name": name, "location": "Leeds",
+                "last_updated": updated}
+
+    def staff(self, staff_id, department_id):
+        return {"staff_id": staff_id, "first_name": "Jeremie", "last_name": "Franey", "department_id": department_id,
+                "email_address": "j@terrifictotes.com", "last_updated": datetime(2024, 1, 1)}
+
+    def test_repeated_full_scan_rows_are_not_changes(self, s3_client):
+        self.set_up(s3_client)
+        self.put_batch("department", "2024-01-01 00:00:00.000000",
+                       [self.department(1, "Sales", datetime(2024, 1, 1)),
+                        self.department(2, "Finance", datetime(2024, 1, 1))])
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-01-01 00:00:00.000000")
+        self.put_batch("department", "2024-02-01 00:00:00.000000",
+                       [self.department(1, "Sales", datetime(2024, 1, 1)),
+                        self.department(2, "Accounts", datetime(2024, 2, 1))])
+
+        changes = transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-02-01 00:00:00.000000")
+
+        assert changes == {"department": [2]}
+
+    def test_rows_are_compared_by_value_not_last_updated(self, s3_client):
+        self.set_up(s3_client)
+        # files extracted without last_updated, and a rename that did not move it
+        self.put_batch("department", "2024-01-01 00:00:00.000000",
+                       [{"department_id": 1, "department_name": "Sales", "location": "Leeds"},
+                        {"department_id": 2, "department_name": "Finance", "location": "Leeds"}])
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-01-01 00:00:00.000000")
+        self.put_batch("department", "2024-02-01 00:00:00.000000",
+                       [{"department_id": 1, "department_name": "Sales", "location": "Leeds"},
+                        {"department_id": 2, "department_name": "Accounts", "location": "Leeds"}])
+
+        changes = transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-02-01 00:00:00.000000")
+
+        assert changes == {"department": [2]}
+        snapshot = transform.read_snapshot('ingestion-bucket-124-33', "department", s3_client)
+        assert snapshot["department_name"].tolist() == ["Sales", "Accounts"]
+
+    def test_department_change_rebuilds_only_its_staff(self, s3_client):
+        self.set_up(s3_client)
+        self.put_batch("department", "2024-01-01 00:00:00.000000",
+                       [self.department(1, "Sales", datetime(2024, 1, 1)),
+                        self.department(2, "Finance", datetime(2024, 1, 1))])
+        self.put_batch("staff", "2024-01-01 00:00:00.000000", [self.staff(10, 1), self.staff(11, 2)])
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-01-01 00:00:00.000000")
+        batch = "2024-02-01 00:00:00.000000"
+        self.put_batch("department", batch, [self.department(2, "Accounts", datetime(2024, 2, 1))])
+        changes = transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', batch)
+
+        dim_staff(batch, 'ingestion-bucket-124-33', 'processed-bucket-124-33', changed_keys=changes)
+
+        df_result = wr.s3.read_parquet(f"s3://processed-bucket-124-33/dim_staff/{batch}.parquet")
+        assert df_result[["staff_id", "department_name"]].values.tolist() == [[11, "Accounts"]]
+
+    def test_retried_run_still_rebuilds_the_staff_of_a_changed_department(self, s3_client, monkeypatch):
+        self.set_up(s3_client)
+        monkeypatch.setenv("S3_INGESTION_BUCKET", 'ingestion-bucket-124-33')
+        monkeypatch.setenv("S3_PROCESSED_BUCKET", 'processed-bucket-124-33')
+        self.put_batch("department", "2024-01-01 00:00:00.000000",
+                       [self.department(1, "Sales", datetime(2024, 1, 1)),
+                        self.department(2, "Finance", datetime(2024, 1, 1))])
+        self.put_batch("staff", "2024-01-01 00:00:00.000000", [self.staff(10, 1), self.staff(11, 2)])
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-01-01 00:00:00.000000")
+        batch = "2024-02-01 00:00:00.000000"
+        self.put_batch("department", batch, [self.department(2, "Accounts", datetime(2024, 2, 1))])
+        event = {"myresult": {"timestamp_to_transform": batch, "ingestion_format": "csv"}}
+
+        # the first attempt merges the snapshots, then dim_staff fails
+        def failing_dim_staff(*args):
+            raise ValueError("throttled")
+        monkeypatch.setattr(transform, "dim_staff", failing_dim_staff)
+        with pytest.raises(RuntimeError):
+            transform.lambda_handler(event, None)
+        monkeypatch.setattr(transform, "dim_staff", dim_staff)
+        result = transform.lambda_handler(event, None)
+
+        assert result["builders"]["dim_staff"] == 'dim_staff transformation complete'
+        df_result = wr.s3.read_parquet(f"s3://processed-bucket-124-33/dim_staff/{batch}.parquet")
+        assert df_result[["staff_id", "department_name"]].values.tolist() == [[11, "Accounts"]]
+
+    def test_address_change_reaches_counterparties_outside_the_batch(self, s3_client):
+        self.set_up(s3_client)
+        address = {"address_id": 15, "address_line_1": "1 Road", "city": "Leeds", "last_updated": datetime(2024, 1, 1)}
+        self.put_batch("address", "2024-01-01 00:00:00.000000", [address])
+        self.put_batch("counterparty", "2024-01-01 00:00:00.000000",
+                       [{"counterparty_id": 1, "counterparty_legal_name": "Fahey and Sons", "legal_address_id": 15,
+                         "last_updated": datetime(2024, 1, 1)}])
+        transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', "2024-01-01 00:00:00.000000")
+        batch = "2024-02-01 00:00:00.000000"
+        self.put_batch("address", batch, [{**address, "city": "York", "last_updated": datetime(2024, 2, 1)}])
+        changes = transform.update_snapshots(s3_client, 'ingestion-bucket-124-33', batch)
+
+        dim_counterparty(batch, 'ingestion-bucket-124-33', 'processed-bucket-124-33', s3_client, changed_keys=changes)
+
+        df_result = wr.s3.read_parquet(f"s3://processed-bucket-124-33/dim_counterparty/{batch}.parquet")
+        assert df_result[["counterparty_id", "counterparty_legal_city"]].values.tolist() == [[1, "York"]]
+
+
+class TestRunBuilders:
+    def failing_builder(self):
+        raise ValueError("no address file")
+
+    def test_one_failure_does_not_stop_the_others(self):
+        metrics = transform.new_run_metrics()
+        builders = {"dim_currency": lambda: "done", "dim_location": self.failing_builder, "dim_design": lambda: "done"}
+
+        results = transform.run_builders(builders, metrics, {"pool_size": 3, "fail_fast": False})
+
+        assert results == [{"table": "dim_currency", "result": "done"},
+                           {"table": "dim_location", "error": "no address file"},
+                           {"table": "dim_design", "result": "done"}]
+        assert set(metrics["tables"]) == {"dim_currency", "dim_location", "dim_design"}
+
+    def test_builders_overlap_on_the_pool(self):
+        barrier = threading.Barrier(2, timeout=5)
+        builders = {"dim_currency": barrier.wait, "dim_design": barrier.wait}
+
+        results = transform.run_builders(builders, transform.new_run_metrics(), {"pool_size": 2, "fail_fast": False})
+
+        assert all("error" not in result for result in results)
+
+    def test_fail_fast_skips_the_remaining_builders(self):
+        builders = {"dim_location": self.failing_builder, "dim_design": lambda: "done"}
+
+        results = transform.run_builders(builders, transform.new_run_metrics(), {"pool_size": 1, "fail_fast": True})
+
+        assert [result["table"] for result in results] == ["dim_location"]
+
+    def test_config_defaults_to_sequential(self, monkeypatch):
+        monkeypatch.delenv("TRANSFORM_POOL_SIZE", raising=False)
+        monkeypatch.delenv("TRANSFORM_FAIL_FAST", raising=False)
+
+        assert transform.get_transform_config() == {"pool_size": 1, "fail_fast": False}
+
+
+class TestColumnTransforms:
+    def test_every_row_keeps_its_own_date_and_time(self):
+        df = pd.DataFrame({"sales_order_id": [1, 2],
+                           "created_at": [datetime(2022, 11, 3, 14, 20, 52, 186000), datetime(2023, 1, 5, 8, 0)]})
+
+        result = transform.split_datetime_columns(df, {"created_at": "created"})
+
+        assert list(result["created_date"]) == [date(2022, 11, 3), date(2023, 1, 5)]
+        assert list(result["created_time"]) == [time(14, 20, 52, 186000), time(8, 0)]
+        assert "created_at" not in result.columns
+
+    def test_text_dates_are_coerced(self):
+        df = pd.DataFrame({"agreed_payment_date": ["2022-11-08", None]})
+
+        result = transform.coerce_date_columns(df, ["agreed_payment_date"])
+
+        assert result["agreed_payment_date"][0] == date(2022, 11, 8)
+        assert pd.isna(result["agreed_payment_date"][1])
+
+    def test_aliases_and_column_order(self):
+        df = pd.DataFrame({"sales_order_id": [7], "units_sold": [3]})
+
+        result = transform.order_columns(transform.alias_columns(df, {"sales_record_id": "sales_order_id"}),
+                                         ["sales_record_id", "units_sold"])
+
+        assert result.values.tolist() == [[7, 3]]
+        with pytest.raises(KeyError):
+            transform.order_columns(df, ["sales_record_id"])
+
+
 @mock_aws          
 class TestCheckFileExistsInBucket: 
     def test_logs_error_if_ingestion_bucket_does_not_exist(self, s3_client): 
@@ -541,4 +926,215 @@ class TestCheckFileExistsInBucket:
         df = pd.DataFrame(new_rows, columns = columns)
         #file not added to s3 bucket 
 
-        assert check_file_exists_in_ingestion_bucket(bucket='ingestion-bucket-124-33', filename=f"design/{file_marker}.csv") == False
\ No newline at end of file
+        assert check_file_exists_in_ingestion_bucket(bucket='ingestion-bucket-124-33',
+                                                     filename=f"design/{file_marker}.csv") == False
+
+
+@mock_aws
+class TestReadIngestionFile:
+    def test_csv_index_column_is_dropped(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        wr.s3.to_csv(pd.DataFrame({"currency_id": [1]}), "s3://ingestion-bucket-124-33/currency/x.csv")
+
+        df = read_ingestion_file("ingestion-bucket-124-33", "currency/x.csv")
+
+        assert list(df.columns) == ["currency_id"]
+
+    def test_arrow_ipc_file_keeps_its_types(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        table = pa.table({"currency_id": [1], "created_at": [datetime(2022, 11, 3, 14, 20, 49, 962000)]})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        s3_client.put_object(Bucket='ingestion-bucket-124-33', Key="currency/x.arrow",
+                             Body=sink.getvalue().to_pybytes())
+
+        df = read_ingestion_file("ingestion-bucket-124-33", "currency/x.arrow")
+
+        assert df["created_at"][0] == pd.Timestamp(2022, 11, 3, 14, 20, 49, 962000)
+
+    def test_csv_is_read_with_the_source_schema(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        body = (b",address_id,postal_code,phone,last_updated\n"
+                b"0,1,01234,0207 123456,2022-11-03 14:20:49.962\n1,,99999,0207 654321,2022-11-03 14:20:49\n")
+        s3_client.put_object(Bucket='ingestion-bucket-124-33', Key="address/x.csv", Body=body)
+        wr.s3.to_csv(pd.DataFrame({"sales_order_id": [1], "unit_price": [Decimal("3.10")]}),
+                     "s3://ingestion-bucket-124-33/sales_order/x.csv")
+
+        address = read_ingestion_file("ingestion-bucket-124-33", "address/x.csv")
+        sales_order = read_ingestion_file("ingestion-bucket-124-33", "sales_order/x.csv")
+
+        assert list(address["postal_code"]) == ["01234", "99999"]
+        assert str(address["address_id"].dtype) == "Int64"
+        assert address["last_updated"][0] == pd.Timestamp(2022, 11, 3, 14, 20, 49, 962000)
+        assert sales_order["unit_price"][0] == Decimal("3.10")
+
+    def test_copy_engine_booleans_are_read_as_booleans(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        # COPY ... TO STDOUT WITH (FORMAT csv) writes booleans as t/f and NULL as an empty field
+        copy_body = b"payment_id,paid,payment_date\n1,t,2022-11-03\n2,f,2022-11-04\n3,,f\n"
+        s3_client.put_object(Bucket='ingestion-bucket-124-33', Key="payment/copy.csv", Body=copy_body)
+        wr.s3.to_csv(pd.DataFrame({"payment_id": [1, 2], "paid": [True, False]}),
+                     "s3://ingestion-bucket-124-33/payment/select.csv")
+
+        copied = read_ingestion_file("ingestion-bucket-124-33", "payment/copy.csv")
+        selected = read_ingestion_file("ingestion-bucket-124-33", "payment/select.csv")
+
+        assert str(copied["paid"].dtype) == "boolean"
+        assert list(copied["paid"][:2]) == [True, False]
+        assert copied["paid"].isna()[2]
+        # a text column keeps its t/f as text
+        assert copied["payment_date"][2] == "f"
+        assert list(selected["paid"]) == [True, False]
+
+
+
+@mock_aws
+class TestCompression:
+    @pytest.mark.parametrize("codec,extension", [("gzip", "gz"), ("zstd", "zst")])
+    def test_compressed_csv_is_read(self, s3_client, codec, extension):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        body = pa.Codec(codec).compress(b",currency_id,currency_code\n0,1,GBP\n", asbytes=True)
+        s3_client.put_object(Bucket='ingestion-bucket-124-33', Key=f"currency/x.csv.{extension}", Body=body)
+
+        df = read_ingestion_file('ingestion-bucket-124-33', f"currency/x.csv.{extension}")
+
+        assert list(df.columns) == ["currency_id", "currency_code"]
+        assert list(df["currency_code"]) == ["GBP"]
+
+    def test_processed_codec_defaults_to_snappy(self, monkeypatch):
+        monkeypatch.delenv("PROCESSED_CODEC", raising=False)
+        monkeypatch.delenv("PROCESSED_CODECS", raising=False)
+
+        assert processed_parquet_options("dim_staff") == {"compression": "snappy"}
+
+    def test_processed_codec_can_be_set_per_table(self, monkeypatch):
+        monkeypatch.setenv("PROCESSED_CODEC", "none")
+        monkeypatch.setenv("PROCESSED_CODECS", "fact_sales_order=zstd:9")
+
+        assert processed_parquet_options("fact_sales_order") == {
+            "compression": "zstd", "pyarrow_additional_kwargs": {"compression_level": 9}}
+        assert processed_parquet_options("dim_date") == {"compression": None}
+
+    def test_processed_file_uses_the_codec(self, s3_client, monkeypatch):
+        monkeypatch.setenv("PROCESSED_CODECS", "dim_date=gzip")
+        s3_client.create_bucket(
+        Bucket='processed-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+
+        key = dim_date("x", 'processed-bucket-124-33', start='2020-01-01', end='2020-01-31')
+
+        body = s3_client.get_object(Bucket='processed-bucket-124-33', Key=key)["Body"].read()
+        assert pq.ParquetFile(io.BytesIO(body)).metadata.row_group(0).column(0).compression == "GZIP"
+
+
+@mock_aws
+class TestFindIngestionKeys:
+    def test_part_files_of_a_split_table_are_found(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        file_marker = "1995-01-01 00:00:00.000000"
+        for part in [1, 0]:
+            s3_client.put_object(Bucket='ingestion-bucket-124-33',
+                                 Key=f"sales_order/{file_marker}/part-0000{part}.csv", Body=b"")
+
+        keys = find_ingestion_keys('ingestion-bucket-124-33', "sales_order", file_marker)
+
+        assert keys == [f"sales_order/{file_marker}/part-00000.csv", f"sales_order/{file_marker}/part-00001.csv"]
+
+    def test_no_keys_when_table_is_not_in_the_batch(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+
+        assert find_ingestion_keys('ingestion-bucket-124-33', "sales_order", "1995-01-01 00:00:00.000000") == []
+
+    def test_keys_come_from_the_manifest_without_touching_the_bucket(self):
+        manifest = {"tables": {
+            "sales_order": {"changed": True, "keys": ["sales_order/1995/part-00000.csv"]},
+            "department": {"changed": False, "keys": ["department/1990.csv"]}}}
+
+        assert find_ingestion_keys('no-such-bucket', "sales_order", "1995", manifest=manifest) == [
+            "sales_order/1995/part-00000.csv"]
+        assert find_ingestion_keys('no-such-bucket', "department", "1995", manifest=manifest) == []
+        assert find_latest_ingestion_keys('no-such-bucket', "department", manifest) == ["department/1990.csv"]
+
+    def test_batch_manifest_is_read_from_the_payload_key(self, s3_client):
+        s3_client.create_bucket(
+        Bucket='ingestion-bucket-124-33',
+        CreateBucketConfiguration={
+        'LocationConstraint': 'eu-west-2',
+            },
+        )
+        manifest = {"batch": "1995", "ingestion_format": "csv", "tables": {}}
+        s3_client.put_object(Bucket='ingestion-bucket-124-33', Key="manifests/1995.json", Body=json.dumps(manifest))
+
+        assert get_batch_manifest(s3_client, 'ingestion-bucket-124-33', "manifests/1995.json") == manifest
+        assert get_batch_manifest(s3_client, 'ingestion-bucket-124-33', None) is None
+
+
+def test_importing_transform_does_not_load_dataframe_libraries():
+    code = ("import sys, src.lambda_handler.transform; "
+            "print(any(name in sys.modules for name in ['pandas', 'awswrangler', 'pyarrow']))")
+
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+
+    assert output.strip() == "False"
+
+
+@mock_aws
+class TestTableMetrics:
+    def test_builder_rows_and_bytes_are_recorded_per_table(self, s3_client):
+        transform.install_s3_meter()
+        s3_client = boto3.client("s3", region_name="eu-west-2")
+        for bucket in ['ingestion-bucket-124-33', 'processed-bucket-124-33']:
+            s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'eu-west-2'})
+        body = (b"currency_id,currency_code,created_at,last_updated\n"
+                b"1,GBP,2025-06-10 09:15:00,2025-06-10 09:15:00\n2,USD,2025-06-10 09:15:00,2025-06-10 09:15:00\n")
+        s3_client.put_object(Bucket='ingestion-bucket-124-33', Key="currency/x.csv", Body=body)
+        metrics = transform.new_run_metrics()
+
+        with transform.table_timer(metrics, "dim_currency"):
+            dim_currency("x", 'ingestion-bucket-124-33', 'processed-bucket-124-33')
+
+        record = metrics["tables"]["dim_currency"]
+        assert record["rows_in"] == 2
+        assert record["rows_out"] == 2
+        assert record["bytes_read"] == len(body)
+        assert record["bytes_written"] > 0
+        assert record["s3_requests"] > 0